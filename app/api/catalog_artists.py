@@ -1,10 +1,13 @@
 from __future__ import annotations
 
+import os
 from typing import Any, Dict, List, Optional
-from fastapi import APIRouter, Request, HTTPException, Query
+from fastapi import APIRouter, Request, HTTPException, Query, Response
 
 router = APIRouter(tags=["catalog"])
 
+SUMMARY_TTL = int(os.environ.get("CATALOG_SUMMARY_TTL", "60"))
+
 # --- helpers ---------------------------------------------------------------
 
 def _row_to_track(r) -> Dict[str, Any]:
@@ -27,6 +30,7 @@ def _row_to_track(r) -> Dict[str, Any]:
 @router.get("/catalog/artists/summary")
 async def artists_summary(
     request: Request,
+    response: Response,
     top: int = Query(3, ge=1, le=20),
     chat: str = Query("OGMA_archive"),
 ) -> Dict[str, Any]:
@@ -87,6 +91,8 @@ async def artists_summary(
         except Exception:
             out_top = []
 
+    # сводка одна на всех — пусть её кешируют клиенты и слой сжатия
+    response.headers["Cache-Control"] = f"public, max-age={SUMMARY_TTL}"
     return {
         "top": out_top,
         "ru": row["ru"] or [],
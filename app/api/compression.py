@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+import os
+import gzip
+import hashlib
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:  # brotli — опционально; без него отдаём gzip
+    import brotli  # type: ignore
+except Exception:  # pragma: no cover
+    brotli = None  # type: ignore
+
+# Сжатие ответов по типу контента — замена GZipMiddleware, который жал всё подряд,
+# включая audio/mpeg. Жмём только текст/JSON и только тело одним сообщением (обычные
+# JSON-ответы FastAPI); стримы (аудио, SSE) проходят как есть. Для кешируемых ответов
+# (Cache-Control: public/max-age без no-store/private) сжатое тело кладётся в LRU по
+# хешу исходного тела — одинаковые сводки каталога не пережимаются на каждый запрос.
+
+MIN_SIZE = int(os.environ.get("HTTP_COMPRESS_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.environ.get("HTTP_GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.environ.get("HTTP_BROTLI_QUALITY", "5"))
+CACHE_MAX_BYTES = int(os.environ.get("HTTP_COMPRESS_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+COMPRESSIBLE_PREFIXES = ("text/",)
+COMPRESSIBLE_TYPES = {
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "application/x-ndjson",
+    "image/svg+xml",
+}
+NEVER_COMPRESS = {"text/event-stream"}
+
+
+def is_compressible(content_type: str) -> bool:
+    mt = (content_type or "").split(";", 1)[0].strip().lower()
+    if not mt or mt in NEVER_COMPRESS:
+        return False
+    return mt in COMPRESSIBLE_TYPES or mt.endswith("+json") or mt.startswith(COMPRESSIBLE_PREFIXES)
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """br, если клиент его принимает и модуль установлен; иначе gzip; иначе None."""
+    accepted = {}
+    for part in (accept_encoding or "").lower().split(","):
+        name, _, params = part.strip().partition(";")
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name] = q
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", accepted.get("*", 0)) > 0:
+        return "gzip"
+    return None
+
+
+def _cacheable(headers: Headers) -> bool:
+    cc = headers.get("cache-control", "").lower()
+    if not cc or "no-store" in cc or "private" in cc or "no-cache" in cc:
+        return False
+    return "public" in cc or "max-age" in cc
+
+
+def _compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)  # type: ignore[union-attr]
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+class CompressedBodyCache:
+    """LRU сжатых тел с бюджетом в байтах. Ключ — (sha1 исходного тела, кодировка)."""
+
+    def __init__(self, max_bytes: int = CACHE_MAX_BYTES):
+        self.max_bytes = max(0, int(max_bytes))
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items: "OrderedDict[Tuple[bytes, str], bytes]" = OrderedDict()
+
+    def get_or_compress(self, body: bytes, encoding: str) -> bytes:
+        if not self.max_bytes:
+            return _compress(body, encoding)
+        key = (hashlib.sha1(body).digest(), encoding)
+        hit = self._items.get(key)
+        if hit is not None:
+            self._items.move_to_end(key)
+            self.hits += 1
+            return hit
+        self.misses += 1
+        out = _compress(body, encoding)
+        if len(out) <= self.max_bytes:
+            self._items[key] = out
+            self.bytes += len(out)
+            while self.bytes > self.max_bytes and self._items:
+                _, old = self._items.popitem(last=False)
+                self.bytes -= len(old)
+        return out
+
+
+_default_cache = CompressedBodyCache()
+
+
+class CompressionMiddleware:
+    def __init__(self, app: ASGIApp, minimum_size: int = MIN_SIZE, cache: Optional[CompressedBodyCache] = None):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.cache = cache if cache is not None else _default_cache
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await _Responder(self, encoding, send)(self.app, scope, receive)
+
+
+class _Responder:
+    def __init__(self, mw: CompressionMiddleware, encoding: str, send: Send):
+        self.mw = mw
+        self.encoding = encoding
+        self.send = send
+        self.start: Optional[Message] = None
+        self.passthrough = False
+
+    async def __call__(self, app: ASGIApp, scope: Scope, receive: Receive) -> None:
+        await app(scope, receive, self.on_send)
+
+    async def on_send(self, message: Message) -> None:
+        if self.passthrough:
+            await self.send(message)
+            return
+
+        if message["type"] == "http.response.start":
+            headers = Headers(raw=message["headers"])
+            status = message["status"]
+            if (
+                status < 200 or status in (204, 206, 304)
+                or "content-encoding" in headers
+                or "content-range" in headers
+                or not is_compressible(headers.get("content-type", ""))
+            ):
+                # аудио, диапазоны, уже сжатое — не трогаем и не буферим
+                self.passthrough = True
+                await self.send(message)
+            else:
+                self.start = message
+            return
+
+        if message["type"] != "http.response.body" or self.start is None:
+            await self.send(message)
+            return
+
+        start, self.start = self.start, None
+        body = message.get("body", b"")
+        if message.get("more_body", False) or len(body) < self.mw.minimum_size:
+            # потоковый ответ или мелочь — отдаём как есть
+            self.passthrough = True
+            await self.send(start)
+            await self.send(message)
+            return
+
+        headers = MutableHeaders(raw=start["headers"])
+        if _cacheable(headers):
+            out = self.mw.cache.get_or_compress(body, self.encoding)
+        else:
+            out = _compress(body, self.encoding)
+        headers["Content-Encoding"] = self.encoding
+        headers["Content-Length"] = str(len(out))
+        headers.add_vary_header("Accept-Encoding")
+        if "etag" in headers and not headers["etag"].startswith("W/"):
+            # представление изменилось — строгий ETag делаем слабым
+            headers["ETag"] = "W/" + headers["etag"]
+        self.passthrough = True
+        await self.send(start)
+        await self.send({"type": "http.response.body", "body": out, "more_body": False})
@@ -10,6 +10,7 @@ import uuid
 
 # Берём готовые хелперы авторизации и резолва юзера
 from app.api.auth_shared import resolve_user_id
+from app.api.tgstream.prefetch import default_prefetcher
 
 router = APIRouter()
 
@@ -172,6 +173,11 @@ async def me_listen(payload: ListenIn, request: Request):
     if not track_id:
         raise HTTPException(404, "Track not found")
 
+    # голова следующих треков плейлиста — в кеш стрима, пока этот ещё играет
+    prefetcher = default_prefetcher()
+    if prefetcher is not None:
+        prefetcher.hint(int(uid), pool, str(track_id), payload.playlist_id, payload.playlist_handle)
+
     try:
         track_uuid = uuid.UUID(str(track_id))
     except Exception:
@@ -19,6 +19,7 @@ from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from starlette.responses import Response
 
 from app.observability.metrics import PromHTTPMiddleware, metrics_app  # metrics_app не монтируем на "/"
+from app.api.compression import CompressionMiddleware
 from app.api.telegram_logger import TelegramHandler
 
 from app.api.search import router as search_router
@@ -26,6 +27,8 @@ from app.api import me_send as _me_send
 from app.api.auth_webapp import router as auth_router
 from app.api.users import router as users_router
 from app.api.stream_gateway import router as stream_router, close_tg as _close_tg
+from app.api.tgstream.cachemgr import start_cache_manager, stop_cache_manager
+from app.api.tgstream.warmer import start_warmer, stop_warmer
 from app.api import catalog_artists as _catalog_artists
 from app.api import listen as _listen
 from app.api.playlists import router as playlists_router
@@ -235,9 +238,17 @@ async def lifespan(app: FastAPI):
             await start_log_shipper(app)
         await start_console_logs(app)
         await start_cache_shipper(app)
+        # 💾 бюджет и вытеснение дискового кеша стрима
+        await start_cache_manager(app)
+        # 🔥 прогрев кеша популярными треками в тихие часы
+        await start_warmer(app)
+        # 📨 очередь /me/send
+        await _me_send.start_send_queue(app)
         yield
     finally:
         # 👇 корректно останавливаем фоновые задачи
+        with suppress(Exception):
+            await _me_send.stop_send_queue(app)
         with suppress(Exception):
             await stop_live_monitors(app)
         # ⛔ останов лог-shipper
@@ -247,6 +258,10 @@ async def lifespan(app: FastAPI):
             await stop_console_logs(app)
         with suppress(Exception):
             await stop_cache_shipper(app)
+        with suppress(Exception):
+            await stop_warmer(app)
+        with suppress(Exception):
+            await stop_cache_manager(app)
 
         if tg_handler:
             logging.getLogger().removeHandler(tg_handler)
@@ -296,6 +311,8 @@ async def _ogma_metrics_mw(request: Request, call_next):
 # Если нужно отдельное приложение с метриками — оставляем только /metrics через Instrumentator.
 # app.mount("/metrics", metrics_app)  # ← не нужно, конфликтует с Instrumentator
 app.add_middleware(PromHTTPMiddleware)
+# сжатие JSON/текста (gzip/br); аудио и Range-ответы проходят без сжатия
+app.add_middleware(CompressionMiddleware)
 
 # ── CORS: без '*' при credentials; список из ENV иначе dev-дефолт ─────────────
 _allow_origins = [
@@ -324,6 +341,8 @@ app.add_middleware(
         "Content-Range",
         "Content-Length",
         "Content-Encoding",
+        "ETag",
+        "Last-Modified",
     ],
 )
 
@@ -2,10 +2,12 @@
 from __future__ import annotations
 
 import os
-import tempfile
+import socket
+import logging
+import contextlib
 import asyncio as _asyncio
 from dataclasses import dataclass
-from typing import Optional
+from typing import Optional, Set
 
 import asyncpg
 from fastapi import APIRouter, HTTPException, Request, BackgroundTasks
@@ -13,24 +15,68 @@ from pydantic import BaseModel, Field
 
 from telethon import TelegramClient, types
 from telethon.errors import RPCError
-from telethon.tl.types import Document
+from telethon.errors.rpcerrorlist import (
+    DocumentInvalidError,
+    FileIdInvalidError,
+    FileReferenceEmptyError,
+    FileReferenceExpiredError,
+    FileReferenceInvalidError,
+    MediaEmptyError,
+    MediaInvalidError,
+)
 
 from app.api.stream_gateway import (  # реюзим готовые хелперы
-    _get_document,
+    _fetch_location,
     _db_get_track,
     _filename_from,
-    _ensure_tg,
     _maybe_user_id,
+    _tg_byte_iter,
 )
+from app.api.tgstream.locations import DocLocation, cache as _loc_cache
+from app.api.tgstream.scheduler import BULK as PRIO_BULK
+from app.api.tgstream.upload import stream_upload
+
+try:
+    from app.api.telemetry.metrics import mark_send_job
+except Exception:
+    def mark_send_job(result: str) -> None:  # type: ignore
+        pass
 
 router = APIRouter()
+log = logging.getLogger("app.me_send")
+
+# --- очередь отправок (send_jobs, sql/013_send_jobs.sql) ---
+# Эндпоинт кладёт задание в таблицу, воркеры API разбирают её не больше SEND_CONCURRENCY
+# за раз (и не больше одного задания на пользователя одновременно). Пока задание
+# выполняется, воркер продлевает аренду (started_at); задание с истёкшей арендой — воркер
+# умер или перезапустился — снова берётся в работу.
+SEND_CONCURRENCY = int(os.environ.get("SEND_CONCURRENCY", "2"))
+SEND_MAX_ATTEMPTS = int(os.environ.get("SEND_MAX_ATTEMPTS", "3"))
+SEND_LEASE_S = int(os.environ.get("SEND_LEASE_S", "300"))
+SEND_POLL_S = float(os.environ.get("SEND_POLL_S", "5"))
+SEND_USER_QUEUE_MAX = int(os.environ.get("SEND_USER_QUEUE_MAX", "20"))
+SEND_KEEP_DAYS = int(os.environ.get("SEND_KEEP_DAYS", "7"))
+_WORKER = f"{socket.gethostname()}:{os.getpid()}"
+_WAKE: Optional[_asyncio.Event] = None
 
 # --- отдельный бот-клиент ---
 _BOT: Optional[TelegramClient] = None
+_BOT_ID: Optional[int] = None
+
+# Telegram больше не принимает сохранённый документ бота — строку в bot_file_ids удаляем
+_STALE_FILE_ERRORS = (
+    DocumentInvalidError,
+    FileIdInvalidError,
+    FileReferenceEmptyError,
+    FileReferenceExpiredError,
+    FileReferenceInvalidError,
+    MediaEmptyError,
+    MediaInvalidError,
+)
 
 async def _ensure_bot():
     """Ленивый запуск Telethon-бота в отдельной сессии."""
-    global _BOT
+    global _BOT, _BOT_ID
     if _BOT is not None:
         return
     api_id = int(os.environ["TELEGRAM_API_ID"])
@@ -41,8 +87,10 @@ async def _ensure_bot():
 
     # можно хранить сессию на диске, чтобы избежать лимитов логина
     sess_path = os.environ.get("TELEGRAM_BOT_SESSION", "/home/ogma/ogma/stream/ogma_bot.session")
-    _BOT = TelegramClient(sess_path, api_id, api_hash)
-    await _BOT.start(bot_token=bot_token)
+    bot = TelegramClient(sess_path, api_id, api_hash)
+    await bot.start(bot_token=bot_token)
+    _BOT_ID = int((await bot.get_me()).id)
+    _BOT = bot
 
 
 # ----- модель запроса -----
@@ -67,14 +115,14 @@ async def _resolve_track_meta(pool: asyncpg.Pool, body: SendReq) -> TrackMeta:
     if body.chat and body.msg_id:
         chat_username = body.chat.lstrip("@")
         # подтянем документ, а заодно выясним mime/size
-        doc: Document = await _get_document(chat_username, int(body.msg_id))
+        loc = await _fetch_location(chat_username, int(body.msg_id), PRIO_BULK)
         return TrackMeta(
             chat_username=chat_username,
             msg_id=int(body.msg_id),
             title=None,
             artists=[],
-            mime=getattr(doc, "mime_type", None),
-            size_bytes=getattr(doc, "size", None),
+            mime=loc.mime,
+            size_bytes=loc.size or None,
         )
 
     if body.track_id:
@@ -108,18 +156,110 @@ async def _try_forward(user_id: int, meta: TrackMeta) -> bool:
         return False
 
 
-async def _download_via_user(doc: Document, dst_path: str):
-    """Качаем оригинал через пользовательскую сессию (user session)."""
-    await _ensure_tg()  # из stream_gateway
-    from app.api.stream_gateway import _TG  # type: ignore
-    assert _TG is not None
-    # iter_download в файл
-    async with await _TG.download_media(doc, file=dst_path) as _:
+# --- документы, уже загруженные ботом (bot_file_ids, sql/012_bot_file_ids.sql) ---
+async def _cached_bot_file(pool: asyncpg.Pool, meta: TrackMeta) -> Optional[asyncpg.Record]:
+    try:
+        row = await pool.fetchrow(
+            """
+            select doc_id, access_hash, file_ref, src_doc_id
+              from bot_file_ids
+             where bot_id = $1 and chat_username = $2 and tg_msg_id = $3
+            """,
+            _BOT_ID, meta.chat_username, meta.msg_id,
+        )
+    except asyncpg.UndefinedTableError:
+        return None
+    if row is None:
+        return None
+    # сообщение в канале могли заменить другим файлом — сверяемся с кешем расположений
+    loc = _loc_cache().get((meta.chat_username, meta.msg_id))
+    if loc is not None and row["src_doc_id"] and int(row["src_doc_id"]) != int(loc.doc_id):
+        await _forget_bot_file(pool, meta)
+        return None
+    return row
+
+
+async def _remember_bot_file(pool: asyncpg.Pool, meta: TrackMeta, doc, src_doc_id: Optional[int]) -> None:
+    try:
+        await pool.execute(
+            """
+            insert into bot_file_ids(bot_id, chat_username, tg_msg_id, doc_id, access_hash, file_ref, src_doc_id)
+            values ($1, $2, $3, $4, $5, $6, $7)
+            on conflict (bot_id, chat_username, tg_msg_id) do update set
+              doc_id      = excluded.doc_id,
+              access_hash = excluded.access_hash,
+              file_ref    = excluded.file_ref,
+              src_doc_id  = excluded.src_doc_id,
+              created_at  = now()
+            """,
+            _BOT_ID, meta.chat_username, meta.msg_id,
+            int(doc.id), int(doc.access_hash), bytes(doc.file_reference or b""), src_doc_id,
+        )
+    except Exception as e:
+        log.warning("bot_file_ids insert failed for %s/%s: %r", meta.chat_username, meta.msg_id, e)
+
+
+async def _forget_bot_file(pool: asyncpg.Pool, meta: TrackMeta) -> None:
+    try:
+        await pool.execute(
+            "delete from bot_file_ids where bot_id = $1 and chat_username = $2 and tg_msg_id = $3",
+            _BOT_ID, meta.chat_username, meta.msg_id,
+        )
+    except Exception:
         pass
 
 
-async def _bot_send_file(user_id: int, file_path: str, meta: TrackMeta):
-    """Загрузка файла ботом в личку пользователю с красивыми атрибутами аудио."""
+def _caption(meta: TrackMeta) -> str:
+    performer = (", ".join(meta.artists)) if meta.artists else None
+    if meta.title or performer:
+        return f"{performer + ' — ' if performer else ''}{meta.title or ''}".strip(" —")
+    return ""
+
+
+async def _try_cached_send(pool: asyncpg.Pool, user_id: int, meta: TrackMeta) -> bool:
+    """Шлём документ, который бот уже загружал для этого трека, — ноль байт трафика."""
+    await _ensure_bot()
+    assert _BOT is not None
+    row = await _cached_bot_file(pool, meta)
+    if row is None:
+        return False
+    doc = types.InputDocument(
+        id=int(row["doc_id"]), access_hash=int(row["access_hash"]), file_reference=bytes(row["file_ref"])
+    )
+    try:
+        await _BOT.send_file(entity=user_id, file=doc, caption=_caption(meta))
+    except _STALE_FILE_ERRORS as e:
+        log.info("cached bot file for %s/%s rejected: %r", meta.chat_username, meta.msg_id, e)
+        await _forget_bot_file(pool, meta)
+        return False
+    except RPCError:
+        return False
+    with contextlib.suppress(Exception):
+        await pool.execute(
+            """
+            update bot_file_ids set sends = sends + 1, used_at = now()
+             where bot_id = $1 and chat_username = $2 and tg_msg_id = $3
+            """,
+            _BOT_ID, meta.chat_username, meta.msg_id,
+        )
+    return True
+
+
+async def _reupload_via_bot(pool: asyncpg.Pool, loc: DocLocation, name: str):
+    """Качаем оригинал пользовательской сессией тем же путём, что и стрим (блочный кеш +
+    общий планировщик, класс bulk) и сразу заливаем частями ботом — без временного файла."""
+    await _ensure_bot()
+    assert _BOT is not None
+    chunks = _tg_byte_iter(loc, 0, loc.size - 1, pool, PRIO_BULK)
+    try:
+        return await stream_upload(_BOT, chunks, loc.size, name)
+    finally:
+        await chunks.aclose()
+
+
+async def _bot_send_file(user_id: int, file, meta: TrackMeta):
+    """Отправка ботом в личку пользователю с красивыми атрибутами аудио; file — путь или
+    InputFile после stream_upload. Возвращает сообщение — его документ потом шлём без перезагрузки."""
     await _ensure_bot()
     assert _BOT is not None
 
@@ -135,48 +275,236 @@ async def _bot_send_file(user_id: int, file_path: str, meta: TrackMeta):
             performer=performer,
         )]
 
-    caption = None
-    if title or performer:
-        caption = f"{performer + ' — ' if performer else ''}{title or ''}".strip(" —")
-
-    await _BOT.send_file(
+    return await _BOT.send_file(
         entity=user_id,
-        file=file_path,
-        caption=caption or "",
+        file=file,
+        caption=_caption(meta),
         attributes=attrs,
+        mime_type=meta.mime or None,
         force_document=False,  # пусть телеграм распознает как музыку
     )
 
 
 async def _send_track_to_user(pool: asyncpg.Pool, user_id: int, meta: TrackMeta):
-    """Главная фонова задача: forward или reupload."""
-    # 1) пробуем переслать
+    """Главная фонова задача: уже загруженный ботом документ, forward или reupload."""
+    # 1) бот уже загружал этот трек — шлём тот же документ
+    if await _try_cached_send(pool, user_id, meta):
+        return
+
+    # 2) пробуем переслать
     ok = await _try_forward(user_id, meta)
     if ok:
         return
 
-    # 2) если переслать нельзя — качаем юзер-сессией и грузим ботом
-    doc = await _get_document(meta.chat_username, meta.msg_id)
+    # 3) если переслать нельзя — качаем юзер-сессией, на лету грузим ботом и запоминаем документ
+    loc = await _fetch_location(meta.chat_username, meta.msg_id, PRIO_BULK)
     # проверка лимита 2ГБ
-    size = int(getattr(doc, "size", 0) or meta.size_bytes or 0)
+    size = int(loc.size or meta.size_bytes or 0)
     if size > 2 * 1024 * 1024 * 1024:
         raise HTTPException(413, "File is larger than Telegram limit (2GB)")
 
-    # временный файл с читабельным именем
+    # читабельное имя файла
     fname = _filename_from(meta.title, meta.artists, meta.mime)
-    tmp_dir = os.environ.get("OGMA_TMP", "/tmp/ogma_slices")
-    os.makedirs(tmp_dir, exist_ok=True)
-    tmp_path = os.path.join(tmp_dir, f"{fname}")
+    uploaded = await _reupload_via_bot(pool, loc, fname)
+    sent = await _bot_send_file(user_id, uploaded, meta)
+    doc = getattr(sent, "document", None)
+    if doc is not None:
+        await _remember_bot_file(pool, meta, doc, int(loc.doc_id))
+
+
+_ENQUEUE_SQL = """
+insert into send_jobs(user_id, chat_username, tg_msg_id, title, artists, mime, size_bytes)
+values ($1, $2, $3, $4, $5, $6, $7)
+on conflict (user_id, chat_username, tg_msg_id) where status in ('queued', 'running') do nothing
+returning id
+"""
+
+# свободные задания: очередь по порядку, у пользователя не больше одного в работе
+_CLAIM_SQL = """
+update send_jobs s
+   set status = 'running', attempts = s.attempts + 1, started_at = now(), worker = $1
+ where s.id in (
+   select j.id
+     from send_jobs j
+    where j.run_after <= now()
+      and (j.status = 'queued'
+           or (j.status = 'running' and j.started_at < now() - make_interval(secs => $3)))
+      and not exists (
+            select 1 from send_jobs r
+             where r.user_id = j.user_id and r.id <> j.id and r.status = 'running'
+               and r.started_at >= now() - make_interval(secs => $3))
+    order by j.id
+    limit $2
+    for update skip locked)
+returning s.*
+"""
+
+
+async def _enqueue_send(pool: asyncpg.Pool, user_id: int, meta: TrackMeta) -> int:
+    async with pool.acquire() as con:
+        pending = await con.fetchval(
+            "select count(*) from send_jobs where user_id = $1 and status in ('queued', 'running')", user_id
+        )
+        if int(pending or 0) >= SEND_USER_QUEUE_MAX:
+            raise HTTPException(429, "Too many pending sends")
+        job_id = await con.fetchval(
+            _ENQUEUE_SQL,
+            user_id, meta.chat_username, meta.msg_id, meta.title, list(meta.artists or []),
+            meta.mime, meta.size_bytes,
+        )
+        if job_id is None:  # этот трек уже в очереди у пользователя
+            job_id = await con.fetchval(
+                """
+                select id from send_jobs
+                 where user_id = $1 and chat_username = $2 and tg_msg_id = $3
+                   and status in ('queued', 'running')
+                """,
+                user_id, meta.chat_username, meta.msg_id,
+            )
+    if _WAKE is not None:
+        _WAKE.set()
+    return int(job_id)
+
+
+async def _finish_job(pool: asyncpg.Pool, job_id: int, status: str, error: Optional[str] = None, delay_s: float = 0) -> None:
+    mark_send_job("retry" if status == "queued" else status)
+    with contextlib.suppress(Exception):
+        await pool.execute(
+            """
+            update send_jobs
+               set status = $2, last_error = $3, worker = null,
+                   run_after = now() + make_interval(secs => $4),
+                   finished_at = case when $2 = 'queued' then null else now() end
+             where id = $1
+            """,
+            job_id, status, error, float(delay_s),
+        )
+
+
+async def _keep_lease(pool: asyncpg.Pool, job_id: int) -> None:
+    while True:
+        await _asyncio.sleep(max(1.0, SEND_LEASE_S / 3))
+        with contextlib.suppress(Exception):
+            await pool.execute(
+                "update send_jobs set started_at = now() where id = $1 and worker = $2 and status = 'running'",
+                job_id, _WORKER,
+            )
+
 
+async def _run_job(pool: asyncpg.Pool, row: asyncpg.Record) -> None:
+    job_id = int(row["id"])
+    attempts = int(row["attempts"])
+    if attempts > SEND_MAX_ATTEMPTS:  # воркер падал на этом задании раз за разом
+        await _finish_job(pool, job_id, "failed", row["last_error"] or "lease expired")
+        return
+    meta = TrackMeta(
+        chat_username=row["chat_username"],
+        msg_id=int(row["tg_msg_id"]),
+        title=row["title"],
+        artists=list(row["artists"] or []),
+        mime=row["mime"],
+        size_bytes=row["size_bytes"],
+    )
+    lease = _asyncio.create_task(_keep_lease(pool, job_id), name="ogma-send-lease")
     try:
-        await _download_via_user(doc, tmp_path)
-        await _bot_send_file(user_id, tmp_path, meta)
+        await _send_track_to_user(pool, int(row["user_id"]), meta)
+    except _asyncio.CancelledError:
+        raise
+    except HTTPException as e:  # 413 и т.п. — повтор не поможет
+        await _finish_job(pool, job_id, "failed", str(e.detail))
+    except Exception as e:
+        log.warning("send job %s failed (attempt %d/%d): %r", job_id, attempts, SEND_MAX_ATTEMPTS, e)
+        if attempts >= SEND_MAX_ATTEMPTS:
+            await _finish_job(pool, job_id, "failed", repr(e))
+        else:
+            await _finish_job(pool, job_id, "queued", repr(e), delay_s=30 * 2 ** (attempts - 1))
+    else:
+        await _finish_job(pool, job_id, "done")
     finally:
-        # по желанию можно хранить сутки — пока удаляем сразу
-        try:
-            os.remove(tmp_path)
-        except Exception:
-            pass
+        lease.cancel()
+        with contextlib.suppress(BaseException):
+            await lease
+
+
+async def _send_runner(pool: asyncpg.Pool, stop_evt: _asyncio.Event, wake: _asyncio.Event) -> None:
+    running: Set[_asyncio.Task] = set()
+
+    def _done(t: _asyncio.Task) -> None:
+        running.discard(t)
+        wake.set()
+
+    last_cleanup = 0.0
+    loop = _asyncio.get_running_loop()
+    try:
+        while not stop_evt.is_set():
+            wake.clear()
+            free = SEND_CONCURRENCY - len(running)
+            if free > 0:
+                try:
+                    rows = await pool.fetch(_CLAIM_SQL, _WORKER, free, SEND_LEASE_S)
+                except asyncpg.UndefinedTableError:
+                    log.warning("send_jobs table is missing (sql/013_send_jobs.sql) — /me/send runs in-process")
+                    return
+                except Exception as e:
+                    log.warning("send queue claim failed: %r", e)
+                    rows = []
+                for row in rows:
+                    t = _asyncio.create_task(_run_job(pool, row), name="ogma-send-job")
+                    running.add(t)
+                    t.add_done_callback(_done)
+            if loop.time() - last_cleanup > 3600:
+                last_cleanup = loop.time()
+                with contextlib.suppress(Exception):
+                    await pool.execute(
+                        """
+                        delete from send_jobs
+                         where status in ('done', 'failed') and finished_at < now() - make_interval(days => $1)
+                        """,
+                        SEND_KEEP_DAYS,
+                    )
+            with contextlib.suppress(_asyncio.TimeoutError):
+                await _asyncio.wait_for(wake.wait(), SEND_POLL_S)
+    finally:
+        for t in list(running):
+            t.cancel()
+        if running:
+            await _asyncio.gather(*list(running), return_exceptions=True)
+        # прерванные остановкой задания — обратно в очередь без штрафа за попытку
+        with contextlib.suppress(Exception):
+            await pool.execute(
+                """
+                update send_jobs
+                   set status = 'queued', worker = null, started_at = null, attempts = greatest(attempts - 1, 0)
+                 where worker = $1 and status = 'running'
+                """,
+                _WORKER,
+            )
+
+
+async def start_send_queue(app) -> None:
+    global _WAKE
+    if SEND_CONCURRENCY <= 0:
+        return
+    stop_evt = _asyncio.Event()
+    _WAKE = _asyncio.Event()
+    app.state._send_stop_evt = stop_evt
+    app.state._send_task = _asyncio.create_task(
+        _send_runner(app.state.pool, stop_evt, _WAKE), name="ogma-send-queue"
+    )
+
+
+async def stop_send_queue(app) -> None:
+    global _WAKE
+    stop_evt = getattr(app.state, "_send_stop_evt", None)
+    task = getattr(app.state, "_send_task", None)
+    if stop_evt:
+        stop_evt.set()
+    if _WAKE is not None:
+        _WAKE.set()
+    if task:
+        with contextlib.suppress(BaseException):
+            await _asyncio.wait_for(task, 10)
+    _WAKE = None
 
 
 @router.post("/me/send")
@@ -191,7 +519,11 @@ async def me_send(req: Request, body: SendReq, background: BackgroundTasks):
 
     meta = await _resolve_track_meta(pool, body)
 
-    # запускаем в фоне, чтобы не держать HTTP
-    background.add_task(_send_track_to_user, pool, int(user_id), meta)
+    # ставим в очередь, чтобы не держать HTTP; без миграции 013 — по-старому, в этом процессе
+    try:
+        job_id = await _enqueue_send(pool, int(user_id), meta)
+    except asyncpg.UndefinedTableError:
+        background.add_task(_send_track_to_user, pool, int(user_id), meta)
+        return {"ok": True}
 
-    return {"ok": True}
\ No newline at end of file
+    return {"ok": True, "job_id": job_id}
@@ -3,9 +3,12 @@
 from __future__ import annotations
 
 import os
+import hmac as _hmac
 import asyncio as _asyncio
 import logging
-from typing import AsyncGenerator, Optional, Tuple, List
+from collections import OrderedDict, deque
+from dataclasses import replace as _dc_replace
+from typing import AsyncGenerator, Deque, Optional, Tuple, List
 
 from fastapi import APIRouter, HTTPException, Request, Response
 from fastapi import Query
@@ -13,7 +16,7 @@ from fastapi.responses import StreamingResponse
 
 from telethon import TelegramClient
 from telethon.sessions import StringSession
-from telethon.tl.types import InputDocumentFileLocation, Document
+from telethon.tl.types import Document
 from telethon.tl.functions.upload import GetFileRequest as _GetFileRequestOrig
 from telethon.tl.functions.channels import JoinChannelRequest
 from telethon.errors.rpcerrorlist import UserAlreadyParticipantError
@@ -41,6 +44,15 @@ except Exception:
     except Exception:
         _RPCError = Exception  # type: ignore
 
+try:
+    from telethon.errors import FileReferenceExpiredError  # type: ignore
+except Exception:
+    try:
+        from telethon.errors.rpcerrorlist import FileReferenceExpiredError  # type: ignore
+    except Exception:  # fallback stub
+        class FileReferenceExpiredError(Exception):  # type: ignore
+            pass
+
 from contextlib import suppress
 import asyncpg
 
@@ -57,8 +69,78 @@ except Exception:
     STREAM_START_TOTAL = STREAM_BYTES_TOTAL = DOWNLOAD_START_TOTAL = None  # type: ignore
     TG_FLOODWAITS_TOTAL = TG_RPC_ERRORS_TOTAL = None  # type: ignore
 
+try:
+    from app.api.telemetry.metrics import mark_stream_chunk, add_stream_pace_wait
+except Exception:
+    def mark_stream_chunk(source: str) -> None:  # type: ignore
+        pass
+
+    def add_stream_pace_wait(seconds: float) -> None:  # type: ignore
+        pass
+
 from app.api.telemetry.eventlog import EventLog
 from app.api.auth_shared import resolve_user_id
+from app.api.tgstream.locations import (
+    DocLocation,
+    location_from_document,
+    location_from_row,
+    persist_location,
+    cache as _loc_cache,
+)
+from app.api.tgstream.blockcache import BlockFile, default_cache as _block_cache
+from app.api.tgstream.singleflight import default_flights as _flights
+from app.api.tgstream.cachemgr import default_manager as _cache_mgr
+from app.api.tgstream.filesend import cached_file_response
+from app.api.tgstream.chunking import ramp_pieces
+from app.api.tgstream.scheduler import (
+    BULK as PRIO_BULK,
+    SEEK as PRIO_SEEK,
+    STREAM as PRIO_STREAM,
+    Priority,
+    Ticket,
+    default_scheduler as _sched,
+)
+from app.api.tgstream.clientpool import ClientPool, start_health_checks
+from app.api.tgstream.cdn import ENABLED as _CDN_ENABLED, default_cdn
+from app.api.tgstream.fetcher import FetcherError, default_client as _fetcher_client
+from app.api.tgstream.peers import (
+    LOC_HEADER as _PEER_LOC_HEADER,
+    TOKEN_HEADER as _PEER_TOKEN_HEADER,
+    PeerUnavailable,
+    decode_loc,
+    default_peers as _peers,
+)
+from app.api.tgstream.prefetch import default_prefetcher as _prefetcher
+from app.api.tgstream.intros import MAX_BYTES as _INTRO_MAX, load_intro as _load_intro
+from app.api.tgstream.memcache import default_memcache as _mem_cache
+from app.api.tgstream.pacing import PlaybackPacer
+from app.api.tgstream.seekindex import (
+    ENABLED as _SEEK_ENABLED,
+    MOOV_MAX_BYTES as _MOOV_MAX_BYTES,
+    MP4_MIMES as _MP4_MIMES,
+    SeekIndex,
+    find_frame,
+    find_moov,
+    id3_end,
+    load_index as _load_seek_index,
+    mp3_index,
+    mp4_index,
+    mp4_moov_location,
+    save_index as _save_seek_index,
+    seek_kind,
+)
+from app.api.tgstream.segmented import (
+    MIN_BYTES as _SEGMENT_MIN_BYTES,
+    SEGMENTS as _SEGMENTS,
+    segmented_blocks,
+)
+from app.api.tgstream.conditional import (
+    etag_for,
+    http_date,
+    not_modified,
+    range_allowed,
+    validator_headers,
+)
 
 # Логгер модуля
 log = logging.getLogger("app.tgstream")
@@ -107,7 +189,17 @@ router = APIRouter()
 _TG: Optional[TelegramClient] = None
 _TG_LOCK = _asyncio.Lock()
 
+# Пул сессий для GetFile: основная _TG + дополнительные из TG_POOL_SESSIONS
+# (через запятую: StringSession или путь к .session-файлу)
+_POOL: Optional[ClientPool] = None
+_POOL_LOCK = _asyncio.Lock()
+_POOL_STOP = None
+
+# TG_FETCHER_SOCKET: своей сессии у воркера нет, Telegram — через общий демон (fetcherd)
+_FETCHER = _fetcher_client()
+
 CHUNK = 512 * 1024  # 512 KiB
+READ_AHEAD = int(os.environ.get("TG_READ_AHEAD", "4"))  # сколько GetFile держим в полёте на поток
 _RETRIES = 3
 _BACKOFF_BASE = 0.5  # seconds
 
@@ -171,8 +263,50 @@ async def _ensure_tg():
                 _IS_BOT = False
 
 
+async def _ensure_pool() -> ClientPool:
+    """Пул клиентов для скачивания. Без TG_POOL_SESSIONS в нём одна основная сессия."""
+    global _POOL, _POOL_STOP
+    await _ensure_tg()
+    if _POOL is not None:
+        return _POOL
+    async with _POOL_LOCK:
+        if _POOL is not None:
+            return _POOL
+        # CDN-DC для ботов закрыты — им Telegram отдаёт файлы только с основного DC
+        pool = ClientPool(cdn=default_cdn() if _CDN_ENABLED and not _IS_BOT else None)
+        pool.add(_TG, "main", owned=False)
+        api_id = int(os.environ["TELEGRAM_API_ID"])
+        api_hash = os.environ["TELEGRAM_API_HASH"]
+        raw = [x.strip() for x in (os.environ.get("TG_POOL_SESSIONS", "") or "").split(",") if x.strip()]
+        for i, spec in enumerate(raw, 1):
+            if "/" in spec or spec.endswith(".session"):
+                sess = os.path.expanduser(spec[:-8] if spec.endswith(".session") else spec)
+            else:
+                sess = StringSession(spec)
+            client = TelegramClient(sess, api_id, api_hash)
+            try:
+                await client.connect()
+                if not await client.is_user_authorized():
+                    log.error("tg pool: session #%d is not authorized, skipped", i)
+                    await client.disconnect()
+                    continue
+            except Exception as e:
+                log.error("tg pool: session #%d failed to connect: %r", i, e)
+                continue
+            pool.add(client, f"pool{i}")
+        _POOL_STOP = start_health_checks(pool)
+        log.info("tg pool ready: %d session(s)", len(pool))
+        _POOL = pool
+        return _POOL
+
+
 async def _ensure_join(chat_username: str):
     """Для пользователя пробуем JoinChannel. Для бота — ничего (бот должен быть добавлен вручную)."""
+    if _FETCHER is not None:
+        try:
+            return await _FETCHER.join(chat_username)
+        except FetcherError as e:
+            raise HTTPException(e.status, e.detail)
     await _ensure_tg()
     assert _TG is not None
     if _IS_BOT:
@@ -180,15 +314,16 @@ async def _ensure_join(chat_username: str):
 
     for attempt in range(_RETRIES):
         try:
-            await _TG(JoinChannelRequest(chat_username))
+            await _sched().call(lambda: _TG(JoinChannelRequest(chat_username)), PRIO_STREAM, op="JoinChannel")
             return
         except UserAlreadyParticipantError:
             return
-        except FloodWaitError as e:
+        except FloodWaitError:
+            # планировщик уже выждал общий FloodWait и исчерпал повторы
             if TG_FLOODWAITS_TOTAL:
                 with suppress(Exception):
                     TG_FLOODWAITS_TOTAL.labels(op="JoinChannel").inc()
-            await _asyncio.sleep(getattr(e, "seconds", 3))
+            return
         except _RPCError as e:
             if "BOT_METHOD_INVALID" in str(e):  # на всякий случай
                 return
@@ -211,7 +346,13 @@ async def _db_get_track(pool: asyncpg.Pool, track_id: str) -> dict:
            title,
            artists,
            mime,
-           size_bytes
+           size_bytes,
+           duration_s,
+           tg_document_id,
+           tg_access_hash,
+           tg_file_ref,
+           tg_dc_id,
+           created_at
       from tracks
      where id = $1::uuid
      limit 1;
@@ -222,12 +363,26 @@ async def _db_get_track(pool: asyncpg.Pool, track_id: str) -> dict:
     return dict(row)
 
 
-async def _get_document(chat_username: str, msg_id: int) -> Document:
+async def _db_get_track_by_msg(pool: asyncpg.Pool, chat_username: str, msg_id: int) -> Optional[dict]:
+    row = await pool.fetchrow(
+        """
+        select size_bytes, mime, tg_document_id, created_at
+          from tracks
+         where chat_username = $1 and tg_msg_id = $2
+         limit 1;
+        """,
+        chat_username,
+        int(msg_id),
+    )
+    return dict(row) if row else None
+
+
+async def _get_document(chat_username: str, msg_id: int, priority: int = PRIO_STREAM) -> Document:
     await _ensure_tg()
     assert _TG is not None
     for attempt in range(_RETRIES):
         try:
-            msg = await _TG.get_messages(chat_username, ids=msg_id)
+            msg = await _sched().call(lambda: _TG.get_messages(chat_username, ids=msg_id), priority, op="get_messages")
             if not msg or not msg.document:
                 raise HTTPException(404, "Message or document not found in Telegram")
             return msg.document
@@ -235,7 +390,7 @@ async def _get_document(chat_username: str, msg_id: int) -> Document:
             if TG_FLOODWAITS_TOTAL:
                 with suppress(Exception):
                     TG_FLOODWAITS_TOTAL.labels(op="get_messages").inc()
-            await _asyncio.sleep(getattr(e, "seconds", 3))
+            raise HTTPException(429, f"Telegram rate limit, wait {getattr(e, 'seconds', 3)}s")
         except _RPCError as e:
             if TG_RPC_ERRORS_TOTAL:
                 with suppress(Exception):
@@ -248,6 +403,93 @@ async def _get_document(chat_username: str, msg_id: int) -> Document:
     raise HTTPException(502, "Telegram upstream unavailable")
 
 
+async def _fetch_location(
+    chat_username: str, msg_id: int, priority: int = PRIO_STREAM, fresh: bool = True
+) -> DocLocation:
+    """Расположение документа из Telegram: своей сессией или через демон-фетчер.
+    fresh=False позволяет демону ответить из своего кеша расположений."""
+    if _FETCHER is not None:
+        try:
+            return await _FETCHER.locate(chat_username, int(msg_id), priority, fresh=fresh)
+        except FetcherError as e:
+            raise HTTPException(e.status, e.detail)
+    doc = await _get_document(chat_username, int(msg_id), priority)
+    return location_from_document(chat_username, int(msg_id), doc)
+
+
+async def _get_location(
+    pool: Optional[asyncpg.Pool],
+    chat_username: str,
+    msg_id: int,
+    row: Optional[dict] = None,
+) -> DocLocation:
+    """LRU → tg_* колонки tracks → get_messages. Telegram трогаем только при полном промахе."""
+    key = (chat_username, int(msg_id))
+    loc = _loc_cache().get(key)
+    if loc is not None:
+        return _with_row_duration(loc, row)
+
+    if row is not None:
+        loc = location_from_row(row)
+        if loc is not None:
+            _loc_cache().put(loc)
+            return loc
+
+    loc = await _fetch_location(chat_username, int(msg_id), fresh=False)
+    loc = _with_row_duration(loc, row)
+    _loc_cache().put(loc)
+    if pool is not None:
+        _asyncio.create_task(persist_location(pool, loc))
+    return loc
+
+
+def _with_row_duration(loc: DocLocation, row: Optional[dict]) -> DocLocation:
+    """В LRU могла попасть запись без длительности (строка без duration_s, документ без
+    DocumentAttributeAudio) — берём её из tracks, иначе темп и индекс MP3 останутся без неё."""
+    duration = int((row or {}).get("duration_s") or 0)
+    if loc.duration_s or not duration:
+        return loc
+    loc = _dc_replace(loc, duration_s=duration)
+    _loc_cache().put(loc)
+    return loc
+
+
+async def _refresh_location(pool: Optional[asyncpg.Pool], loc: DocLocation) -> DocLocation:
+    """Вызывается на FILE_REFERENCE_EXPIRED: перечитываем сообщение и обновляем кеш + БД."""
+    _loc_cache().invalidate(loc.key)
+    fresh = await _fetch_location(loc.chat_username, loc.msg_id)
+    _loc_cache().put(fresh)
+    if pool is not None:
+        _asyncio.create_task(persist_location(pool, fresh))
+    return fresh
+
+
+async def _track_location(pool: asyncpg.Pool, t: dict) -> Tuple[DocLocation, int, str]:
+    """Расположение + размер + mime для строки tracks без лишних походов в Telegram."""
+    loc = await _get_location(pool, t["chat_username"], t["tg_msg_id"], t)
+    size = int(loc.size or t.get("size_bytes") or 0)
+    if size <= 0:
+        loc = _with_row_duration(await _refresh_location(pool, loc), t)
+        size = int(loc.size or 0)
+    if size <= 0:
+        raise HTTPException(500, "Unknown file size")
+    mime = t.get("mime") or loc.mime or "application/octet-stream"
+    return loc, size, mime
+
+
+async def _track_meta(pool: asyncpg.Pool, t: dict) -> Tuple[int, str, Optional[int]]:
+    """Размер, mime и id документа для HEAD/пробинга — из tracks и кеша расположений.
+    В Telegram идём, только если размер нигде не известен."""
+    cached = _loc_cache().get((t["chat_username"], int(t["tg_msg_id"])))
+    size = int(t.get("size_bytes") or (cached.size if cached else 0) or 0)
+    mime = t.get("mime") or (cached.mime if cached else None)
+    doc_id = t.get("tg_document_id") or (cached.doc_id if cached else None)
+    if size <= 0:
+        loc, size, mime = await _track_location(pool, t)
+        doc_id = loc.doc_id
+    return size, mime or "application/octet-stream", (int(doc_id) if doc_id else None)
+
+
 def _parse_range(range_header: Optional[str], size: int) -> Tuple[int, int, bool]:
     if not range_header or not range_header.startswith("bytes="):
         return 0, size - 1, False
@@ -285,76 +527,534 @@ def _parse_range(range_header: Optional[str], size: int) -> Tuple[int, int, bool
     return start, end, True
 
 
-async def _tg_byte_iter(doc: Document, start: int, end: int) -> AsyncGenerator[bytes, None]:
-    await _ensure_tg()
-    assert _TG is not None
+def _validators(doc_id: int, size: int, created_at=None, start: int = 0) -> Tuple[str, Optional[str]]:
+    # ETag из id документа и размера: одинаковый во всех воркерах, меняется вместе с файлом
+    return etag_for(doc_id, size, start), http_date(created_at)
 
-    loc = InputDocumentFileLocation(
-        id=doc.id,
-        access_hash=doc.access_hash,
-        file_reference=doc.file_reference,
-        thumb_size="",
-    )
 
-    base = start - (start % CHUNK)
-    offset = base
-    to_send = end - start + 1
-    first = True
+def _not_modified(etag: str, last_mod: Optional[str], immutable: bool, max_age: int = 0) -> Response:
+    return Response(status_code=304, headers=validator_headers(etag, last_mod, immutable, max_age))
 
-    while to_send > 0:
-        last_exc = None
-        for attempt in range(_RETRIES):
-            try:
-                resp = await _TG(
+
+class _LocRef:
+    """Общее расположение документа для всех параллельных чанков одного потока.
+    При FILE_REFERENCE_EXPIRED освежается один раз, остальные чанки подхватывают новое."""
+
+    def __init__(self, loc: DocLocation, pool: Optional[asyncpg.Pool] = None):
+        self.loc = loc
+        self.pool = pool
+        self._lock = _asyncio.Lock()
+
+    async def refresh(self, stale: DocLocation) -> DocLocation:
+        async with self._lock:
+            if self.loc is stale:
+                self.loc = await _refresh_location(self.pool, stale)
+        return self.loc
+
+
+async def _fetch_chunk(ref: _LocRef, offset: int, limit: int = CHUNK, priority: Priority = PRIO_STREAM) -> bytes:
+    """Один GetFile через общий планировщик, с ретраями (RPC / сеть / протухший
+    file_reference). FloodWait выжидает сам планировщик — сюда он долетает, только
+    если ждать дольше нельзя, и уходит наверх (429)."""
+    clients = await _ensure_pool()
+    assert _TG is not None
+
+    last_exc: Optional[BaseException] = None
+    for attempt in range(_RETRIES):
+        used = ref.loc
+        try:
+            # пул выбирает сессию по dc_id документа и нагрузке
+            resp = await _sched().call(
+                lambda: clients.call(
                     GetFileRequest(
-                        location=loc,
+                        location=used.input_location(),
                         offset=offset,
-                        limit=CHUNK,
+                        limit=limit,
                         precise=True,
-                        cdn_supported=True,
-                    )
-                )
-                orig = getattr(resp, "bytes", b"")
-                if not orig:
-                    return
-                buf = orig
-
-                if first and start > base:
-                    cut = start - base
-                    buf = buf[cut:] if cut < len(buf) else b""
-                    first = False
-
-                if len(buf) > to_send:
-                    buf = buf[:to_send]
-
-                if buf:
-                    yield buf
-                    to_send -= len(buf)
-
-                offset += len(orig)
+                        cdn_supported=clients.cdn is not None,
+                    ),
+                    dc_id=used.dc_id or None,
+                ),
+                priority,
+                op="GetFile",
+            )
+            return bytes(getattr(resp, "bytes", b"") or b"")
+        except FileReferenceExpiredError as e:
+            # file_reference протух — освежаем и повторяем тот же offset
+            last_exc = e
+            await ref.refresh(used)
+        except FloodWaitError:
+            if TG_FLOODWAITS_TOTAL:
+                with suppress(Exception):
+                    TG_FLOODWAITS_TOTAL.labels(op="GetFile").inc()
+            raise
+        except _RPCError as e:
+            last_exc = e
+            if TG_RPC_ERRORS_TOTAL:
+                with suppress(Exception):
+                    TG_RPC_ERRORS_TOTAL.labels(op="GetFile").inc()
+            await _TG.connect()
+            await _asyncio.sleep(_BACKOFF_BASE * (2 ** attempt))
+        except (ConnectionError, OSError) as e:
+            last_exc = e
+            await _TG.connect()
+            await _asyncio.sleep(_BACKOFF_BASE * (2 ** attempt))
+    if last_exc:
+        raise last_exc
+    return b""
+
+
+def _read_cached(bf: BlockFile, idx: int) -> Optional[bytes]:
+    try:
+        return bf.read_block(idx)
+    except OSError:
+        return None
+
+
+async def _cached_block(bf: Optional[BlockFile], idx: int) -> Optional[bytes]:
+    # чтение с диска — в пуле потоков: медленный диск не должен стопорить весь воркер
+    if bf is None:
+        return None
+    return await _asyncio.to_thread(_read_cached, bf, idx)
+
+
+async def _fetch_block_through(
+    ref: _LocRef, bf: Optional[BlockFile], offset: int, priority: Priority = PRIO_STREAM
+) -> bytes:
+    idx = offset // CHUNK
+    if bf is not None:
+        # блок мог докачать соседний запрос, пока мы ждали своей очереди
+        await _asyncio.to_thread(bf.reload)
+        data = await _cached_block(bf, idx)
+        if data is not None:
+            return data
+
+    data = await _fetch_chunk(ref, offset, priority=priority)
+    if bf is not None and data:
+        try:
+            await _asyncio.to_thread(bf.write_block, idx, data)
+        except OSError as e:
+            log.warning("block cache write failed doc=%s block=%s: %r", bf.key, idx, e)
+    return data
+
+
+def _mem_offer(loc: DocLocation, offset: int, data: bytes) -> None:
+    # в память — только целые блоки (или хвост файла), как и на диск
+    if data and (len(data) == CHUNK or offset + len(data) == loc.size):
+        _mem_cache().offer((int(loc.doc_id), offset // CHUNK), data)
+
+
+async def _load_block(
+    ref: _LocRef, bf: Optional[BlockFile], offset: int, priority: int = PRIO_STREAM, owner: Optional[str] = None
+) -> bytes:
+    """Блок из памяти или дискового кеша, а при промахе — из Telegram со сквозной записью в кеш.
+    Одновременные промахи по одному (документ, offset) делят один GetFile.
+    owner — узел-владелец документа: блок берётся у него, Telegram — только если он недоступен."""
+    key = (ref.loc.doc_id, offset)
+    data = _mem_cache().get((int(ref.loc.doc_id), offset // CHUNK))
+    if data is not None:
+        mark_stream_chunk("memory")
+        return data
+
+    if owner is not None:
+        try:
+            data = await _flights().do(key, lambda: _peers().fetch_block(owner, ref.loc, offset, priority))
+            mark_stream_chunk("peer")
+            _mem_offer(ref.loc, offset, data)
+            return data
+        except PeerUnavailable as e:
+            log.warning("peer block failed doc=%s offset=%s: %s; going to Telegram", ref.loc.doc_id, offset, e)
+
+    data = await _cached_block(bf, offset // CHUNK)
+    if bf is not None:
+        _cache_mgr().record(bf.data_path, hit=data is not None)
+    if data is not None:
+        mark_stream_chunk("disk")
+        _mem_offer(ref.loc, offset, data)
+        return data
+
+    shared = _flights().in_flight(key)
+    ticket = Ticket(priority)
+    data = await _flights().do(key, lambda: _fetch_block_through(ref, bf, offset, ticket), ticket)
+    mark_stream_chunk("shared" if shared else "telegram")
+    _mem_offer(ref.loc, offset, data)
+    return data
+
+
+async def _load_piece(ref: _LocRef, offset: int, limit: int, priority: int = PRIO_SEEK) -> bytes:
+    """Короткий GetFile у точки seek. В блочный кеш не пишется — там только целые блоки."""
+    key = (ref.loc.doc_id, offset, limit)
+    ticket = Ticket(priority)
+    data = await _flights().do(key, lambda: _fetch_chunk(ref, offset, limit, ticket), ticket)
+    mark_stream_chunk("telegram")
+    return data
+
+
+def _forget_task(task: _asyncio.Task) -> None:
+    # забираем исключение у брошенного read-ahead таска, чтобы asyncio не ругался в лог
+    if not task.cancelled():
+        task.exception()
+
+
+async def _tg_byte_iter(
+    doc_loc: DocLocation,
+    start: int,
+    end: int,
+    pool: Optional[asyncpg.Pool] = None,
+    priority: int = PRIO_STREAM,
+    peers: bool = True,
+) -> AsyncGenerator[bytes, None]:
+    """Отдаёт байты [start, end] документа, держа в полёте до READ_AHEAD запросов GetFile.
+
+    Блоки, уже лежащие в дисковом кеше, читаются оттуда; недостающие тянутся из Telegram
+    и сразу дописываются в кеш, так что любой Range постепенно прогревает трек.
+
+    Seek внутрь незакешированного блока начинается с коротких запросов (ramp_pieces),
+    чтобы первый байт пришёл быстро; дальше — целые блоки по CHUNK.
+    priority — класс в планировщике MTProto (стрим / скачивание / прогрев).
+
+    Ответы выдаются строго по порядку offset'ов. Новые запросы ставятся только после того,
+    как клиент забрал очередной чанк, поэтому медленный клиент сам ограничивает окно.
+    При отключении клиента (aclose/cancel генератора) висящие запросы отменяются.
+
+    При STREAM_NODES блоки чужого документа берутся у узла-владельца и локально не кешируются;
+    peers=False — запрос пришёл от соседа, отвечаем сами.
+
+    Если начало диапазона не в кеше, но есть в интро-сторе (track_intros), оно уходит клиенту
+    сразу, пока первые блоки качаются параллельно.
+
+    Большие скачивания (priority=bulk) идут сегментами: несколько отрезков файла качаются
+    параллельно прямо в блочный кеш, а клиенту байты уходят по порядку (_segmented_byte_iter).
+
+    Проигрывание (priority=stream) при известной длительности идёт в темпе звука: блок,
+    которого нет в памяти/на диске, запрашивается не раньше, чем он окажется в пределах
+    STREAM_PACE_AHEAD_S секунд от позиции слушателя (PlaybackPacer).
+
+    С TG_FETCHER_SOCKET всё это делает демон, а воркер только читает поток из сокета.
+    """
+    if _FETCHER is not None:
+        remote = _FETCHER.read(doc_loc, start, end, priority, peers)
+        try:
+            async for chunk in remote:
+                yield chunk
+        except FetcherError as e:
+            raise HTTPException(e.status, e.detail)
+        finally:
+            await remote.aclose()  # рвём соединение — демон перестаёт качать
+        return
+
+    owner: Optional[str] = None
+    if peers:
+        shard = _peers()
+        shard.ensure_checks()
+        owner = shard.owner_for(doc_loc.doc_id)
+
+    ref = _LocRef(doc_loc, pool)
+    bf: Optional[BlockFile] = None
+    if doc_loc.size > 0 and owner is None:
+        bf = _block_cache().open(str(doc_loc.doc_id), doc_loc.size)
+        if bf is not None:
+            await _asyncio.to_thread(bf.reload)
+
+    if priority == PRIO_BULK and bf is not None and _SEGMENTS > 1 and end - start + 1 >= _SEGMENT_MIN_BYTES:
+        async for chunk in _segmented_byte_iter(ref, bf, start, end, priority):
+            yield chunk
+        return
+
+    window = max(1, READ_AHEAD)
+    pending: Deque[Tuple[int, int, _asyncio.Task]] = deque()
+    next_offset = start - (start % CHUNK)
+    pos = start  # следующий байт, который должен уйти клиенту
+
+    pacer: Optional[PlaybackPacer] = None
+    if priority == PRIO_STREAM:
+        pacer = PlaybackPacer.for_track(doc_loc.size, doc_loc.duration_s, min_ahead=window * CHUNK)
+
+    def _local(off: int) -> bool:
+        idx = off // CHUNK
+        return (bf is not None and bf.has(idx)) or (int(doc_loc.doc_id), idx) in _mem_cache()
+
+    # первый блок нигде не лежит — старт пойдёт из интро или через короткие запросы
+    cold = (bf is None or not bf.has(start // CHUNK)) and (int(doc_loc.doc_id), start // CHUNK) not in _mem_cache()
+
+    intro_task: Optional[_asyncio.Task] = None
+    if start < _INTRO_MAX and cold:
+        intro_task = _asyncio.create_task(_load_intro(pool, doc_loc.doc_id))
+
+    intro: Optional[bytes] = None
+    ramp: Deque[Tuple[int, int]] = deque()
+    pieces = ramp_pieces(start, end, CHUNK) if owner is None and cold else []
+    if pieces and intro_task is not None:
+        # seek внутрь интро: интро у большинства треков ещё нет — выясняем до первого GetFile,
+        # иначе без него начало пошло бы целым блоком вместо коротких запросов
+        intro = await intro_task
+        intro_task = None
+        if intro and start < len(intro):
+            pieces = []
+    if pieces:
+        ramp.extend(pieces)
+        next_offset += CHUNK  # голову блока добирают короткие запросы
+
+    def _schedule() -> None:
+        nonlocal next_offset
+        while len(pending) < window:
+            if ramp:
+                off, limit = ramp.popleft()
+                task = _asyncio.create_task(_load_piece(ref, off, limit, max(priority, PRIO_SEEK)))
+            elif next_offset <= end:
+                if pacer is not None and not pacer.allows(next_offset - start, pos - start) and not _local(next_offset):
+                    break  # слушатель ещё далеко — Telegram подождёт
+                off, limit = next_offset, CHUNK
+                task = _asyncio.create_task(_load_block(ref, bf, off, priority, owner))
+                next_offset += CHUNK
+            else:
                 break
-            except FloodWaitError as e:
-                last_exc = e
-                if TG_FLOODWAITS_TOTAL:
-                    with suppress(Exception):
-                        TG_FLOODWAITS_TOTAL.labels(op="GetFile").inc()
-                await _TG.connect()
-                await _asyncio.sleep(getattr(e, "seconds", 3))
-            except _RPCError as e:
-                last_exc = e
-                if TG_RPC_ERRORS_TOTAL:
-                    with suppress(Exception):
-                        TG_RPC_ERRORS_TOTAL.labels(op="GetFile").inc()
-                await _TG.connect()
-                await _asyncio.sleep(_BACKOFF_BASE * (2 ** attempt))
-            except (ConnectionError, OSError) as e:
-                last_exc = e
-                await _TG.connect()
-                await _asyncio.sleep(_BACKOFF_BASE * (2 ** attempt))
-        else:
-            if last_exc:
-                raise last_exc
-            return
+            pending.append((off, limit, task))
+
+    try:
+        _schedule()
+        if intro_task is not None:
+            intro = await intro_task
+            intro_task = None
+        if intro and start < len(intro):
+            # хвост блока, уже отданный из интро, срежет общий код ниже по pos
+            buf = intro[start : min(end + 1, len(intro))]
+            mark_stream_chunk("intro")
+            if pacer is not None:
+                pacer.started()
+            yield buf
+            pos += len(buf)
+            if pos > end:
+                return
+        while pending or next_offset <= end:
+            if not pending:
+                # всё докачанное отдано, следующий блок за окном темпа — ждём, пока слушатель догонит
+                assert pacer is not None
+                wait = max(0.05, min(1.0, pacer.delay(next_offset - start, pos - start)))
+                add_stream_pace_wait(wait)
+                await _asyncio.sleep(wait)
+                _schedule()
+                continue
+            offset, limit, task = pending.popleft()
+            orig = await task
+            if not orig:
+                return
+
+            buf = orig
+            if pos > offset:
+                cut = pos - offset
+                buf = buf[cut:] if cut < len(buf) else b""
+            if len(buf) > end - pos + 1:
+                buf = buf[: end - pos + 1]
+
+            if buf:
+                if pacer is not None:
+                    pacer.started()
+                yield buf
+                pos += len(buf)
+
+            # короткий ответ = конец файла; остальное окно уже не нужно
+            if len(orig) < limit or pos > end:
+                return
+            _schedule()
+    finally:
+        if intro_task is not None:
+            intro_task.cancel()
+            intro_task.add_done_callback(_forget_task)
+        for _, _, task in pending:
+            task.cancel()
+            task.add_done_callback(_forget_task)
+        pending.clear()
+
+
+def _memory_response(
+    loc: DocLocation, start: int, end: int, status_code: int, mime: str, headers: dict
+) -> Optional[Response]:
+    mem = _mem_cache()
+    if not mem.enabled:
+        return None
+    first, last = start // CHUNK, end // CHUNK
+    doc = int(loc.doc_id)
+    if any((doc, i) not in mem for i in range(first, last + 1)):
+        return None
+    views: List[memoryview] = []
+    for i in range(first, last + 1):
+        block = mem.get((doc, i))
+        if block is None:
+            return None
+        lo = start - i * CHUNK if i == first else 0
+        hi = end - i * CHUNK + 1 if i == last else len(block)
+        views.append(memoryview(block)[lo:hi])  # срез без копии
+    mark_stream_chunk("memory")
+    if len(views) == 1:
+        return Response(content=views[0], status_code=status_code, headers=headers, media_type=mime)
+
+    async def body():
+        for v in views:
+            yield v
+
+    return StreamingResponse(
+        body(),
+        status_code=status_code,
+        media_type=mime,
+        headers={**headers, "Content-Length": str(end - start + 1)},
+    )
+
+
+async def _segmented_byte_iter(
+    ref: _LocRef, bf: BlockFile, start: int, end: int, priority: int = PRIO_BULK
+) -> AsyncGenerator[bytes, None]:
+    """Байты [start, end] по порядку, пока сегменты файла качаются параллельно в кеш.
+    Ошибка блока повторяется только для него, а не перезапуском всего файла."""
+
+    async def load(idx: int) -> bytes:
+        return await _load_block(ref, bf, idx * CHUNK, priority)
+
+    pos = start
+    blocks = segmented_blocks(
+        load,
+        lambda idx: _cached_block(bf, idx),
+        start // CHUNK,
+        end // CHUNK,
+        bf.block_len,
+        cached=bf.has,
+        fatal=(FloodWaitError, HTTPException),
+    )
+    try:
+        async for idx, data in blocks:
+            offset = idx * CHUNK
+            buf = data[pos - offset : end - offset + 1]
+            if buf:
+                yield buf
+                pos += len(buf)
+    finally:
+        await blocks.aclose()
+
+
+# --- индекс перемотки (seekindex) ---
+_SEEK_CACHE: "OrderedDict[int, Optional[SeekIndex]]" = OrderedDict()
+_SEEK_CACHE_MAX = 4096
+_SEEK_FRAME_WINDOW = 8 * 1024
+# ?t=, для которого индекса (пока) нет: отдали файл с начала — кешировать надолго нельзя,
+# иначе кеш спрячет правильный ответ, когда индекс появится
+_SEEK_FALLBACK_MAX_AGE = int(os.environ.get("STREAM_SEEK_FALLBACK_MAX_AGE", "60"))
+
+
+async def _read_range(pool: Optional[asyncpg.Pool], loc: DocLocation, start: int, end: int) -> bytes:
+    # мимо темпа и сегментов: интро, память, диск, иначе короткие запросы у точки seek
+    parts = [bytes(chunk) async for chunk in _tg_byte_iter(loc, start, end, pool, PRIO_SEEK)]
+    return b"".join(parts)
+
+
+async def _build_seek_index(pool: Optional[asyncpg.Pool], loc: DocLocation) -> Optional[SeekIndex]:
+    idx = await _load_seek_index(pool, loc.doc_id)
+    if idx is not None:
+        return idx
+    head = await _read_range(pool, loc, 0, min(loc.size, CHUNK) - 1)
+    kind = seek_kind(loc.mime, head)
+    if kind == "mp3":
+        idx = mp3_index(head, loc.size, loc.duration_s)
+        skip = id3_end(head)
+        if idx is None and len(head) <= skip < loc.size:
+            # обложка в ID3 больше блока — первый фрейм ищем сразу за тегом
+            after = await _read_range(pool, loc, skip, min(loc.size, skip + CHUNK) - 1)
+            idx = mp3_index(after, loc.size, loc.duration_s, base=skip)
+    elif kind == "mp4":
+        off, length = mp4_moov_location(head, loc.size)
+        if off is not None and length and off + length <= len(head):
+            idx = mp4_index(head[off : off + length], off)
+        elif off is not None:
+            # moov после mdat: читаем хвост — он же ляжет в блочный кеш к запросу плеера
+            end = off + length - 1 if length else loc.size - 1
+            if end - off + 1 <= _MOOV_MAX_BYTES:
+                tail = await _read_range(pool, loc, off, end)
+                found = find_moov(tail)
+                if found is not None:
+                    idx = mp4_index(tail[found[0] : found[0] + found[1]], off + found[0])
+    if idx is not None:
+        await _save_seek_index(pool, loc.doc_id, idx)
+    return idx
+
+
+async def _seek_index(pool: Optional[asyncpg.Pool], loc: DocLocation) -> Optional[SeekIndex]:
+    """Индекс документа: LRU процесса → track_seek_index → разбор начала/moov.
+    None — формат не поддержан или байты сейчас недоступны."""
+    if not _SEEK_ENABLED or loc.size <= 0:
+        return None
+    key = int(loc.doc_id)
+    if key in _SEEK_CACHE:
+        _SEEK_CACHE.move_to_end(key)
+        return _SEEK_CACHE[key]
+    try:
+        idx = await _flights().do(("seek", key), lambda: _build_seek_index(pool, loc))
+    except Exception as e:
+        log.warning("seek index failed doc=%s: %r", key, e)
+        return None  # ошибку Telegram не запоминаем — попробуем в следующий раз
+    _SEEK_CACHE[key] = idx
+    while len(_SEEK_CACHE) > _SEEK_CACHE_MAX:
+        _SEEK_CACHE.popitem(last=False)
+    return idx
+
+
+async def _seek_offset(pool: Optional[asyncpg.Pool], loc: DocLocation, idx: SeekIndex, t: float) -> Tuple[int, int]:
+    """(мс, байт) для момента t. У MP3 байт выровнен на начало фрейма рядом с точкой индекса."""
+    ms, off = idx.lookup(t)
+    if idx.kind != "mp3" or ms <= 0:
+        return ms, off
+    window = await _read_range(pool, loc, off, min(loc.size, off + _SEEK_FRAME_WINDOW) - 1)
+    pos = find_frame(window)
+    return ms, off + (pos or 0)
+
+
+async def _seek_base(
+    pool: Optional[asyncpg.Pool], loc: DocLocation, size: int, seek: Optional[float]
+) -> Tuple[Optional[int], int]:
+    """?t= → (мс, base): с какого байта начинается ответ. Только MP3, иначе (None, 0)."""
+    if seek is None:
+        return None, 0
+    idx = await _seek_index(pool, loc)
+    if idx is None or idx.kind != "mp3":
+        return None, 0
+    ms, base = await _seek_offset(pool, loc, idx, seek)
+    if base >= size:
+        return None, 0
+    return ms, base
+
+
+def _seek_caching(seek: Optional[float], base: int) -> dict:
+    """immutable — только если смещение ?t= дал индекс; иначе короткий max-age."""
+    if seek is None or base:
+        return {"immutable": True}
+    return {"immutable": False, "max_age": _SEEK_FALLBACK_MAX_AGE}
+
+
+def _disk_response(
+    loc: DocLocation, start: int, end: int, status_code: int, mime: str, headers: dict, offload: bool = True
+) -> Optional[Response]:
+    """Если весь диапазон уже в блочном кеше — ответ прямо из .blk (смещения совпадают
+    с документом): из пула потоков или через X-Accel-Redirect/X-Sendfile (STREAM_OFFLOAD).
+    Диапазон, целиком лежащий в памяти (_mem_cache), отдаётся оттуда без похода на диск.
+    Иначе None — идём через _tg_byte_iter."""
+    if loc.size <= 0:
+        return None
+    resp = _memory_response(loc, start, end, status_code, mime, headers)
+    if resp is not None:
+        return resp
+    bf = _block_cache().open(str(loc.doc_id), loc.size)
+    if bf is None or bf.missing(start // bf.block_size, end // bf.block_size):
+        return None
+    try:
+        resp = cached_file_response(
+            bf.data_path, start, end, status_code=status_code, headers=headers, media_type=mime, offload=offload
+        )
+    except OSError:
+        return None
+    if bf.missing(start // bf.block_size, end // bf.block_size):
+        # вытеснили, пока открывали файл
+        return None
+    _cache_mgr().record(bf.data_path, hit=True)
+    mark_stream_chunk("disk")
+    return resp
 
 
 # строгий резак диапазона (safety)
@@ -413,10 +1113,21 @@ async def _log_play(pool: asyncpg.Pool, user_id: int, track_id: str):
         pass
 
 
+def _note_played(uid: int, key) -> None:
+    # ушёл из плейлиста — префетч его следующих треков больше не нужен
+    prefetcher = _prefetcher()
+    if prefetcher is not None:
+        prefetcher.played(int(uid), key)
+
+
 # --- endpoints ---
 
 @router.get("/stream/{track_id}")
-async def stream_track(track_id: str, request: Request):
+async def stream_track(
+    track_id: str,
+    request: Request,
+    seek: Optional[float] = Query(None, alias="t", ge=0, description="старт с этой секунды (MP3)"),
+):
     pool: asyncpg.Pool = request.app.state.pool
     if not pool:
         raise HTTPException(503, "DB pool not ready")
@@ -425,15 +1136,30 @@ async def stream_track(track_id: str, request: Request):
     uid = _maybe_user_id(request)
     if uid:
         _asyncio.create_task(_log_play(pool, uid, t["id"]))
+        _note_played(uid, t["id"])
 
-    doc = await _get_document(t["chat_username"], t["tg_msg_id"])
-    size = int(getattr(doc, "size", 0) or t.get("size_bytes") or 0)
-    if size <= 0:
-        raise HTTPException(500, "Unknown file size")
-    mime = t.get("mime") or (getattr(doc, "mime_type", None) or "application/octet-stream")
+    loc, size, mime = await _track_location(pool, t)
+
+    # ?t= — ответ начинается с фрейма MP3 у этой секунды и для клиента это отдельный файл
+    # [base, size): Range и Content-Range считаются от base. MP4 внутри mdat не режется —
+    # отдаём целиком, плеер перемотает сам по moov.
+    seek_ms, base = await _seek_base(pool, loc, size, seek)
+    vsize = size - base
+
+    etag, last_mod = _validators(loc.doc_id, size, t.get("created_at"), base)
+    caching = _seek_caching(seek, base)
+    if not_modified(request.headers, etag, last_mod):
+        return _not_modified(etag, last_mod, **caching)
 
     r = request.headers.get("range")
-    start, end, partial = _parse_range(r, size)
+    if not range_allowed(request.headers, etag, last_mod):
+        r = None  # If-Range не совпал — отдаём файл целиком
+    vstart, vend, partial = _parse_range(r, vsize)
+    start, end = vstart + base, vend + base
+
+    if start == 0 and seek is None and (mime or "").lower() in _MP4_MIMES and int(loc.doc_id) not in _SEEK_CACHE:
+        # moov может лежать в конце — индекс заодно подтянет хвост в кеш до запроса плеера
+        _asyncio.create_task(_seek_index(pool, loc))
 
     ev: EventLog | None = getattr(request.app.state, "eventlog", None)
     chat_username = t["chat_username"]
@@ -453,7 +1179,7 @@ async def stream_track(track_id: str, request: Request):
     async def body():
         nonlocal total_sent
         try:
-            agen = _range_guard(start, end, _tg_byte_iter(doc, start, end))
+            agen = _range_guard(start, end, _tg_byte_iter(loc, start, end, pool))
             async for chunk in agen:
                 if chunk:
                     total_sent += len(chunk)
@@ -478,18 +1204,46 @@ async def stream_track(track_id: str, request: Request):
     headers = {
         "Accept-Ranges": "bytes",
         "X-Accel-Buffering": "no",
-        "Cache-Control": "no-transform",
-        "Content-Encoding": "identity",
+        **validator_headers(etag, last_mod, **caching),
     }
+    if base:
+        headers["X-Seek-Time"] = f"{(seek_ms or 0) / 1000:.3f}"
+    if partial:
+        headers["Content-Range"] = f"bytes {vstart}-{vend}/{vsize}"
+    # с ?t= nginx отсчитал бы Range от начала .blk, а не от base — такой ответ отдаём сами
+    disk = _disk_response(loc, start, end, 206 if partial else 200, mime, headers, offload=not base)
+    if disk is not None:
+        return disk
     if partial:
-        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
         headers["Content-Length"] = str(end - start + 1)
         return StreamingResponse(body(), status_code=206, media_type=mime, headers=headers)
     else:
-        headers["Content-Length"] = str(size)
+        headers["Content-Length"] = str(vsize)
         return StreamingResponse(body(), status_code=200, media_type=mime, headers=headers)
 
 
+@router.get("/stream/{track_id}/seek")
+async def stream_seek(track_id: str, request: Request, t: float = Query(..., ge=0)):
+    """Время → байт по индексу перемотки: для MP3 — начало фрейма, для MP4 — начало чанка."""
+    pool: asyncpg.Pool = request.app.state.pool
+    if not pool:
+        raise HTTPException(503, "DB pool not ready")
+    row = await _db_get_track(pool, track_id)
+    loc, size, _ = await _track_location(pool, row)
+    idx = await _seek_index(pool, loc)
+    if idx is None:
+        raise HTTPException(404, "No seek index for this track")
+    ms, offset = await _seek_offset(pool, loc, idx, t)
+    return {
+        "kind": idx.kind,
+        "duration": idx.duration_ms / 1000,
+        "t": ms / 1000,
+        "offset": offset,
+        "size": size,
+        "moov_offset": idx.moov_offset or None,
+    }
+
+
 @router.get("/download/{track_id}")
 async def download_track(track_id: str, request: Request):
     pool: asyncpg.Pool = request.app.state.pool
@@ -501,14 +1255,15 @@ async def download_track(track_id: str, request: Request):
     if uid:
         _asyncio.create_task(_log_play(pool, uid, t["id"]))
 
-    doc = await _get_document(t["chat_username"], t["tg_msg_id"])
-    size = int(getattr(doc, "size", 0) or t.get("size_bytes") or 0)
-    if size <= 0:
-        raise HTTPException(500, "Unknown file size")
-    mime = t.get("mime") or (getattr(doc, "mime_type", None) or "application/octet-stream")
+    loc, size, mime = await _track_location(pool, t)
     fname = _filename_from(t.get("title"), t.get("artists"), mime)
+    etag, last_mod = _validators(loc.doc_id, size, t.get("created_at"))
+    if not_modified(request.headers, etag, last_mod):
+        return _not_modified(etag, last_mod, immutable=True)
 
     r = request.headers.get("range")
+    if not range_allowed(request.headers, etag, last_mod):
+        r = None  # If-Range не совпал — отдаём файл целиком
     start, end, partial = _parse_range(r, size)
 
     ev: EventLog | None = getattr(request.app.state, "eventlog", None)
@@ -528,7 +1283,7 @@ async def download_track(track_id: str, request: Request):
 
     async def body():
         try:
-            agen = _range_guard(start, end, _tg_byte_iter(doc, start, end))
+            agen = _range_guard(start, end, _tg_byte_iter(loc, start, end, pool, PRIO_BULK))
             async for chunk in agen:
                 if chunk:
                     yield chunk
@@ -548,12 +1303,15 @@ async def download_track(track_id: str, request: Request):
     headers = {
         "Accept-Ranges": "bytes",
         "X-Accel-Buffering": "no",
-        "Cache-Control": "no-transform",
-        "Content-Encoding": "identity",
+        **validator_headers(etag, last_mod, immutable=True),
         "Content-Disposition": f'attachment; filename="{fname}"',
     }
     if partial:
         headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    disk = _disk_response(loc, start, end, 206 if partial else 200, mime, headers)
+    if disk is not None:
+        return disk
+    if partial:
         headers["Content-Length"] = str(end - start + 1)
         return StreamingResponse(body(), status_code=206, media_type=mime, headers=headers)
     else:
@@ -561,13 +1319,15 @@ async def download_track(track_id: str, request: Request):
         return StreamingResponse(body(), status_code=200, media_type=mime, headers=headers)
 
 
-# --- resilient full download (без Range) ---
+# --- resilient full download (без Range, сегментами) ---
 @router.get("/download2/{track_id}")
 async def download_track_resilient(track_id: str, request: Request):
-    async with request.app.state.pool.acquire() as con:
+    pool: asyncpg.Pool = request.app.state.pool
+    async with pool.acquire() as con:
         t = await con.fetchrow(
             """
-            select id::text, tg_msg_id, chat_username, title, artists, mime, size_bytes
+            select id::text, tg_msg_id, chat_username, title, artists, mime, size_bytes,
+                   tg_document_id, tg_access_hash, tg_file_ref, tg_dc_id, created_at
             from tracks where id=$1::uuid
         """,
             track_id,
@@ -575,12 +1335,13 @@ async def download_track_resilient(track_id: str, request: Request):
     if not t:
         raise HTTPException(404, "Track not found")
 
-    await _ensure_tg()
-    assert _TG is not None
-    doc = await _get_document(t["chat_username"], t["tg_msg_id"])
-    total = int(t["size_bytes"] or 0)
+    loc = await _get_location(pool, t["chat_username"], t["tg_msg_id"], dict(t))
+    total = int(t["size_bytes"] or loc.size or 0)
     if total <= 0:
         raise HTTPException(500, "Unknown file size")
+    etag, last_mod = _validators(loc.doc_id, total, t["created_at"])
+    if not_modified(request.headers, etag, last_mod):
+        return _not_modified(etag, last_mod, immutable=True)
 
     title = t["title"] or "track"
     artists = ", ".join(t["artists"] or [])
@@ -588,30 +1349,23 @@ async def download_track_resilient(track_id: str, request: Request):
     filename = f"{artists + ' - ' if artists else ''}{title}{ext}".strip().replace("/", "_")
 
     async def generator():
-        offset = 0
-        chunk = 512 * 1024
-        retries = 0
-        while offset < total:
-            try:
-                async for data in _TG.iter_download(doc, offset=offset, chunk_size=chunk, request_size=chunk):
-                    if not data:
-                        break
-                    offset += len(data)
+        # тот же путь, что у /download: сегменты качаются параллельно в блочный кеш,
+        # сбойный блок повторяется сам по себе, без перезапуска файла
+        try:
+            async for data in _range_guard(0, total - 1, _tg_byte_iter(loc, 0, total - 1, pool, PRIO_BULK)):
+                if data:
                     yield data
-                if offset >= total:
-                    break
-                raise RuntimeError("short read")
-            except Exception:
-                retries += 1
-                if retries > 5:
-                    raise
-                await _asyncio.sleep(0.5 * retries)
+        except FloodWaitError as e:
+            log.warning("TG FloodWait on download2 %s: %s", track_id, getattr(e, "seconds", None))
+            raise HTTPException(status_code=429, detail=f"Telegram rate limit, wait {getattr(e,'seconds',3)}s")
+        except _RPCError as e:
+            log.error("TG RPCError on download2 %s: %r", track_id, e)
+            raise HTTPException(status_code=502, detail=f"Telegram RPC error: {e.__class__.__name__}")
 
     headers = {
         "Accept-Ranges": "bytes",
         "X-Accel-Buffering": "no",
-        "Cache-Control": "no-transform",
-        "Content-Encoding": "identity",
+        **validator_headers(etag, last_mod, immutable=True),
         "Content-Disposition": f'attachment; filename="{filename}"',
         "Content-Type": t["mime"] or "application/octet-stream",
         "Content-Length": str(total),
@@ -620,35 +1374,58 @@ async def download_track_resilient(track_id: str, request: Request):
 
 
 @router.head("/stream/{track_id}")
-async def head_stream(track_id: str, request: Request):
+async def head_stream(
+    track_id: str,
+    request: Request,
+    seek: Optional[float] = Query(None, alias="t", ge=0, description="старт с этой секунды (MP3)"),
+):
     pool = request.app.state.pool
     if not pool:
         raise HTTPException(503, "DB pool not ready")
     t = await _db_get_track(pool, track_id)
 
-    uid = _maybe_user_id(request)
-    if uid:
-        _asyncio.create_task(_log_play(pool, uid, t["id"]))
-
-    doc = await _get_document(t["chat_username"], t["tg_msg_id"])
-    size = int(getattr(doc, "size", 0) or t.get("size_bytes") or 0)
-    if size <= 0:
-        raise HTTPException(500, "Unknown file size")
-    mime = t.get("mime") or (getattr(doc, "mime_type", None) or "application/octet-stream")
+    # HEAD — это проба плеера, а не прослушивание: в history не пишем,
+    # размер/mime берём из БД или кеша расположений без GetMessages
+    size, mime, doc_id = await _track_meta(pool, t)
+    # ?t= — тот же «отдельный файл» [base, size), что отдаст GET; индексу нужно расположение
+    seek_ms, base = None, 0
+    if seek is not None:
+        loc, size, mime = await _track_location(pool, t)
+        doc_id = int(loc.doc_id)
+        seek_ms, base = await _seek_base(pool, loc, size, seek)
 
     headers = {
         "Accept-Ranges": "bytes",
         "X-Accel-Buffering": "no",
         "Cache-Control": "no-transform",
-        "Content-Encoding": "identity",
-        "Content-Length": str(size),
+        "Content-Length": str(size - base),
         "Content-Type": mime,
     }
+    if base:
+        headers["X-Seek-Time"] = f"{(seek_ms or 0) / 1000:.3f}"
+    if doc_id:
+        etag, last_mod = _validators(doc_id, size, t.get("created_at"), base)
+        caching = _seek_caching(seek, base)
+        if not_modified(request.headers, etag, last_mod):
+            return _not_modified(etag, last_mod, **caching)
+        headers.update(validator_headers(etag, last_mod, **caching))
     return Response(status_code=200, headers=headers, media_type=mime)
 
 
 async def close_tg():
-    global _TG
+    global _TG, _POOL, _POOL_STOP
+    if _POOL_STOP is not None:
+        _POOL_STOP()
+        _POOL_STOP = None
+    if _POOL is not None:
+        for m in _POOL.members:
+            if m.client is not _TG:
+                with suppress(Exception):
+                    await m.client.disconnect()
+        if _POOL.cdn is not None:
+            await _POOL.cdn.close()
+        _POOL = None
+    await _peers().close()
     async with _TG_LOCK:
         if _TG is not None:
             with suppress(Exception):
@@ -656,6 +1433,79 @@ async def close_tg():
             _TG = None
 
 
+@router.get("/_peer/health", include_in_schema=False)
+async def peer_health():
+    return {"ok": True, "node": _peers().self_url}
+
+
+async def _peer_location(pool: Optional[asyncpg.Pool], doc_id: int, hint: str) -> Optional[DocLocation]:
+    """Расположение документа для /_peer/block — только из своих источников: кеш расположений,
+    tracks по tg_document_id, иначе сообщение (chat, msg_id) из подсказки соседа через Telegram.
+    access_hash, file_ref и size из заголовка не берём: размер уходит в блочный кеш."""
+    loc = _loc_cache().get_doc(doc_id)
+    if loc is not None:
+        return loc
+    if pool is not None:
+        row = await pool.fetchrow(
+            """
+            select chat_username, tg_msg_id, size_bytes, mime, duration_s,
+                   tg_document_id, tg_access_hash, tg_file_ref, tg_dc_id
+              from tracks
+             where tg_document_id = $1
+             limit 1
+            """,
+            int(doc_id),
+        )
+        if row is not None:
+            loc = location_from_row(dict(row))
+            if loc is not None:
+                _loc_cache().put(loc)
+                return loc
+    try:
+        claimed = decode_loc(hint)
+    except Exception:
+        return None
+    try:
+        loc = await _get_location(pool, claimed.chat_username, claimed.msg_id)
+    except HTTPException:
+        return None
+    return loc if int(loc.doc_id) == int(doc_id) else None
+
+
+@router.get("/_peer/block/{doc_id}/{offset}", include_in_schema=False)
+async def peer_block(doc_id: int, offset: int, request: Request, p: int = Query(PRIO_STREAM)):
+    """Блок документа для соседнего узла: из своего кеша или из Telegram со сквозной записью.
+    Дальше по кольцу не пересылаем — отвечает тот, кого спросили."""
+    shard = _peers()
+    if not shard.enabled:
+        raise HTTPException(404, "Not found")
+    if not _hmac.compare_digest(request.headers.get(_PEER_TOKEN_HEADER, ""), shard.token):
+        raise HTTPException(403, "Bad peer token")
+    if offset < 0 or offset % CHUNK:
+        raise HTTPException(400, "Bad block")
+
+    pool: Optional[asyncpg.Pool] = getattr(request.app.state, "pool", None)
+    loc = await _peer_location(pool, doc_id, request.headers.get(_PEER_LOC_HEADER, ""))
+    if loc is None:
+        raise HTTPException(404, "Unknown document")
+    if loc.size and offset >= loc.size:
+        raise HTTPException(400, "Bad block")
+    end = offset + CHUNK - 1
+    if loc.size:
+        end = min(end, loc.size - 1)
+    parts: List[bytes] = []
+    try:
+        async for chunk in _tg_byte_iter(loc, offset, end, pool, p, peers=False):
+            parts.append(chunk)
+    except FloodWaitError as e:
+        raise HTTPException(429, f"Telegram rate limit, wait {getattr(e, 'seconds', 3)}s")
+    return Response(
+        content=b"".join(parts),
+        media_type="application/octet-stream",
+        headers={"Cache-Control": "no-store"},
+    )
+
+
 @router.get("/stream/by-msg/{msg_id}")
 async def stream_by_msg(
     msg_id: int,
@@ -670,9 +1520,17 @@ async def stream_by_msg(
             detail="Query 'chat' is required (username канала без @)",
         )
 
+    pool: Optional[asyncpg.Pool] = getattr(request.app.state, "pool", None)
+    cached = _loc_cache().get((chat_username, int(msg_id)))
+    uid = _maybe_user_id(request)
+    if uid:
+        _note_played(uid, (chat_username, int(msg_id)))
+
     # 2. пытаемся зайти в канал (если юзер-сессия). Если нельзя зайти -> 404, а не 500
+    #    При попадании в кеш расположений канал уже проверен — JoinChannel не нужен.
     try:
-        await _ensure_join(chat_username)
+        if cached is None:
+            await _ensure_join(chat_username)
     except HTTPException as e:
         # если _ensure_join внутри уже вернуло HTTPException (e.g. сессии нет) — прокинем как есть
         raise e
@@ -683,9 +1541,9 @@ async def stream_by_msg(
             detail=f"Cannot access chat '{chat_username}': {e.__class__.__name__}",
         )
 
-    # 3. достаём сам документ из телеги
+    # 3. достаём расположение документа (кеш → tracks → телега)
     try:
-        doc = await _get_document(chat_username, msg_id)
+        loc = cached or await _get_location(pool, chat_username, msg_id)
     except HTTPException as e:
         # _get_document уже делает 404/502 → просто пробрасываем
         raise e
@@ -703,23 +1561,31 @@ async def stream_by_msg(
         )
 
     # 4. валидируем размер/миме
-    size = int(getattr(doc, "size", 0) or 0)
+    size = int(loc.size or 0)
     if size <= 0:
-        mt = getattr(doc, "mime_type", "unknown")
+        mt = loc.mime or "unknown"
         raise HTTPException(
             status_code=415,
             detail=f"Unsupported/unknown Telegram file size (mime={mt})",
         )
 
-    mime = getattr(doc, "mime_type", None) or "application/octet-stream"
+    mime = loc.mime or "application/octet-stream"
+
+    # 5. валидаторы: (chat, msg) может со временем указывать на другой документ,
+    #    поэтому без immutable — только ETag для ревалидации и If-Range
+    etag, _ = _validators(loc.doc_id, size)
+    if not_modified(request.headers, etag, None):
+        return _not_modified(etag, None, immutable=False)
 
-    # 5. поддерживаем Range
+    # 6. поддерживаем Range
     r = request.headers.get("range")
+    if not range_allowed(request.headers, etag, None):
+        r = None
     start, end, partial = _parse_range(r, size)
 
     async def body():
         try:
-            agen = _range_guard(start, end, _tg_byte_iter(doc, start, end))
+            agen = _range_guard(start, end, _tg_byte_iter(loc, start, end, pool))
             async for chunk in agen:
                 if chunk:
                     yield chunk
@@ -771,12 +1637,16 @@ async def stream_by_msg(
     headers = {
         "Accept-Ranges": "bytes",
         "X-Accel-Buffering": "no",
-        "Cache-Control": "no-transform",
-        "Content-Encoding": "identity",
+        **validator_headers(etag, None),
     }
 
     if partial:
         headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    disk = _disk_response(loc, start, end, 206 if partial else 200, mime, headers)
+    if disk is not None:
+        return disk
+
+    if partial:
         headers["Content-Length"] = str(end - start + 1)
 
         return StreamingResponse(
@@ -808,47 +1678,63 @@ async def head_stream_by_msg(
             detail="Query 'chat' is required (username канала без @)",
         )
 
-    # HEAD тоже лучше проверить доступ к каналу, чтобы фронт мог заранее понять 404
-    try:
-        await _ensure_join(chat_username)
-    except Exception as e:
-        raise HTTPException(
-            status_code=404,
-            detail=f"Cannot access chat '{chat_username}': {e.__class__.__name__}",
-        )
-
-    await _ensure_tg()
+    pool: Optional[asyncpg.Pool] = getattr(request.app.state, "pool", None)
+    cached = _loc_cache().get((chat_username, int(msg_id)))
+
+    # Метаданные: кеш расположений → tracks. Трек из индекса уже проверен индексатором,
+    # так что JoinChannel/GetMessages нужны только для сообщений, которых нет в БД.
+    meta: Optional[Tuple[int, Optional[str], Optional[int]]] = None
+    if cached is not None and cached.size > 0:
+        meta = (cached.size, cached.mime, cached.doc_id)
+    elif pool is not None:
+        row = await _db_get_track_by_msg(pool, chat_username, msg_id)
+        if row and int(row.get("size_bytes") or 0) > 0:
+            meta = (int(row["size_bytes"]), row.get("mime"), row.get("tg_document_id"))
+
+    if meta is None:
+        # HEAD тоже лучше проверить доступ к каналу, чтобы фронт мог заранее понять 404
+        try:
+            await _ensure_join(chat_username)
+        except Exception as e:
+            raise HTTPException(
+                status_code=404,
+                detail=f"Cannot access chat '{chat_username}': {e.__class__.__name__}",
+            )
 
-    try:
-        doc = await _get_document(chat_username, msg_id)
-    except HTTPException as e:
-        raise e
-    except _RPCError as e:
-        raise HTTPException(
-            status_code=404,
-            detail=f"Telegram RPC access error: {e.__class__.__name__}",
-        )
-    except Exception as e:
-        raise HTTPException(
-            status_code=502,
-            detail=f"Telegram upstream error: {e.__class__.__name__}",
-        )
+        try:
+            loc = await _get_location(pool, chat_username, msg_id)
+        except HTTPException as e:
+            raise e
+        except _RPCError as e:
+            raise HTTPException(
+                status_code=404,
+                detail=f"Telegram RPC access error: {e.__class__.__name__}",
+            )
+        except Exception as e:
+            raise HTTPException(
+                status_code=502,
+                detail=f"Telegram upstream error: {e.__class__.__name__}",
+            )
+        meta = (int(loc.size or 0), loc.mime, loc.doc_id)
 
-    size = int(getattr(doc, "size", 0) or 0)
+    size, mime, doc_id = meta
     if size <= 0:
         raise HTTPException(
             status_code=500,
             detail="Unknown file size",
         )
 
-    mime = getattr(doc, "mime_type", None) or "application/octet-stream"
-
+    mime = mime or "application/octet-stream"
     headers = {
         "Accept-Ranges": "bytes",
         "X-Accel-Buffering": "no",
         "Cache-Control": "no-transform",
-        "Content-Encoding": "identity",
         "Content-Length": str(size),
         "Content-Type": mime,
     }
+    if doc_id:
+        etag, _ = _validators(int(doc_id), size)
+        if not_modified(request.headers, etag, None):
+            return _not_modified(etag, None, immutable=False)
+        headers.update(validator_headers(etag, None))
     return Response(status_code=200, headers=headers, media_type=mime)
\ No newline at end of file
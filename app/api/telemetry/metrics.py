@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from prometheus_client import Counter, Gauge, REGISTRY
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY
 
 # -------- helper: idempotent get-or-create -----------------------------------
 def _get_or_create(metric_cls, name: str, documentation: str, labelnames=(), **kwargs):
@@ -42,6 +42,95 @@ DOWNLOAD_BYTES_TOTAL = _get_or_create(
     Counter, "ogma_download_bytes_total", "Downloaded bytes", ["user", "resource"]
 )
 
+# Stream gateway: откуда пришёл очередной блок аудио (memory / disk / telegram / shared / peer / intro)
+STREAM_CHUNKS_TOTAL = _get_or_create(
+    Counter, "ogma_stream_chunks_total", "Stream blocks served by source", ["source"]
+)
+
+# Stream cache manager: попадания, вытеснение, занятый объём
+STREAM_CACHE_LOOKUPS_TOTAL = _get_or_create(
+    Counter, "ogma_stream_cache_lookups_total", "Stream disk cache lookups", ["result"]
+)
+STREAM_CACHE_HIT_RATIO = _get_or_create(
+    Gauge, "ogma_stream_cache_hit_ratio", "Stream disk cache hit ratio (process lifetime)"
+)
+STREAM_CACHE_EVICTED_BYTES_TOTAL = _get_or_create(
+    Counter, "ogma_stream_cache_evicted_bytes_total", "Bytes evicted from the stream disk cache"
+)
+STREAM_CACHE_BYTES = _get_or_create(
+    Gauge, "ogma_stream_cache_bytes", "Bytes currently used by the stream disk cache"
+)
+_stream_cache_hits = 0
+_stream_cache_lookups = 0
+
+# Планировщик MTProto-вызовов: очередь по приоритетам, занятые слоты, FloodWait
+TG_QUEUE_DEPTH = _get_or_create(
+    Gauge, "ogma_tg_queue_depth", "Telegram calls waiting in the scheduler", ["priority"]
+)
+TG_INFLIGHT = _get_or_create(
+    Gauge, "ogma_tg_inflight", "Telegram calls currently in flight"
+)
+TG_QUEUE_WAIT_SECONDS = _get_or_create(
+    Histogram, "ogma_tg_queue_wait_seconds", "Time a Telegram call waited for a scheduler slot",
+    ["priority"], buckets=(0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60),
+)
+TG_FLOODWAIT_SECONDS_TOTAL = _get_or_create(
+    Counter, "ogma_tg_floodwait_seconds_total", "Seconds of FloodWait imposed by Telegram", ["op"]
+)
+TG_POOL_MEMBERS = _get_or_create(
+    Gauge, "ogma_tg_pool_members", "Telegram client pool members by state", ["state"]
+)
+# Шардирование по узлам: доступность соседей (1 — в кольце)
+STREAM_PEER_UP = _get_or_create(
+    Gauge, "ogma_stream_peer_up", "Stream peer node is alive and in the hash ring", ["peer"]
+)
+# CDN Telegram: байты с CDN-DC и события (redirect / reupload / hash_fail / fallback …)
+TG_CDN_BYTES_TOTAL = _get_or_create(
+    Counter, "ogma_tg_cdn_bytes_total", "Bytes downloaded from Telegram CDN data centers"
+)
+TG_CDN_EVENTS_TOTAL = _get_or_create(
+    Counter, "ogma_tg_cdn_events_total", "Telegram CDN redirect handling events", ["event"]
+)
+# Прогрев кеша по популярности: докачанные байты и треки по исходу (warmed / cached / failed)
+STREAM_WARM_BYTES_TOTAL = _get_or_create(
+    Counter, "ogma_stream_warm_bytes_total", "Bytes prefetched into the stream cache by the warmer"
+)
+STREAM_WARM_TRACKS_TOTAL = _get_or_create(
+    Counter, "ogma_stream_warm_tracks_total", "Tracks visited by the stream cache warmer", ["result"]
+)
+# In-memory LRU горячих блоков: попадания/промахи, вытесненные байты, занятый объём
+STREAM_MEMCACHE_LOOKUPS_TOTAL = _get_or_create(
+    Counter, "ogma_stream_memcache_lookups_total", "Hot-block memory cache lookups", ["result"]
+)
+STREAM_MEMCACHE_EVICTED_BYTES_TOTAL = _get_or_create(
+    Counter, "ogma_stream_memcache_evicted_bytes_total", "Bytes evicted from the hot-block memory cache"
+)
+STREAM_MEMCACHE_BYTES = _get_or_create(
+    Gauge, "ogma_stream_memcache_bytes", "Bytes held by the hot-block memory cache"
+)
+# Сегментное скачивание: повторы отдельных блоков вместо перезапуска файла
+DOWNLOAD_SEGMENT_RETRIES_TOTAL = _get_or_create(
+    Counter, "ogma_download_segment_retries_total", "Per-block retries in segmented downloads"
+)
+# Темп докачки по проигрыванию: сколько секунд потоки ждали слушателя вместо запросов в Telegram
+STREAM_PACE_WAIT_SECONDS_TOTAL = _get_or_create(
+    Counter, "ogma_stream_pace_wait_seconds_total", "Seconds stream fetching waited for the listener"
+)
+# /me/send: очередь отправок (done / retry / failed) и конвейерная перезаливка ботом
+SEND_JOBS_TOTAL = _get_or_create(
+    Counter, "ogma_send_jobs_total", "Finished /me/send queue jobs", ["result"]
+)
+SEND_UPLOAD_BYTES_TOTAL = _get_or_create(
+    Counter, "ogma_send_upload_bytes_total", "Bytes re-uploaded by the bot for /me/send"
+)
+SEND_UPLOAD_RETRIES_TOTAL = _get_or_create(
+    Counter, "ogma_send_upload_retries_total", "Per-part retries in /me/send re-uploads"
+)
+# Префетч следующих треков плейлиста (fetched / cached / cancelled / failed)
+STREAM_PREFETCH_TOTAL = _get_or_create(
+    Counter, "ogma_stream_prefetch_total", "Playlist next-track prefetches by result", ["result"]
+)
+
 # Errors
 ERRORS_TOTAL = _get_or_create(
     Counter, "ogma_errors_total", "HTTP errors total", ["path", "status_code"]
@@ -114,4 +203,176 @@ def mark_error(path: str, status_code: int) -> None:
     try:
         ERRORS_TOTAL.labels(path=path, status_code=str(status_code)).inc()
     except Exception:
-        pass
\ No newline at end of file
+        pass
+
+
+def mark_stream_chunk(source: str) -> None:
+    try:
+        STREAM_CHUNKS_TOTAL.labels(source=source).inc()
+    except Exception:
+        pass
+
+
+def mark_stream_cache_lookup(hit: bool) -> None:
+    global _stream_cache_hits, _stream_cache_lookups
+    _stream_cache_lookups += 1
+    if hit:
+        _stream_cache_hits += 1
+    try:
+        STREAM_CACHE_LOOKUPS_TOTAL.labels(result="hit" if hit else "miss").inc()
+        STREAM_CACHE_HIT_RATIO.set(_stream_cache_hits / _stream_cache_lookups)
+    except Exception:
+        pass
+
+
+def mark_stream_cache_evicted(n_bytes: int) -> None:
+    if n_bytes > 0:
+        try:
+            STREAM_CACHE_EVICTED_BYTES_TOTAL.inc(n_bytes)
+        except Exception:
+            pass
+
+
+def set_stream_cache_bytes(n_bytes: int) -> None:
+    try:
+        STREAM_CACHE_BYTES.set(n_bytes)
+    except Exception:
+        pass
+
+
+def set_tg_queue_depth(priority: str, n: int) -> None:
+    try:
+        TG_QUEUE_DEPTH.labels(priority=priority).set(n)
+    except Exception:
+        pass
+
+
+def set_tg_inflight(n: int) -> None:
+    try:
+        TG_INFLIGHT.set(n)
+    except Exception:
+        pass
+
+
+def observe_tg_queue_wait(priority: str, seconds: float) -> None:
+    try:
+        TG_QUEUE_WAIT_SECONDS.labels(priority=priority).observe(seconds)
+    except Exception:
+        pass
+
+
+def mark_tg_floodwait(op: str, seconds: float) -> None:
+    try:
+        TG_FLOODWAIT_SECONDS_TOTAL.labels(op=op).inc(max(0.0, seconds))
+    except Exception:
+        pass
+
+
+def set_tg_pool_members(state: str, n: int) -> None:
+    try:
+        TG_POOL_MEMBERS.labels(state=state).set(n)
+    except Exception:
+        pass
+
+
+def set_stream_peer_up(peer: str, up: bool) -> None:
+    try:
+        STREAM_PEER_UP.labels(peer=peer).set(1 if up else 0)
+    except Exception:
+        pass
+
+
+def add_tg_cdn_bytes(n_bytes: int) -> None:
+    if n_bytes > 0:
+        try:
+            TG_CDN_BYTES_TOTAL.inc(n_bytes)
+        except Exception:
+            pass
+
+
+def mark_tg_cdn_event(event: str) -> None:
+    try:
+        TG_CDN_EVENTS_TOTAL.labels(event=event).inc()
+    except Exception:
+        pass
+
+
+def add_stream_warm_bytes(n_bytes: int) -> None:
+    if n_bytes > 0:
+        try:
+            STREAM_WARM_BYTES_TOTAL.inc(n_bytes)
+        except Exception:
+            pass
+
+
+def mark_stream_warm_track(result: str) -> None:
+    try:
+        STREAM_WARM_TRACKS_TOTAL.labels(result=result).inc()
+    except Exception:
+        pass
+
+
+def mark_stream_prefetch(result: str) -> None:
+    try:
+        STREAM_PREFETCH_TOTAL.labels(result=result).inc()
+    except Exception:
+        pass
+
+
+def mark_stream_memcache_lookup(hit: bool) -> None:
+    try:
+        STREAM_MEMCACHE_LOOKUPS_TOTAL.labels(result="hit" if hit else "miss").inc()
+    except Exception:
+        pass
+
+
+def mark_stream_memcache_evicted(n_bytes: int) -> None:
+    if n_bytes > 0:
+        try:
+            STREAM_MEMCACHE_EVICTED_BYTES_TOTAL.inc(n_bytes)
+        except Exception:
+            pass
+
+
+def set_stream_memcache_bytes(n_bytes: int) -> None:
+    try:
+        STREAM_MEMCACHE_BYTES.set(n_bytes)
+    except Exception:
+        pass
+
+
+def mark_download_segment_retry() -> None:
+    try:
+        DOWNLOAD_SEGMENT_RETRIES_TOTAL.inc()
+    except Exception:
+        pass
+
+
+def mark_send_job(result: str) -> None:
+    try:
+        SEND_JOBS_TOTAL.labels(result=result).inc()
+    except Exception:
+        pass
+
+
+def add_send_upload_bytes(n_bytes: int) -> None:
+    if n_bytes > 0:
+        try:
+            SEND_UPLOAD_BYTES_TOTAL.inc(n_bytes)
+        except Exception:
+            pass
+
+
+def mark_send_upload_retry() -> None:
+    try:
+        SEND_UPLOAD_RETRIES_TOTAL.inc()
+    except Exception:
+        pass
+
+
+def add_stream_pace_wait(seconds: float) -> None:
+    if seconds > 0:
+        try:
+            STREAM_PACE_WAIT_SECONDS_TOTAL.inc(seconds)
+        except Exception:
+            pass
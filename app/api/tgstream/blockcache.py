@@ -0,0 +1,224 @@
+# /home/ogma/ogma/app/api/tgstream/blockcache.py
+from __future__ import annotations
+
+import os
+import fcntl
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator, List, Optional
+
+# Блочный разреженный кеш аудио на диске, общий для stream_gateway и stream/main.py.
+#
+# Раскладка: <root>/<key[:2]>/<key>.blk — разреженный файл полного размера,
+#            <root>/<key[:2]>/<key>.map — битмап присутствующих блоков (1 бит на блок).
+# Ключ — id Telegram-документа: он одинаков для by-id и by-msg маршрутов обоих шлюзов.
+# Блок пишется целиком и только потом помечается в битмапе, поэтому читатель
+# никогда не увидит бит без данных. Битмап обновляется под flock — воркеры не теряют биты.
+# Менеджер кеша удаляет .blk/.map без лока, поэтому под flock писатель сверяет inode своего
+# .blk с тем, что лежит по пути: данные, ушедшие в вытесненный файл, битом не помечаются.
+# Читатель сначала открывает .blk, потом перечитывает битмап: у файла, заведённого заново под
+# тем же именем, битмап уже обнулён, и дыры (нули) по старым битам не уйдут клиенту.
+# (Сверять inode при чтении нельзя — номер освобождённого inode ФС тут же выдаёт новому файлу.)
+
+BLOCK_SIZE = 512 * 1024  # совпадает с CHUNK в stream_gateway и в stream/main.py
+
+log = logging.getLogger("app.tgstream.blockcache")
+
+
+def default_root() -> str:
+    root = os.environ.get("BLOCK_CACHE_DIR", "").strip()
+    if root:
+        return root
+    base = os.environ.get("CACHE_DIR", "/home/ogma/ogma/stream/media-cache")
+    return os.path.join(base, "blocks")
+
+
+@contextmanager
+def _locked(path: str) -> Iterator[int]:
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield fd
+    finally:
+        _unlock_close(fd)
+
+
+def _unlock_close(fd: int) -> None:
+    try:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    except OSError:
+        pass
+    try:
+        os.close(fd)
+    except OSError:
+        pass
+
+
+class BlockFile:
+    """Один закешированный документ: данные + битмап блоков."""
+
+    def __init__(self, root: str, key: str, size: int, block_size: int = BLOCK_SIZE):
+        if size <= 0:
+            raise ValueError("size must be positive")
+        self.key = key
+        self.size = int(size)
+        self.block_size = int(block_size)
+        self.nblocks = (self.size + self.block_size - 1) // self.block_size
+
+        sub = os.path.join(root, key[:2] or "__")
+        os.makedirs(sub, exist_ok=True)
+        self.data_path = os.path.join(sub, f"{key}.blk")
+        self.map_path = os.path.join(sub, f"{key}.map")
+        self._bits = bytearray((self.nblocks + 7) // 8)
+        self._init()
+
+    # --- bitmap ---
+    def _init(self) -> None:
+        with _locked(self.map_path) as fd:
+            try:
+                st = os.stat(self.data_path)
+                same = st.st_size == self.size
+            except FileNotFoundError:
+                same = False
+            if not same:
+                # новый файл или документ сменил размер — начинаем с пустого битмапа;
+                # битмап обнуляем до создания .blk: кто откроет новый файл, старых битов не увидит
+                self._bits[:] = bytes(len(self._bits))
+                os.ftruncate(fd, 0)
+                os.pwrite(fd, bytes(self._bits), 0)
+                with open(self.data_path, "wb") as f:
+                    f.truncate(self.size)
+                return
+            self._bits[:] = self._read_bits(fd)
+
+    def _read_bits(self, fd: int) -> bytearray:
+        raw = os.pread(fd, len(self._bits), 0)
+        bits = bytearray(len(self._bits))
+        bits[: len(raw)] = raw
+        return bits
+
+    def reload(self) -> None:
+        """Подтягивает битмап с диска (блоки могли дописать другие воркеры)."""
+        try:
+            with open(self.map_path, "rb") as f:
+                raw = f.read(len(self._bits))
+            bits = bytearray(len(self._bits))  # короткий (только что созданный) битмап — нули
+            bits[: len(raw)] = raw
+            self._bits[:] = bits
+        except FileNotFoundError:
+            # запись вытеснил менеджер кеша — считаем, что блоков больше нет
+            self._bits[:] = bytes(len(self._bits))
+
+    def has(self, idx: int) -> bool:
+        if idx < 0 or idx >= self.nblocks:
+            return False
+        return bool(self._bits[idx >> 3] & (1 << (idx & 7)))
+
+    def missing(self, first: int, last: int) -> List[int]:
+        self.reload()
+        return [i for i in range(max(0, first), min(last, self.nblocks - 1) + 1) if not self.has(i)]
+
+    @property
+    def complete(self) -> bool:
+        return not self.missing(0, self.nblocks - 1)
+
+    # --- data ---
+    def block_len(self, idx: int) -> int:
+        start = idx * self.block_size
+        return max(0, min(self.block_size, self.size - start))
+
+    def block_for(self, offset: int) -> int:
+        return offset // self.block_size
+
+    def read_block(self, idx: int) -> Optional[bytes]:
+        if not self.has(idx):
+            return None
+        n = self.block_len(idx)
+        try:
+            with open(self.data_path, "rb") as f:
+                self.reload()  # биты — от того файла, что открыт (или новее)
+                if not self.has(idx):
+                    return None
+                f.seek(idx * self.block_size)
+                data = f.read(n)
+        except FileNotFoundError:
+            self._bits[:] = bytes(len(self._bits))
+            return None
+        return data if len(data) == n else None
+
+    def write_block(self, idx: int, data: bytes) -> bool:
+        """Пишет блок целиком. Неполные блоки (обрыв, хвост не того размера) не кешируются."""
+        if idx < 0 or idx >= self.nblocks or len(data) != self.block_len(idx):
+            return False
+        if self.has(idx):
+            return True
+        if not os.path.exists(self.data_path):
+            self._init()  # файл вытеснили, пока описание жило в LRU
+        try:
+            f = open(self.data_path, "r+b")
+        except FileNotFoundError:
+            return False
+        with f:
+            f.seek(idx * self.block_size)
+            f.write(data)
+            f.flush()
+            written = os.fstat(f.fileno())
+            with _locked(self.map_path) as fd:
+                try:
+                    st = os.stat(self.data_path)
+                    same = (st.st_dev, st.st_ino) == (written.st_dev, written.st_ino)
+                except FileNotFoundError:
+                    same = False
+                if not same:
+                    # вытеснили (и, возможно, уже создали заново), пока мы писали
+                    self._bits[:] = bytes(len(self._bits))
+                    return False
+                bits = self._read_bits(fd)
+                bits[idx >> 3] |= 1 << (idx & 7)
+                os.pwrite(fd, bytes(bits), 0)
+                self._bits[:] = bits
+        return True
+
+
+class BlockCache:
+    """Фабрика BlockFile с небольшим LRU открытых описаний."""
+
+    def __init__(self, root: Optional[str] = None, block_size: int = BLOCK_SIZE, max_open: int = 1024):
+        self.root = root or default_root()
+        self.block_size = int(block_size)
+        self._max_open = max(1, int(max_open))
+        self._files: "OrderedDict[str, BlockFile]" = OrderedDict()
+        self.enabled = True
+        try:
+            os.makedirs(self.root, exist_ok=True)
+        except OSError as e:
+            log.warning("block cache disabled: cannot create %s: %s", self.root, e)
+            self.enabled = False
+
+    def open(self, key: str, size: int) -> Optional[BlockFile]:
+        if not self.enabled or not key or size <= 0:
+            return None
+        bf = self._files.get(key)
+        if bf is not None and bf.size == size:
+            self._files.move_to_end(key)
+            return bf
+        try:
+            bf = BlockFile(self.root, key, size, self.block_size)
+        except OSError as e:
+            log.warning("block cache open failed key=%s: %s", key, e)
+            return None
+        self._files[key] = bf
+        while len(self._files) > self._max_open:
+            self._files.popitem(last=False)
+        return bf
+
+
+_default: Optional[BlockCache] = None
+
+
+def default_cache() -> BlockCache:
+    global _default
+    if _default is None:
+        _default = BlockCache()
+    return _default
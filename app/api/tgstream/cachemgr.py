@@ -0,0 +1,280 @@
+# /home/ogma/ogma/app/api/tgstream/cachemgr.py
+from __future__ import annotations
+
+import asyncio as _asyncio
+import os
+import json
+import time
+import fcntl
+import logging
+from contextlib import suppress
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from app.api.tgstream.blockcache import default_root as _block_root
+
+# Менеджер дискового кеша аудио: бюджет в байтах + вытеснение до low-watermark.
+#
+# Учитываемые записи: блочные файлы (<doc>.blk + <doc>.map) и старые полнофайловые <track>.bin.
+# Размер считаем по реально занятым блокам ФС (st_blocks) — .blk разреженные.
+# Статистика обращений (atime/hits) копится в памяти каждого воркера и раз в интервал
+# вливается под flock в общий индекс <root>/.cache-index.json. Тот же проход пересканирует
+# дерево (индекс перестраивается и после рестарта), чистит осиротевшие .part и свой
+# недописанный .cache-index.json.tmp (чужие *.tmp не трогаем) и вытесняет
+# записи по LRU/LFU, пока объём не опустится до low-watermark.
+
+log = logging.getLogger("app.tgstream.cachemgr")
+
+try:
+    from app.api.telemetry.metrics import (
+        mark_stream_cache_lookup,
+        mark_stream_cache_evicted,
+        set_stream_cache_bytes,
+    )
+except Exception:
+    def mark_stream_cache_lookup(hit: bool) -> None:  # type: ignore
+        pass
+
+    def mark_stream_cache_evicted(n_bytes: int) -> None:  # type: ignore
+        pass
+
+    def set_stream_cache_bytes(n_bytes: int) -> None:  # type: ignore
+        pass
+
+DATA_SUFFIXES = (".blk", ".bin")
+COMPANION_SUFFIXES = (".map",)
+INDEX_NAME = ".cache-index.json"
+LOCK_NAME = ".cache.lock"
+
+MAX_BYTES = int(float(os.environ.get("STREAM_CACHE_MAX_GB", "0") or 0) * 1024 ** 3)  # 0 — без лимита
+LOW_WATERMARK = float(os.environ.get("STREAM_CACHE_LOW_WATERMARK", "0.9"))
+POLICY = (os.environ.get("STREAM_CACHE_POLICY", "lru") or "lru").strip().lower()
+INTERVAL_S = int(os.environ.get("STREAM_CACHE_EVICT_INTERVAL", "60"))
+PART_MAX_AGE_S = int(os.environ.get("STREAM_CACHE_PART_MAX_AGE", "3600"))
+
+
+def default_manager_root() -> str:
+    # по умолчанию блоки лежат в <CACHE_DIR>/blocks — тогда бюджетим весь CACHE_DIR,
+    # чтобы заодно учесть и старые .bin
+    if os.environ.get("BLOCK_CACHE_DIR", "").strip():
+        return _block_root()
+    return os.environ.get("CACHE_DIR", "/home/ogma/ogma/stream/media-cache")
+
+
+@dataclass
+class Entry:
+    rel: str
+    size: int
+    atime: float
+    hits: int = 0
+
+
+def _allocated(st: os.stat_result) -> int:
+    blocks = getattr(st, "st_blocks", None)
+    return int(blocks) * 512 if blocks is not None else int(st.st_size)
+
+
+class CacheManager:
+    def __init__(
+        self,
+        root: Optional[str] = None,
+        max_bytes: int = MAX_BYTES,
+        low_watermark: float = LOW_WATERMARK,
+        policy: str = POLICY,
+    ):
+        self.root = os.path.abspath(root or default_manager_root())
+        self.max_bytes = max(0, int(max_bytes))
+        self.low_watermark = min(max(low_watermark, 0.1), 1.0)
+        self.policy = policy if policy in {"lru", "lfu"} else "lru"
+        self.total_bytes = 0
+        self.evicted_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._pending: Dict[str, Tuple[float, int]] = {}
+
+    # --- учёт обращений (вызывается из горячего пути, только память) ---
+    def record(self, path: str, hit: bool) -> None:
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        mark_stream_cache_lookup(hit)
+        rel = os.path.relpath(os.path.abspath(path), self.root)
+        if rel.startswith(".."):
+            return
+        _, hits = self._pending.get(rel, (0.0, 0))
+        self._pending[rel] = (time.time(), hits + (1 if hit else 0))
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return (self.hits / total) if total else 0.0
+
+    # --- индекс ---
+    def _index_path(self) -> str:
+        return os.path.join(self.root, INDEX_NAME)
+
+    def _load_index(self) -> Dict[str, Entry]:
+        try:
+            with open(self._index_path(), "r") as f:
+                raw = json.load(f)
+        except Exception:
+            return {}
+        out: Dict[str, Entry] = {}
+        for rel, v in (raw.get("entries") or {}).items():
+            try:
+                out[rel] = Entry(rel=rel, size=int(v["size"]), atime=float(v["atime"]), hits=int(v.get("hits", 0)))
+            except Exception:
+                continue
+        return out
+
+    def _save_index(self, entries: Dict[str, Entry]) -> None:
+        tmp = self._index_path() + ".tmp"
+        data = {
+            "version": 1,
+            "entries": {e.rel: {"size": e.size, "atime": e.atime, "hits": e.hits} for e in entries.values()},
+        }
+        with open(tmp, "w") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp, self._index_path())
+
+    # --- скан дерева ---
+    def _scan(self, known: Dict[str, Entry]) -> Dict[str, Entry]:
+        now = time.time()
+        found: Dict[str, Entry] = {}
+        for dirpath, _dirs, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(dirpath, name)
+                if name.endswith(".part") or name == INDEX_NAME + ".tmp":
+                    # остатки оборванных загрузок старого шлюза и прерванной записи индекса
+                    with suppress(OSError):
+                        if now - os.stat(path).st_mtime > PART_MAX_AGE_S:
+                            os.remove(path)
+                    continue
+                if not name.endswith(DATA_SUFFIXES):
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                size = _allocated(st)
+                stem = path[: -len(".blk")] if name.endswith(".blk") else None
+                if stem:
+                    for suf in COMPANION_SUFFIXES:
+                        with suppress(OSError):
+                            size += _allocated(os.stat(stem + suf))
+                rel = os.path.relpath(path, self.root)
+                prev = known.get(rel)
+                found[rel] = Entry(
+                    rel=rel,
+                    size=size,
+                    atime=prev.atime if prev else st.st_mtime,
+                    hits=prev.hits if prev else 0,
+                )
+        return found
+
+    def _remove(self, entry: Entry) -> None:
+        path = os.path.join(self.root, entry.rel)
+        paths = [path]
+        if path.endswith(".blk"):
+            stem = path[: -len(".blk")]
+            paths += [stem + suf for suf in COMPANION_SUFFIXES]
+        for p in paths:
+            with suppress(FileNotFoundError):
+                os.remove(p)
+
+    def _victims(self, entries: Dict[str, Entry]) -> List[Entry]:
+        if self.policy == "lfu":
+            return sorted(entries.values(), key=lambda e: (e.hits, e.atime))
+        return sorted(entries.values(), key=lambda e: e.atime)
+
+    def run_once(self, pending: Optional[Dict[str, Tuple[float, int]]] = None) -> int:
+        """Слить статистику, пересканировать, вытеснить. Возвращает число вытесненных байт.
+        Если другой воркер уже держит лок — ничего не делает (pending вернётся в очередь)."""
+        os.makedirs(self.root, exist_ok=True)
+        fd = os.open(os.path.join(self.root, LOCK_NAME), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)  # занят → BlockingIOError
+            known = self._load_index()
+            for rel, (atime, hits) in (pending or {}).items():
+                e = known.get(rel)
+                if e is not None:
+                    e.atime = max(e.atime, atime)
+                    e.hits += hits
+                else:
+                    known[rel] = Entry(rel=rel, size=0, atime=atime, hits=hits)
+
+            entries = self._scan(known)
+            total = sum(e.size for e in entries.values())
+            evicted = 0
+            if self.max_bytes and total > self.max_bytes:
+                target = int(self.max_bytes * self.low_watermark)
+                for victim in self._victims(entries):
+                    if total <= target:
+                        break
+                    self._remove(victim)
+                    entries.pop(victim.rel, None)
+                    total -= victim.size
+                    evicted += victim.size
+                log.info("stream cache evicted %d bytes, now %d/%d", evicted, total, self.max_bytes)
+
+            self._save_index(entries)
+            self.total_bytes = total
+            self.evicted_bytes += evicted
+            return evicted
+        finally:
+            with suppress(OSError):
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    async def tick(self) -> None:
+        pending, self._pending = self._pending, {}
+        try:
+            evicted = await _asyncio.to_thread(self.run_once, pending)
+        except BlockingIOError:
+            # лок у соседнего воркера — вернём статистику и попробуем в следующий раз
+            for rel, (atime, hits) in pending.items():
+                cur_atime, cur_hits = self._pending.get(rel, (0.0, 0))
+                self._pending[rel] = (max(atime, cur_atime), hits + cur_hits)
+            return
+        if evicted:
+            mark_stream_cache_evicted(evicted)
+        set_stream_cache_bytes(self.total_bytes)
+
+
+_default: Optional[CacheManager] = None
+
+
+def default_manager() -> CacheManager:
+    global _default
+    if _default is None:
+        _default = CacheManager()
+    return _default
+
+
+async def _runner(mgr: CacheManager, stop_evt: _asyncio.Event) -> None:
+    while not stop_evt.is_set():
+        try:
+            await mgr.tick()
+        except Exception:
+            log.exception("stream cache manager tick failed")
+        with suppress(_asyncio.TimeoutError):
+            await _asyncio.wait_for(stop_evt.wait(), timeout=max(5, INTERVAL_S))
+
+
+# ---- API для main.py ----
+async def start_cache_manager(app) -> None:
+    mgr = default_manager()
+    stop_evt = _asyncio.Event()
+    app.state._stream_cache_stop_evt = stop_evt
+    app.state._stream_cache_task = _asyncio.create_task(_runner(mgr, stop_evt), name="ogma-stream-cache")
+
+
+async def stop_cache_manager(app) -> None:
+    stop_evt = getattr(app.state, "_stream_cache_stop_evt", None)
+    task = getattr(app.state, "_stream_cache_task", None)
+    if stop_evt:
+        stop_evt.set()
+    if task:
+        with suppress(Exception):
+            await _asyncio.wait_for(task, timeout=10)
@@ -0,0 +1,404 @@
+# /home/ogma/ogma/app/api/tgstream/cdn.py
+from __future__ import annotations
+
+import os
+import copy
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from contextlib import suppress
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+# Скачивание через CDN-DC Telegram (https://core.telegram.org/cdn).
+#
+# На GetFile с cdn_supported=True Telegram для популярных файлов отвечает
+# upload.fileCdnRedirect: байты лежат на CDN-DC, зашифрованные AES-256-CTR, а достаются
+# upload.getCdnFile по file_token. Редирект запоминается на документ (и сессию) — следующие
+# блоки идут сразу на CDN, мимо основного DC. Каждый ответ CDN расшифровывается и
+# сверяется с sha256 из file_hashes / upload.getCdnFileHashes; если CDN просит
+# перезалить файл (cdnFileReuploadNeeded) — upload.reuploadCdnFile на основном DC и повтор.
+#
+# Протухший file_token — редирект забываем и заново спрашиваем основной DC. Любая другая
+# беда с CDN (недоступен, хеш не сошёлся, нет AES) — документ на время уходит в режим
+# без CDN (cdn_supported=False), проигрывание не должно из-за CDN ломаться.
+
+log = logging.getLogger("app.tgstream.cdn")
+
+try:
+    from telethon.errors import FloodWaitError, RPCError
+    from telethon.tl.types.upload import FileCdnRedirect
+    from telethon.tl.functions.upload import (
+        GetCdnFileRequest,
+        GetCdnFileHashesRequest,
+        ReuploadCdnFileRequest,
+    )
+except Exception:  # pragma: no cover
+    class FloodWaitError(Exception):  # type: ignore
+        seconds = 3
+
+    class RPCError(Exception):  # type: ignore
+        message = ""
+
+    class FileCdnRedirect:  # type: ignore
+        pass
+
+    GetCdnFileRequest = GetCdnFileHashesRequest = ReuploadCdnFileRequest = None  # type: ignore
+
+try:  # быстрый AES из cryptography; иначе — pyaes, который тянет Telethon
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+    def _aes_ctr(key: bytes, iv: bytes, data: bytes) -> bytes:
+        dec = Cipher(algorithms.AES(key), modes.CTR(iv)).decryptor()
+        return dec.update(data) + dec.finalize()
+except Exception:  # pragma: no cover
+    try:
+        from telethon.crypto import AESModeCTR
+
+        def _aes_ctr(key: bytes, iv: bytes, data: bytes) -> bytes:
+            return AESModeCTR(key, iv).encrypt(data)
+    except Exception:
+        _aes_ctr = None  # type: ignore
+
+try:
+    from app.api.telemetry.metrics import add_tg_cdn_bytes, mark_tg_cdn_event
+except Exception:
+    def add_tg_cdn_bytes(n_bytes: int) -> None:  # type: ignore
+        pass
+
+    def mark_tg_cdn_event(event: str) -> None:  # type: ignore
+        pass
+
+KIB = 1024
+ENABLED = os.environ.get("TG_CDN", "1") not in ("0", "false", "no", "")
+HASH_CHUNK = 128 * KIB           # гранулярность file_hashes, если Telegram не сказал иного
+MAX_LIMIT = 512 * KIB            # самый большой кусок одного getCdnFile
+REDIRECT_CACHE_MAX = int(os.environ.get("TG_CDN_REDIRECT_CACHE", "4096"))
+REDIRECT_TTL_S = float(os.environ.get("TG_CDN_REDIRECT_TTL", "3600"))
+FALLBACK_TTL_S = float(os.environ.get("TG_CDN_FALLBACK_TTL", "600"))
+REUPLOAD_RETRIES = 3
+
+
+class CdnError(Exception):
+    """CDN не отдал байты — вызывающий идёт на основной DC без CDN."""
+
+
+class CdnTokenExpired(CdnError):
+    """file_token больше не действует — нужен свежий редирект."""
+
+
+class CdnHashMismatch(CdnError):
+    pass
+
+
+class CdnChunk:
+    """Ответ в форме upload.File: вызывающим нужен только .bytes."""
+
+    __slots__ = ("bytes",)
+
+    def __init__(self, data: bytes):
+        self.bytes = data
+
+
+@dataclass
+class CdnRedirect:
+    dc_id: int
+    file_token: bytes
+    key: bytes
+    iv: bytes
+    hashes: Dict[int, Any] = field(default_factory=dict)  # offset → FileHash
+    created: float = field(default_factory=time.monotonic)
+
+    @classmethod
+    def from_tl(cls, tl: Any) -> "CdnRedirect":
+        red = cls(
+            dc_id=int(tl.dc_id),
+            file_token=bytes(tl.file_token),
+            key=bytes(tl.encryption_key),
+            iv=bytes(tl.encryption_iv),
+        )
+        red.add_hashes(getattr(tl, "file_hashes", None))
+        return red
+
+    def add_hashes(self, items: Optional[Iterable[Any]]) -> None:
+        for h in items or ():
+            self.hashes[int(h.offset)] = h
+
+    @property
+    def hash_chunk(self) -> int:
+        for h in self.hashes.values():
+            return int(h.limit) or HASH_CHUNK
+        return HASH_CHUNK
+
+
+def cdn_pieces(start: int, stop: int, max_limit: int = MAX_LIMIT) -> List[Tuple[int, int]]:
+    """Нарезка [start, stop) на законные getCdnFile: limit — степень двойки от 4 KiB до
+    max_limit, offset кратен limit (значит, кусок не пересекает границу 1 MiB)."""
+    out: List[Tuple[int, int]] = []
+    pos = start
+    while pos < stop:
+        size = max_limit
+        while size > 4 * KIB and (pos % size or pos + size > stop):
+            size //= 2
+        out.append((pos, size))
+        pos += size
+    return out
+
+
+def decrypt(red: CdnRedirect, offset: int, data: bytes) -> bytes:
+    """AES-256-CTR: 12 байт iv + (offset / 16) big-endian как счётчик."""
+    if _aes_ctr is None:
+        raise CdnError("no AES-CTR implementation available")
+    iv = red.iv[:12] + (offset // 16).to_bytes(4, "big")
+    return _aes_ctr(red.key, iv, data)
+
+
+def check_hashes(red: CdnRedirect, offset: int, data: bytes) -> List[int]:
+    """Сверяет data (начиная с offset, выровненного по хешам) с file_hashes.
+    Возвращает offset'ы, для которых хешей ещё нет; несовпадение — CdnHashMismatch."""
+    missing: List[int] = []
+    pos, end = offset, offset + len(data)
+    while pos < end:
+        h = red.hashes.get(pos)
+        if h is None:
+            missing.append(pos)
+            pos += red.hash_chunk
+            continue
+        piece = data[pos - offset:pos - offset + int(h.limit)]
+        if hashlib.sha256(piece).digest() != bytes(h.hash):
+            raise CdnHashMismatch(f"cdn hash mismatch at offset {pos}")
+        pos += int(h.limit)
+    return missing
+
+
+def _doc_id(request: Any) -> Optional[int]:
+    with suppress(Exception):
+        return int(request.location.id)
+    return None
+
+
+def _without_cdn(request: Any) -> Any:
+    req = copy.copy(request)
+    req.cdn_supported = False
+    return req
+
+
+def _rpc_message(e: BaseException) -> str:
+    return str(getattr(e, "message", "") or e)
+
+
+class CdnFetcher:
+    def __init__(
+        self,
+        max_redirects: int = REDIRECT_CACHE_MAX,
+        ttl: float = REDIRECT_TTL_S,
+        fallback_ttl: float = FALLBACK_TTL_S,
+    ):
+        self.max_redirects = max(1, int(max_redirects))
+        self.ttl = ttl
+        self.fallback_ttl = fallback_ttl
+        self._redirects: "OrderedDict[Tuple[str, int], CdnRedirect]" = OrderedDict()
+        self._no_cdn: Dict[int, float] = {}
+        self._senders: Dict[Tuple[int, int], Any] = {}
+        self._inited: set = set()
+        self._lock = asyncio.Lock()
+
+    # --- редиректы ---
+    def allowed(self, doc_id: int) -> bool:
+        until = self._no_cdn.get(doc_id)
+        if until is None:
+            return True
+        if time.monotonic() >= until:
+            self._no_cdn.pop(doc_id, None)
+            return True
+        return False
+
+    def disable(self, doc_id: int) -> None:
+        self._no_cdn[doc_id] = time.monotonic() + self.fallback_ttl
+
+    def lookup(self, owner: str, doc_id: int) -> Optional[CdnRedirect]:
+        key = (owner, doc_id)
+        red = self._redirects.get(key)
+        if red is None:
+            return None
+        if time.monotonic() - red.created > self.ttl:
+            self._redirects.pop(key, None)
+            return None
+        self._redirects.move_to_end(key)
+        return red
+
+    def remember(self, owner: str, doc_id: int, tl: Any) -> CdnRedirect:
+        red = CdnRedirect.from_tl(tl)
+        self._redirects[(owner, doc_id)] = red
+        self._redirects.move_to_end((owner, doc_id))
+        while len(self._redirects) > self.max_redirects:
+            self._redirects.popitem(last=False)
+        mark_tg_cdn_event("redirect")
+        log.info("doc %s is served from cdn dc %d", doc_id, red.dc_id)
+        return red
+
+    def forget(self, owner: str, doc_id: int) -> None:
+        self._redirects.pop((owner, doc_id), None)
+
+    # --- соединения с CDN-DC ---
+    async def _sender(self, client: Any, dc_id: int) -> Any:
+        key = (id(client), dc_id)
+        sender = self._senders.get(key)
+        if sender is not None and sender.is_connected():
+            return sender
+        async with self._lock:
+            sender = self._senders.get(key)
+            if sender is not None and sender.is_connected():
+                return sender
+            from telethon.crypto import rsa
+            from telethon.network import MTProtoSender
+
+            dc = await client._get_dc(dc_id, cdn=True)
+            # Telethon добавляет RSA-ключ только первого CDN-DC — нужны все
+            for pk in getattr(client._cdn_config, "public_keys", None) or ():
+                with suppress(Exception):
+                    rsa.add_key(pk.public_key, old=False)
+            # на CDN не авторизуемся: свой временный auth key, без ImportAuthorization
+            sender = MTProtoSender(None, loggers=client._log)
+            await sender.connect(client._connection(
+                dc.ip_address,
+                dc.port,
+                dc.id,
+                loggers=client._log,
+                proxy=client._proxy,
+                local_addr=client._local_addr,
+            ))
+            self._senders[key] = sender
+            self._inited.discard(key)
+            return sender
+
+    async def _cdn_call(self, client: Any, dc_id: int, request: Any) -> Any:
+        sender = await self._sender(client, dc_id)
+        key = (id(client), dc_id)
+        if key in self._inited:
+            return await client._call(sender, request)
+        from telethon.tl.alltlobjects import LAYER
+        from telethon.tl.functions import InvokeWithLayerRequest
+
+        # первый запрос на новом соединении — внутри initConnection
+        init = copy.copy(client._init_request)
+        init.query = request
+        res = await client._call(sender, InvokeWithLayerRequest(LAYER, init))
+        self._inited.add(key)
+        return res
+
+    async def _drop_sender(self, client: Any, dc_id: int) -> None:
+        key = (id(client), dc_id)
+        sender = self._senders.pop(key, None)
+        self._inited.discard(key)
+        if sender is not None:
+            with suppress(Exception):
+                await sender.disconnect()
+
+    # --- чтение ---
+    async def _piece(self, client: Any, red: CdnRedirect, offset: int, limit: int,
+                     master: Callable[[Any], Awaitable[Any]]) -> bytes:
+        for _ in range(REUPLOAD_RETRIES + 1):
+            res = await self._cdn_call(
+                client, red.dc_id, GetCdnFileRequest(file_token=red.file_token, offset=offset, limit=limit)
+            )
+            token = getattr(res, "request_token", None)
+            if token is None:
+                return await asyncio.to_thread(decrypt, red, offset, bytes(res.bytes))
+            # куска ещё нет на CDN — основной DC заливает его и отдаёт хеши
+            mark_tg_cdn_event("reupload")
+            red.add_hashes(await master(
+                ReuploadCdnFileRequest(file_token=red.file_token, request_token=token)
+            ))
+        raise CdnError(f"cdn reupload did not converge at offset {offset}")
+
+    async def read(self, client: Any, red: CdnRedirect, offset: int, limit: int,
+                   master: Callable[[Any], Awaitable[Any]]) -> bytes:
+        """Байты [offset, offset+limit) документа с CDN, расшифрованные и проверенные.
+        master(request) — вызов на основном DC той же сессии (хеши, reupload)."""
+        g = red.hash_chunk
+        start = offset - offset % g
+        stop = offset + limit
+        stop += (-stop) % g  # проверять можно только целыми кусками file_hashes
+        try:
+            parts: List[bytes] = []
+            for off, lim in cdn_pieces(start, stop):
+                data = await self._piece(client, red, off, lim, master)
+                parts.append(data)
+                if len(data) < lim:
+                    break  # конец файла
+            raw = b"".join(parts)
+
+            missing = check_hashes(red, start, raw)
+            for pos in missing:
+                if pos not in red.hashes:
+                    red.add_hashes(await master(
+                        GetCdnFileHashesRequest(file_token=red.file_token, offset=pos)
+                    ))
+            if missing and check_hashes(red, start, raw):
+                raise CdnHashMismatch(f"no cdn hashes for offset {start}")
+        except CdnHashMismatch:
+            mark_tg_cdn_event("hash_fail")
+            raise
+        except (CdnError, FloodWaitError):
+            raise
+        except RPCError as e:
+            msg = _rpc_message(e)
+            if "TOKEN_INVALID" in msg:
+                mark_tg_cdn_event("token_expired")
+                raise CdnTokenExpired(msg) from e
+            raise CdnError(msg) from e
+        except (ConnectionError, OSError, asyncio.TimeoutError, ValueError) as e:
+            await self._drop_sender(client, red.dc_id)
+            raise CdnError(repr(e)) from e
+
+        add_tg_cdn_bytes(len(raw))
+        return raw[offset - start:offset - start + limit]
+
+    async def get_file(self, owner: str, client: Any, request: Any,
+                       send: Callable[[Any], Awaitable[Any]]) -> Any:
+        """GetFile(cdn_supported=True) с обработкой FileCdnRedirect. send(request) — вызов
+        на основном DC документа от имени owner; ответ — upload.File или CdnChunk."""
+        doc = _doc_id(request)
+        if doc is None:
+            return await send(request)
+        if not self.allowed(doc):
+            return await send(_without_cdn(request))
+
+        for _ in range(2):
+            red = self.lookup(owner, doc)
+            if red is None:
+                res = await send(request)
+                if not isinstance(res, FileCdnRedirect):
+                    return res
+                red = self.remember(owner, doc, res)
+            try:
+                return CdnChunk(await self.read(client, red, request.offset, request.limit, send))
+            except CdnTokenExpired:
+                self.forget(owner, doc)  # за свежим редиректом
+            except CdnError as e:
+                self.forget(owner, doc)
+                self.disable(doc)
+                mark_tg_cdn_event("fallback")
+                log.warning("cdn failed for doc %s via %s (%s), using main dc", doc, owner, e)
+                break
+        return await send(_without_cdn(request))
+
+    async def close(self) -> None:
+        for client_id, dc_id in list(self._senders):
+            sender = self._senders.pop((client_id, dc_id))
+            with suppress(Exception):
+                await sender.disconnect()
+        self._inited.clear()
+
+
+_default: Optional[CdnFetcher] = None
+
+
+def default_cdn() -> CdnFetcher:
+    global _default
+    if _default is None:
+        _default = CdnFetcher()
+    return _default
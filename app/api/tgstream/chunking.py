@@ -0,0 +1,51 @@
+# /home/ogma/ogma/app/api/tgstream/chunking.py
+from __future__ import annotations
+
+import os
+from typing import List, Tuple
+
+# Нарезка запросов upload.getFile с precise=True.
+#
+# Правила Telegram для precise: offset и limit кратны 1 KiB, limit ≤ 1 MiB, а запрос не
+# пересекает границу 1 MiB. Для seek'а внутрь блока первый ответ должен прийти как можно
+# быстрее, поэтому от точки seek (выровненной вниз до 4 KiB) до конца блока идём
+# нарастающими кусками: FIRST, 2·FIRST, 4·FIRST, … Дальше — обычные блоки по 512 KiB,
+# которые ложатся в дисковый кеш.
+
+KIB = 1024
+MIB = 1024 * KIB
+ALIGN = 4 * KIB  # кратно 1 KiB (precise) и 4 KiB (обычный режим) — годится для обоих
+FIRST_CHUNK = int(os.environ.get("TG_FIRST_CHUNK", str(64 * KIB)))
+
+
+def is_precise_legal(offset: int, limit: int) -> bool:
+    if offset < 0 or limit <= 0 or limit > MIB:
+        return False
+    if offset % KIB or limit % KIB:
+        return False
+    return offset // MIB == (offset + limit - 1) // MIB
+
+
+def ramp_pieces(start: int, end: int, block_size: int, first: int = FIRST_CHUNK) -> List[Tuple[int, int]]:
+    """(offset, limit) от start до конца его блока (или до end, если он раньше).
+
+    Пусто, если start уже на границе блока или ramp выключен (first ≤ 0) — тогда
+    выгоднее сразу тянуть целый блок, он пойдёт в кеш.
+    """
+    if first <= 0 or start % block_size == 0:
+        return []
+    first = max(ALIGN, first - first % ALIGN)
+    block_end = start - start % block_size + block_size
+    stop = min(block_end, end + 1)
+    stop += (-stop) % ALIGN  # хвост до 4 KiB — лишние байты обрежет вызывающий
+    stop = min(stop, block_end)
+
+    out: List[Tuple[int, int]] = []
+    off = start - start % ALIGN
+    size = first
+    while off < stop:
+        limit = min(size, stop - off)
+        out.append((off, limit))
+        off += limit
+        size = min(size * 2, block_size)
+    return out
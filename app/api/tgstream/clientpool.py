@@ -0,0 +1,231 @@
+# /home/ogma/ogma/app/api/tgstream/clientpool.py
+from __future__ import annotations
+
+import os
+import time
+import asyncio
+import logging
+from contextlib import suppress
+from dataclasses import dataclass, field
+from typing import Any, Callable, List, Optional
+
+# Пул Telegram-сессий для скачивания файлов.
+#
+# Каждый участник — авторизованный TelethonClient (основная сессия шлюза + сессии из
+# TG_POOL_SESSIONS). Запрос к документу уходит участнику с наименьшей нагрузкой, причём
+# участники, чей домашний DC совпадает с dc_id документа, идут первыми: им не нужен
+# экспортированный sender. Для чужого DC берётся exported sender этого клиента
+# (_borrow_exported_sender — Telethon сам кеширует и переиспользует соединение).
+#
+# FloodWait выключает участника на e.seconds и запрос сразу повторяется на другом;
+# наружу (в общий планировщик) FloodWait уходит, только когда свободных участников нет.
+# Ошибки авторизации выкидывают участника из пула насовсем. Фоновая проверка здоровья
+# переподключает отвалившихся и возвращает остывших.
+#
+# Если GetFile ответил FileCdnRedirect, байты достаются с CDN-DC (см. cdn.py): редирект
+# живёт на (участник, документ), хеши и reupload идут через того же участника.
+
+log = logging.getLogger("app.tgstream.clientpool")
+
+try:
+    from telethon.errors import (
+        AuthKeyError,
+        FloodWaitError,
+        FileMigrateError,
+        UnauthorizedError,
+    )
+except Exception:  # pragma: no cover
+    class FloodWaitError(Exception):  # type: ignore
+        seconds = 3
+
+    class FileMigrateError(Exception):  # type: ignore
+        new_dc = 0
+
+    class AuthKeyError(Exception):  # type: ignore
+        pass
+
+    class UnauthorizedError(Exception):  # type: ignore
+        pass
+
+from app.api.tgstream.cdn import CdnFetcher
+
+try:
+    from app.api.telemetry.metrics import set_tg_pool_members
+except Exception:
+    def set_tg_pool_members(state: str, n: int) -> None:  # type: ignore
+        pass
+
+FLOOD_STRIKES = int(os.environ.get("TG_POOL_FLOOD_STRIKES", "3"))  # подряд — и в долгий карантин
+STRIKE_COOLDOWN_S = float(os.environ.get("TG_POOL_STRIKE_COOLDOWN", "600"))
+HEALTH_INTERVAL_S = float(os.environ.get("TG_POOL_HEALTH_INTERVAL", "30"))
+
+
+@dataclass
+class Member:
+    client: Any
+    name: str
+    inflight: int = 0
+    served: int = 0
+    strikes: int = 0
+    cooling_until: float = 0.0
+    dead: bool = False
+    last_error: Optional[str] = None
+    exported: dict = field(default_factory=dict)  # dc_id → сколько раз брали sender
+
+    @property
+    def home_dc(self) -> Optional[int]:
+        with suppress(Exception):
+            return int(self.client.session.dc_id)
+        return None
+
+    def available(self, now: float) -> bool:
+        return not self.dead and now >= self.cooling_until
+
+
+class NoClientsAvailable(RuntimeError):
+    pass
+
+
+class ClientPool:
+    def __init__(self, cdn: Optional[CdnFetcher] = None) -> None:
+        self.members: List[Member] = []
+        self.cdn = cdn
+        self._flood_exc: Optional[BaseException] = None
+
+    def add(self, client: Any, name: str, owned: bool = True) -> Member:
+        """owned=False — клиент общий (основной _TG): его настройки не трогаем, короткие
+        FloodWait он выжидает сам, как и для остальных своих вызовов."""
+        if owned:
+            # FloodWait не должен проглатываться внутри Telethon — решаем сами
+            with suppress(Exception):
+                client.flood_sleep_threshold = 0
+        m = Member(client=client, name=name)
+        self.members.append(m)
+        self._export()
+        return m
+
+    def __len__(self) -> int:
+        return len(self.members)
+
+    def _export(self) -> None:
+        now = time.monotonic()
+        set_tg_pool_members("healthy", sum(1 for m in self.members if m.available(now)))
+        set_tg_pool_members("cooling", sum(1 for m in self.members if not m.dead and not m.available(now)))
+        set_tg_pool_members("dead", sum(1 for m in self.members if m.dead))
+
+    def pick(self, dc_id: Optional[int] = None, exclude: Optional[set] = None) -> Member:
+        now = time.monotonic()
+        cands = [m for m in self.members if m.available(now) and (not exclude or m.name not in exclude)]
+        if not cands:
+            raise NoClientsAvailable("no healthy telegram sessions")
+        # сначала «родной» DC, затем наименьшая нагрузка
+        return min(cands, key=lambda m: (0 if dc_id and m.home_dc == dc_id else 1, m.inflight, m.served))
+
+    async def _invoke(self, m: Member, request: Any, dc_id: Optional[int]) -> Any:
+        if self.cdn is not None and getattr(request, "cdn_supported", False):
+            return await self.cdn.get_file(m.name, m.client, request, lambda r: self._send(m, r, dc_id))
+        return await self._send(m, request, dc_id)
+
+    async def _send(self, m: Member, request: Any, dc_id: Optional[int]) -> Any:
+        client = m.client
+        if not dc_id or m.home_dc in (None, dc_id):
+            try:
+                return await client(request)
+            except FileMigrateError as e:
+                # dc_id в БД устарел — Telegram сам сказал, где файл
+                dc_id = int(getattr(e, "new_dc", 0) or 0)
+                if not dc_id:
+                    raise
+        sender = await client._borrow_exported_sender(dc_id)
+        m.exported[dc_id] = m.exported.get(dc_id, 0) + 1
+        try:
+            return await client._call(sender, request)
+        finally:
+            await client._return_exported_sender(sender)
+
+    async def call(self, request: Any, dc_id: Optional[int] = None) -> Any:
+        tried: set = set()
+        while True:
+            try:
+                m = self.pick(dc_id, tried)
+            except NoClientsAvailable:
+                # все живые остывают после FloodWait — пусть его выждет общий планировщик
+                if self._flood_exc is not None and any(not x.dead for x in self.members):
+                    raise self._flood_exc
+                raise
+            tried.add(m.name)
+            m.inflight += 1
+            try:
+                res = await self._invoke(m, request, dc_id)
+                m.served += 1
+                m.strikes = 0
+                return res
+            except FloodWaitError as e:
+                secs = float(getattr(e, "seconds", 3) or 3)
+                m.strikes += 1
+                m.cooling_until = time.monotonic() + max(secs, STRIKE_COOLDOWN_S if m.strikes >= FLOOD_STRIKES else 0)
+                m.last_error = f"FloodWait {secs:.0f}s"
+                self._flood_exc = e
+                log.warning("tg pool: %s flood wait %.0fs (strike %d), rerouting", m.name, secs, m.strikes)
+                self._export()
+                continue  # следующий участник; если их нет — FloodWait уйдёт наверх
+            except (AuthKeyError, UnauthorizedError) as e:
+                m.dead = True
+                m.last_error = e.__class__.__name__
+                log.error("tg pool: %s removed after auth error %r", m.name, e)
+                self._export()
+                continue
+            finally:
+                m.inflight -= 1
+
+    # --- здоровье ---
+    async def check(self) -> None:
+        for m in self.members:
+            if m.dead:
+                continue
+            try:
+                if not m.client.is_connected():
+                    await m.client.connect()
+                if not await m.client.is_user_authorized():
+                    m.dead = True
+                    m.last_error = "unauthorized"
+                    log.error("tg pool: %s is no longer authorized, removed", m.name)
+            except Exception as e:
+                m.last_error = repr(e)
+                log.warning("tg pool: health check of %s failed: %r", m.name, e)
+        self._export()
+
+    def status(self) -> List[dict]:
+        now = time.monotonic()
+        return [
+            {
+                "name": m.name,
+                "home_dc": m.home_dc,
+                "inflight": m.inflight,
+                "served": m.served,
+                "cooling_s": max(0, round(m.cooling_until - now)),
+                "dead": m.dead,
+                "last_error": m.last_error,
+            }
+            for m in self.members
+        ]
+
+
+async def _health_loop(pool: ClientPool, stop_evt: asyncio.Event) -> None:
+    while not stop_evt.is_set():
+        with suppress(Exception):
+            await pool.check()
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(stop_evt.wait(), timeout=max(5.0, HEALTH_INTERVAL_S))
+
+
+def start_health_checks(pool: ClientPool) -> Callable[[], None]:
+    """Запускает фоновую проверку; возвращает функцию остановки."""
+    stop_evt = asyncio.Event()
+    task = asyncio.create_task(_health_loop(pool, stop_evt), name="ogma-tg-pool-health")
+
+    def _stop() -> None:
+        stop_evt.set()
+        task.cancel()
+
+    return _stop
@@ -0,0 +1,99 @@
+# /home/ogma/ogma/app/api/tgstream/conditional.py
+from __future__ import annotations
+
+import os
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Dict, Mapping, Optional
+
+# Валидаторы для аудио-ответов (RFC 9110 §13).
+#
+# Байты Telegram-документа неизменны: новый файл = новый document id. Поэтому строгий
+# ETag строится из (doc_id, size) и одинаков во всех воркерах и на обоих шлюзах —
+# браузер/nginx могут ревалидировать трек и безопасно докачивать по If-Range.
+
+IMMUTABLE_MAX_AGE = int(os.environ.get("STREAM_IMMUTABLE_MAX_AGE", str(365 * 24 * 3600)))
+
+
+def etag_for(doc_id: int, size: int, start: int = 0) -> str:
+    """start — ответ /stream?t= начинается с этого байта документа: это другой ресурс."""
+    if start:
+        return f'"tg-{int(doc_id)}-{int(size)}-{int(start)}"'
+    return f'"tg-{int(doc_id)}-{int(size)}"'
+
+
+def http_date(dt: Optional[datetime]) -> Optional[str]:
+    if dt is None:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return format_datetime(dt.astimezone(timezone.utc), usegmt=True)
+
+
+def _parse_date(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        dt = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if dt is None:
+        return None
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+def _etags(header: str):
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag:
+            yield tag
+
+
+def none_match(header: Optional[str], etag: str) -> bool:
+    """If-None-Match совпал (слабое сравнение) — можно отвечать 304."""
+    if not header:
+        return False
+    bare = etag[2:] if etag.startswith("W/") else etag
+    for tag in _etags(header):
+        if tag == "*":
+            return True
+        if (tag[2:] if tag.startswith("W/") else tag) == bare:
+            return True
+    return False
+
+
+def not_modified(headers: Mapping[str, str], etag: str, last_modified: Optional[str]) -> bool:
+    inm = headers.get("if-none-match")
+    if inm is not None:
+        # при наличии If-None-Match дату не смотрим
+        return none_match(inm, etag)
+    ims = _parse_date(headers.get("if-modified-since"))
+    lm = _parse_date(last_modified)
+    return ims is not None and lm is not None and lm <= ims
+
+
+def range_allowed(headers: Mapping[str, str], etag: str, last_modified: Optional[str]) -> bool:
+    """If-Range: Range применяется, только если представление не изменилось.
+    ETag сравнивается строго; дата — на точное совпадение с Last-Modified."""
+    ir = (headers.get("if-range") or "").strip()
+    if not ir:
+        return True
+    if ir.startswith('"') or ir.startswith("W/"):
+        return not ir.startswith("W/") and ir == etag
+    return last_modified is not None and ir == last_modified
+
+
+def validator_headers(
+    etag: str, last_modified: Optional[str], immutable: bool = False, max_age: int = 0
+) -> Dict[str, str]:
+    """max_age — короткое кеширование для ответов, которые ещё могут улучшиться (не immutable)."""
+    out = {"ETag": etag}
+    if last_modified:
+        out["Last-Modified"] = last_modified
+    if immutable:
+        out["Cache-Control"] = f"public, max-age={IMMUTABLE_MAX_AGE}, immutable, no-transform"
+    elif max_age > 0:
+        out["Cache-Control"] = f"public, max-age={int(max_age)}, no-transform"
+    else:
+        out["Cache-Control"] = "no-transform"
+    return out
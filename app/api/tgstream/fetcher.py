@@ -0,0 +1,263 @@
+# /home/ogma/ogma/app/api/tgstream/fetcher.py
+from __future__ import annotations
+
+import os
+import json
+import base64
+import struct
+import asyncio
+import logging
+from contextlib import suppress
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+
+from app.api.tgstream.locations import DocLocation
+
+# Общий фетчер Telegram для нескольких воркеров uvicorn.
+#
+# Без него каждый воркер держит свою Telethon-сессию (<base>.<PID>.session), свой пул,
+# свой single-flight и свой планировщик — восемь воркеров = восемь соединений MTProto и
+# до восьми GetFile одного и того же блока. Демон (fetcherd.py) владеет сессиями, блочным
+# кешем, single-flight и планировщиком; воркеры ходят к нему через Unix-сокет.
+#
+# Протокол: одно соединение — один запрос.
+#   → строка JSON: {"op": "read"|"locate"|"join"|"status", ...}\n
+#   ← строка JSON: {"ok": true, ...} или {"ok": false, "status": 429, "detail": "..."}\n
+#   для read после заголовка идут кадры: u32 big-endian длина + байты; длина 0 — конец,
+#   длина 0xFFFFFFFF — ошибка посреди потока, за ней строка JSON как выше.
+
+log = logging.getLogger("app.tgstream.fetcher")
+
+SOCKET_PATH = os.environ.get("TG_FETCHER_SOCKET", "").strip()
+CONNECT_TIMEOUT_S = float(os.environ.get("TG_FETCHER_CONNECT_TIMEOUT", "2"))
+LINE_LIMIT = 1 << 20
+
+_FRAME = struct.Struct(">I")
+_END = 0
+_ERROR = 0xFFFFFFFF
+
+
+class FetcherError(Exception):
+    """Ошибка, пришедшая от демона: status — HTTP-код, который стоит отдать клиенту."""
+
+    def __init__(self, status: int, detail: str, retry_after: Optional[float] = None):
+        super().__init__(f"{status}: {detail}")
+        self.status = int(status)
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+def loc_to_wire(loc: DocLocation) -> Dict[str, Any]:
+    return {
+        "chat": loc.chat_username,
+        "msg_id": int(loc.msg_id),
+        "doc_id": int(loc.doc_id),
+        "access_hash": int(loc.access_hash),
+        "file_ref": base64.b64encode(loc.file_ref).decode("ascii"),
+        "dc_id": int(loc.dc_id),
+        "size": int(loc.size),
+        "mime": loc.mime,
+        "duration_s": int(loc.duration_s),
+    }
+
+
+def loc_from_wire(d: Dict[str, Any]) -> DocLocation:
+    return DocLocation(
+        chat_username=d["chat"],
+        msg_id=int(d["msg_id"]),
+        doc_id=int(d["doc_id"]),
+        access_hash=int(d["access_hash"]),
+        file_ref=base64.b64decode(d["file_ref"]),
+        dc_id=int(d.get("dc_id") or 0),
+        size=int(d.get("size") or 0),
+        mime=d.get("mime"),
+        duration_s=int(d.get("duration_s") or 0),
+    )
+
+
+async def _read_json(reader: asyncio.StreamReader) -> Dict[str, Any]:
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("fetcher closed the connection")
+    return json.loads(line)
+
+
+def _write_json(writer: asyncio.StreamWriter, obj: Dict[str, Any]) -> None:
+    writer.write(json.dumps(obj, separators=(",", ":")).encode() + b"\n")
+
+
+def _raise_for(head: Dict[str, Any]) -> None:
+    if not head.get("ok"):
+        raise FetcherError(int(head.get("status") or 502), str(head.get("detail") or "fetcher error"),
+                           head.get("retry_after"))
+
+
+# --- клиент (воркер) ---
+class FetcherClient:
+    def __init__(self, path: str):
+        self.path = path
+
+    async def _open(self, request: Dict[str, Any]):
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_unix_connection(self.path, limit=LINE_LIMIT), CONNECT_TIMEOUT_S
+            )
+        except (OSError, asyncio.TimeoutError) as e:
+            raise FetcherError(502, f"telegram fetcher unavailable: {e!r}") from e
+        _write_json(writer, request)
+        await writer.drain()
+        return reader, writer
+
+    async def _call(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        reader, writer = await self._open(request)
+        try:
+            head = await _read_json(reader)
+        finally:
+            writer.close()
+            with suppress(Exception):
+                await writer.wait_closed()
+        _raise_for(head)
+        return head
+
+    async def locate(self, chat: str, msg_id: int, priority: int, fresh: bool = False) -> DocLocation:
+        head = await self._call({"op": "locate", "chat": chat, "msg_id": int(msg_id),
+                                 "priority": priority, "fresh": fresh})
+        return loc_from_wire(head["loc"])
+
+    async def join(self, chat: str) -> None:
+        await self._call({"op": "join", "chat": chat})
+
+    async def status(self) -> Dict[str, Any]:
+        return await self._call({"op": "status"})
+
+    async def read(self, loc: DocLocation, start: int, end: int, priority: int,
+                   peers: bool = True) -> AsyncIterator[bytes]:
+        """Байты [start, end] документа. Закрытие генератора рвёт соединение — демон
+        перестаёт качать (его окно упирается в drain()). peers=False — не ходить к
+        узлу-владельцу (запрос уже пришёл от соседа)."""
+        reader, writer = await self._open({"op": "read", "loc": loc_to_wire(loc), "start": int(start),
+                                           "end": int(end), "priority": priority, "peers": peers})
+        try:
+            _raise_for(await _read_json(reader))
+            while True:
+                (n,) = _FRAME.unpack(await reader.readexactly(_FRAME.size))
+                if n == _END:
+                    return
+                if n == _ERROR:
+                    _raise_for(await _read_json(reader))
+                    raise FetcherError(502, "fetcher stream failed")
+                yield await reader.readexactly(n)
+        except asyncio.IncompleteReadError as e:
+            raise FetcherError(502, "telegram fetcher dropped the stream") from e
+        finally:
+            writer.close()
+            with suppress(Exception):
+                await writer.wait_closed()
+
+
+_client: Optional[FetcherClient] = None
+
+
+def default_client() -> Optional[FetcherClient]:
+    """Клиент демона, если задан TG_FETCHER_SOCKET; иначе None — воркер ходит в Telegram сам."""
+    global _client
+    if _client is None and SOCKET_PATH:
+        _client = FetcherClient(SOCKET_PATH)
+    return _client
+
+
+# --- сервер (демон) ---
+Handler = Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]
+ReadHandler = Callable[[DocLocation, int, int, int, bool], AsyncIterator[bytes]]
+ErrorMapper = Callable[[BaseException], Dict[str, Any]]
+
+
+def _default_error(e: BaseException) -> Dict[str, Any]:
+    return {"ok": False, "status": 502, "detail": f"{e.__class__.__name__}: {e}"}
+
+
+class FetcherServer:
+    def __init__(self, path: str, read: ReadHandler, handlers: Dict[str, Handler],
+                 error: ErrorMapper = _default_error):
+        self.path = path
+        self.read = read
+        self.handlers = handlers
+        self.error = error
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        with suppress(FileNotFoundError):
+            os.unlink(self.path)  # сокет от прошлого запуска
+        d = os.path.dirname(self.path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        self._server = await asyncio.start_unix_server(self._serve, path=self.path, limit=LINE_LIMIT)
+        os.chmod(self.path, 0o660)
+        log.info("telegram fetcher listening on %s", self.path)
+
+    async def serve_forever(self) -> None:
+        assert self._server is not None
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        with suppress(FileNotFoundError):
+            os.unlink(self.path)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            req = await _read_json(reader)
+            if req.get("op") == "read":
+                await self._serve_read(req, writer)
+            else:
+                handler = self.handlers.get(str(req.get("op")))
+                if handler is None:
+                    _write_json(writer, {"ok": False, "status": 400, "detail": f"unknown op {req.get('op')!r}"})
+                else:
+                    try:
+                        out = await handler(req)
+                    except Exception as e:
+                        out = self.error(e)
+                    _write_json(writer, out)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # воркер ушёл
+        except Exception as e:
+            log.warning("fetcher request failed: %r", e)
+        finally:
+            writer.close()
+            with suppress(Exception):
+                await writer.wait_closed()
+
+    async def _serve_read(self, req: Dict[str, Any], writer: asyncio.StreamWriter) -> None:
+        loc = loc_from_wire(req["loc"])
+        agen = self.read(loc, int(req["start"]), int(req["end"]), int(req.get("priority", 0)),
+                         bool(req.get("peers", True)))
+        started = False
+        try:
+            async for chunk in agen:
+                if not started:
+                    _write_json(writer, {"ok": True})
+                    started = True
+                if chunk:
+                    writer.write(_FRAME.pack(len(chunk)))
+                    writer.write(chunk)
+                    await writer.drain()  # медленный воркер тормозит и демона
+            if not started:
+                _write_json(writer, {"ok": True})
+            writer.write(_FRAME.pack(_END))
+            await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            raise
+        except Exception as e:
+            if started:
+                writer.write(_FRAME.pack(_ERROR))
+            _write_json(writer, self.error(e))
+            with suppress(ConnectionError):
+                await writer.drain()
+        finally:
+            with suppress(Exception):
+                await agen.aclose()
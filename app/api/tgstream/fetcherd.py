@@ -0,0 +1,128 @@
+# /home/ogma/ogma/app/api/tgstream/fetcherd.py
+from __future__ import annotations
+
+import os
+import signal
+import asyncio
+import logging
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Dict, Optional
+
+import asyncpg
+from dotenv import load_dotenv
+
+# Демон-фетчер Telegram: одна копия Telethon-сессий, пула, планировщика, single-flight и
+# блочного кеша на машину. Воркеры API (TG_FETCHER_SOCKET) ходят сюда вместо Telegram.
+#
+#   python -m app.api.tgstream.fetcherd
+#
+# Внутри — тот же код, что у воркера в одиночном режиме (stream_gateway), просто с
+# локальным Telegram: запросы всех воркеров сходятся в одном single-flight и одной очереди.
+
+load_dotenv("/home/ogma/ogma/stream/.env")
+
+from app.api import stream_gateway as sg  # noqa: E402
+from app.api.tgstream.fetcher import SOCKET_PATH, FetcherServer, loc_to_wire  # noqa: E402
+from app.api.tgstream.cachemgr import start_cache_manager, stop_cache_manager  # noqa: E402
+from app.api.tgstream.locations import DocLocation  # noqa: E402
+
+log = logging.getLogger("app.tgstream.fetcherd")
+
+# демон сам и есть фетчер — никаких походов к сокету
+sg._FETCHER = None
+
+_db: Optional[asyncpg.Pool] = None
+
+
+def _error(e: BaseException) -> Dict[str, Any]:
+    if isinstance(e, sg.HTTPException):
+        return {"ok": False, "status": e.status_code, "detail": str(e.detail)}
+    if isinstance(e, sg.FloodWaitError):
+        secs = getattr(e, "seconds", 3)
+        return {"ok": False, "status": 429, "detail": f"Telegram rate limit, wait {secs}s", "retry_after": secs}
+    if isinstance(e, sg.FileReferenceExpiredError):
+        return {"ok": False, "status": 502, "detail": "file reference expired"}
+    return {"ok": False, "status": 502, "detail": f"Telegram upstream error: {e.__class__.__name__}"}
+
+
+def _read(loc: DocLocation, start: int, end: int, priority: int, peers: bool) -> AsyncIterator[bytes]:
+    # у демона file_reference может быть свежее, чем у воркера
+    cached = sg._loc_cache().get(loc.key)
+    if cached is not None and cached.doc_id == loc.doc_id:
+        loc = cached
+    return sg._tg_byte_iter(loc, start, end, _db, priority, peers)
+
+
+async def _locate(req: Dict[str, Any]) -> Dict[str, Any]:
+    chat, msg_id = str(req["chat"]), int(req["msg_id"])
+    priority = int(req.get("priority", sg.PRIO_STREAM))
+    cached = sg._loc_cache().get((chat, msg_id))
+    if cached is not None and not req.get("fresh"):
+        loc = cached
+    else:
+        loc = await sg._fetch_location(chat, msg_id, priority)
+        sg._loc_cache().put(loc)
+        if _db is not None:
+            asyncio.create_task(sg.persist_location(_db, loc))
+    return {"ok": True, "loc": loc_to_wire(loc)}
+
+
+async def _join(req: Dict[str, Any]) -> Dict[str, Any]:
+    await sg._ensure_join(str(req["chat"]))
+    return {"ok": True}
+
+
+async def _status(req: Dict[str, Any]) -> Dict[str, Any]:
+    sched = sg._sched()
+    pool = sg._POOL
+    return {
+        "ok": True,
+        "pid": os.getpid(),
+        "queued": sched.queued(),
+        "inflight": sched.inflight,
+        "flood_remaining": round(sched.flood_remaining(), 1),
+        "sessions": pool.status() if pool is not None else [],
+    }
+
+
+async def main() -> None:
+    global _db
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+    if not SOCKET_PATH:
+        raise SystemExit("TG_FETCHER_SOCKET is not set")
+
+    dsn = os.environ.get("PG_DSN")
+    if dsn:
+        # только для сохранения освежённых file_reference в tracks
+        _db = await asyncpg.create_pool(dsn, min_size=1, max_size=4)
+
+    await sg._ensure_pool()
+    state = SimpleNamespace(state=SimpleNamespace())
+    await start_cache_manager(state)
+
+    server = FetcherServer(
+        SOCKET_PATH,
+        read=_read,
+        handlers={"locate": _locate, "join": _join, "status": _status},
+        error=_error,
+    )
+    await server.start()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    serving = asyncio.create_task(server.serve_forever())
+    try:
+        await stop.wait()
+    finally:
+        serving.cancel()
+        await server.close()
+        await stop_cache_manager(state)
+        await sg.close_tg()
+        if _db is not None:
+            await _db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
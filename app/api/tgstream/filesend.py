@@ -0,0 +1,141 @@
+# /home/ogma/ogma/app/api/tgstream/filesend.py
+from __future__ import annotations
+
+import os
+import asyncio
+from typing import Mapping, Optional
+from urllib.parse import quote
+
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+# Отдача диапазона файла с диска, не блокируя event loop.
+#
+# Если ASGI-сервер умеет расширение "http.response.zerocopysend" — отдаём ему fd,
+# и байты уходят через sendfile(2) без копирования в userspace. Иначе (uvicorn)
+# читаем кусками через os.pread в пуле потоков: медленный диск тормозит только свой
+# ответ, а не весь воркер. Файл открывается в конструкторе: если его успели вытеснить,
+# вызывающий получит OSError ещё до отправки заголовков и сможет уйти в Telegram.
+#
+# Режим offload (STREAM_OFFLOAD=accel|sendfile): шлюз проверяет трек, Range и кеш, а байты
+# отдаёт фронтовой сервер — nginx по X-Accel-Redirect во internal location (sendfile,
+# Range считает сам по исходному заголовку клиента), apache/lighttpd — по X-Sendfile.
+# Пример для nginx при STREAM_OFFLOAD_PREFIX=/_ogma_media/ и корне кеша /srv/media-cache:
+#     location /_ogma_media/ {
+#         internal; alias /srv/media-cache/;
+#         etag off; if_modified_since off;
+#         add_header ETag $upstream_http_etag;
+#         add_header Last-Modified $upstream_http_last_modified;
+#     }
+# ETag/Last-Modified шлюза уходят в ответе вместе с X-Accel-Redirect; без add_header nginx
+# подставил бы свои (mtime/размер), и If-Range не совпадал бы между режимами
+# (docs/stream-offload.md).
+
+SEND_CHUNK = 256 * 1024
+
+OFFLOAD = (os.environ.get("STREAM_OFFLOAD", "") or "").strip().lower()  # "" | accel | sendfile
+OFFLOAD_PREFIX = "/" + (os.environ.get("STREAM_OFFLOAD_PREFIX", "/_ogma_media/") or "").strip("/") + "/"
+OFFLOAD_ROOT = os.path.abspath(
+    (os.environ.get("STREAM_OFFLOAD_ROOT", "") or "").strip()
+    or os.environ.get("CACHE_DIR", "/home/ogma/ogma/stream/media-cache")
+)
+
+
+class FileRangeResponse(Response):
+    def __init__(
+        self,
+        path: str,
+        start: int,
+        end: int,
+        status_code: int = 200,
+        headers: Optional[Mapping[str, str]] = None,
+        media_type: Optional[str] = None,
+    ):
+        self.path = path
+        self.start = int(start)
+        self.end = int(end)
+        self._fd: Optional[int] = None
+        # открытый fd держит inode живым, даже если менеджер кеша удалит файл посреди ответа
+        self._fd = os.open(path, os.O_RDONLY)
+        self.status_code = status_code
+        self.media_type = media_type
+        self.background = None
+        self.body = b""
+        hdrs = dict(headers or {})
+        hdrs["Content-Length"] = str(self.end - self.start + 1)
+        self.init_headers(hdrs)
+
+    def close(self) -> None:
+        fd, self._fd = self._fd, None
+        if fd is not None:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def __del__(self) -> None:
+        self.close()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        fd = self._fd
+        try:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            if scope.get("method", "GET").upper() == "HEAD" or fd is None:
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+                return
+
+            count = self.end - self.start + 1
+            if "http.response.zerocopysend" in scope.get("extensions", {}):
+                await send({"type": "http.response.zerocopysend", "file": fd, "offset": self.start, "count": count})
+                return
+
+            offset = self.start
+            left = count
+            while left > 0:
+                data = await asyncio.to_thread(os.pread, fd, min(SEND_CHUNK, left), offset)
+                if not data:
+                    break
+                offset += len(data)
+                left -= len(data)
+                await send({"type": "http.response.body", "body": data, "more_body": left > 0})
+            if left > 0:
+                # файл оказался короче заявленного — закрываем тело, клиент увидит обрыв
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            self.close()
+
+
+def _offload_target(path: str) -> Optional[str]:
+    full = os.path.abspath(path)
+    if OFFLOAD == "sendfile":
+        return full
+    if OFFLOAD == "accel":
+        rel = os.path.relpath(full, OFFLOAD_ROOT)
+        if rel.startswith(".."):
+            return None  # файл вне alias'а nginx — отдадим сами
+        return OFFLOAD_PREFIX + quote(rel.replace(os.sep, "/"))
+    return None
+
+
+def cached_file_response(
+    path: str,
+    start: int,
+    end: int,
+    status_code: int = 200,
+    headers: Optional[Mapping[str, str]] = None,
+    media_type: Optional[str] = None,
+    offload: bool = True,
+) -> Response:
+    """Ответ для диапазона, целиком лежащего в файле кеша. Бросает OSError, если файла нет.
+    offload=False — отдаём сами: фронт считает Range клиента от начала файла, а у ответа
+    может быть своё начало (поток с ?t=)."""
+    target = _offload_target(path) if offload else None
+    if target is None:
+        return FileRangeResponse(path, start, end, status_code=status_code, headers=headers, media_type=media_type)
+
+    os.stat(path)  # вытесненный файл → OSError, пусть вызывающий идёт в Telegram
+    hdrs = {k: v for k, v in (headers or {}).items() if k.lower() not in {"content-length", "content-range"}}
+    hdrs["X-Accel-Redirect" if OFFLOAD == "accel" else "X-Sendfile"] = target
+    # статус, длину и Content-Range nginx выставит сам по Range клиента; ETag и Last-Modified
+    # остаются шлюзовые — internal location отдаёт их через add_header
+    return Response(status_code=200, headers=hdrs, media_type=media_type)
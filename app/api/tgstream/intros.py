@@ -0,0 +1,38 @@
+# /home/ogma/ogma/app/api/tgstream/intros.py
+from __future__ import annotations
+
+import os
+import logging
+from typing import Optional
+
+import asyncpg
+
+# Интро-стор: первые STREAM_INTRO_KB документа, сохранённые индексатором (track_intros).
+#
+# У холодного трека первый байт ждёт GetFile из Telegram. Если начало запрошенного
+# диапазона попадает в интро, шлюз сразу отдаёт его из БД, а блоки с нулевого тянутся
+# параллельно — к моменту, когда интро доиграет, первый блок уже в пути.
+
+log = logging.getLogger("app.tgstream.intros")
+
+ENABLED = os.environ.get("STREAM_INTRO", "1").strip().lower() not in {"0", "false", "no", "off", ""}
+MAX_BYTES = int(os.environ.get("STREAM_INTRO_KB", "128")) * 1024  # индексатор пишет столько же
+
+_missing_table = False
+
+
+async def load_intro(pool: Optional[asyncpg.Pool], doc_id: int) -> Optional[bytes]:
+    """Интро документа или None (выключено, нет строки, нет таблицы, БД недоступна)."""
+    global _missing_table
+    if not ENABLED or pool is None or _missing_table:
+        return None
+    try:
+        data = await pool.fetchval("select data from track_intros where doc_id=$1", int(doc_id))
+    except asyncpg.UndefinedTableError:
+        log.warning("track_intros is missing (sql/011_track_intros.sql not applied): intros disabled")
+        _missing_table = True
+        return None
+    except Exception as e:
+        log.debug("intro lookup failed doc=%s: %r", doc_id, e)
+        return None
+    return bytes(data) if data else None
@@ -0,0 +1,164 @@
+# /home/ogma/ogma/app/api/tgstream/locations.py
+from __future__ import annotations
+
+import os
+from collections import OrderedDict
+from contextlib import suppress
+from dataclasses import dataclass
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+import asyncpg
+from telethon.tl.types import InputDocumentFileLocation
+
+# Кеш расположений Telegram-документов: LRU в процессе → колонки tracks (tg_*) → Telegram.
+# Третий уровень (get_messages) живёт в stream_gateway, здесь только первые два.
+
+LOC_CACHE_MAX = int(os.environ.get("TG_LOCATION_CACHE_MAX", "5000"))
+
+LocKey = Tuple[str, int]
+
+
+@dataclass(frozen=True)
+class DocLocation:
+    chat_username: str
+    msg_id: int
+    doc_id: int
+    access_hash: int
+    file_ref: bytes
+    dc_id: int
+    size: int = 0
+    mime: Optional[str] = None
+    duration_s: int = 0  # из DocumentAttributeAudio / tracks.duration_s; 0 — неизвестна
+
+    @property
+    def key(self) -> LocKey:
+        return (self.chat_username, int(self.msg_id))
+
+    def input_location(self) -> InputDocumentFileLocation:
+        return InputDocumentFileLocation(
+            id=self.doc_id,
+            access_hash=self.access_hash,
+            file_reference=self.file_ref,
+            thumb_size="",
+        )
+
+
+def _doc_duration(doc: Any) -> int:
+    for attr in getattr(doc, "attributes", None) or ():
+        duration = getattr(attr, "duration", None)
+        if duration:
+            return int(duration)
+    return 0
+
+
+def location_from_document(chat_username: str, msg_id: int, doc: Any) -> DocLocation:
+    return DocLocation(
+        chat_username=chat_username,
+        msg_id=int(msg_id),
+        doc_id=int(doc.id),
+        access_hash=int(doc.access_hash),
+        file_ref=bytes(doc.file_reference or b""),
+        dc_id=int(getattr(doc, "dc_id", 0) or 0),
+        size=int(getattr(doc, "size", 0) or 0),
+        mime=getattr(doc, "mime_type", None),
+        duration_s=_doc_duration(doc),
+    )
+
+
+def location_from_row(row: Mapping[str, Any]) -> Optional[DocLocation]:
+    """Строит DocLocation из строки tracks, если индексатор уже сохранил tg_* колонки."""
+    doc_id = row.get("tg_document_id")
+    access_hash = row.get("tg_access_hash")
+    file_ref = row.get("tg_file_ref")
+    if not (doc_id and access_hash and file_ref):
+        return None
+    return DocLocation(
+        chat_username=row["chat_username"],
+        msg_id=int(row["tg_msg_id"]),
+        doc_id=int(doc_id),
+        access_hash=int(access_hash),
+        file_ref=bytes(file_ref),
+        dc_id=int(row.get("tg_dc_id") or 0),
+        size=int(row.get("size_bytes") or 0),
+        mime=row.get("mime"),
+        duration_s=int(row.get("duration_s") or 0),
+    )
+
+
+class LocationCache:
+    """Простой LRU на OrderedDict: (chat_username, msg_id) → DocLocation."""
+
+    def __init__(self, max_items: int = LOC_CACHE_MAX):
+        self._max = max(1, int(max_items))
+        self._items: "OrderedDict[LocKey, DocLocation]" = OrderedDict()
+        self._by_doc: Dict[int, LocKey] = {}
+
+    def get(self, key: LocKey) -> Optional[DocLocation]:
+        loc = self._items.get(key)
+        if loc is not None:
+            self._items.move_to_end(key)
+        return loc
+
+    def get_doc(self, doc_id: int) -> Optional[DocLocation]:
+        key = self._by_doc.get(int(doc_id))
+        return self.get(key) if key is not None else None
+
+    def put(self, loc: DocLocation) -> None:
+        old = self._items.get(loc.key)
+        if old is not None and self._by_doc.get(int(old.doc_id)) == loc.key:
+            del self._by_doc[int(old.doc_id)]
+        self._items[loc.key] = loc
+        self._items.move_to_end(loc.key)
+        self._by_doc[int(loc.doc_id)] = loc.key
+        while len(self._items) > self._max:
+            _, gone = self._items.popitem(last=False)  # самый старый
+            self._drop_doc(gone)
+
+    def invalidate(self, key: LocKey) -> None:
+        gone = self._items.pop(key, None)
+        if gone is not None:
+            self._drop_doc(gone)
+
+    def _drop_doc(self, loc: DocLocation) -> None:
+        if self._by_doc.get(int(loc.doc_id)) == loc.key:
+            del self._by_doc[int(loc.doc_id)]
+
+    def clear(self) -> None:
+        self._items.clear()
+        self._by_doc.clear()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+_cache = LocationCache()
+
+
+def cache() -> LocationCache:
+    return _cache
+
+
+async def persist_location(pool: asyncpg.Pool, loc: DocLocation) -> None:
+    """Сохраняет свежий file_reference в tracks, чтобы следующий процесс не ходил в Telegram."""
+    sql = """
+      UPDATE tracks
+         SET tg_document_id = $3,
+             tg_access_hash = $4,
+             tg_file_ref    = $5,
+             tg_dc_id       = $6,
+             size_bytes     = COALESCE(NULLIF($7, 0), size_bytes),
+             mime           = COALESCE(mime, $8)
+       WHERE chat_username = $1 AND tg_msg_id = $2
+    """
+    with suppress(Exception):
+        await pool.execute(
+            sql,
+            loc.chat_username,
+            int(loc.msg_id),
+            int(loc.doc_id),
+            int(loc.access_hash),
+            loc.file_ref,
+            int(loc.dc_id),
+            int(loc.size),
+            loc.mime,
+        )
@@ -0,0 +1,126 @@
+# /home/ogma/ogma/app/api/tgstream/memcache.py
+from __future__ import annotations
+
+import os
+import logging
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+# In-memory LRU горячих блоков над дисковым кешем.
+#
+# Первый блок (ID3-заголовок и начало аудио) у топовых треков читается постоянно — при
+# каждом старте и каждом пробинге плеера. Держим такие блоки в памяти процесса с жёстким
+# бюджетом STREAM_MEM_CACHE_MB. Значения — неизменяемые bytes: параллельные читатели
+# получают один и тот же объект, а диапазоны режутся через memoryview без копий.
+#
+# Допуск: первые STREAM_MEM_CACHE_HEAD_BLOCKS блоков документа попадают в LRU сразу,
+# остальные — со второго обращения (ключи первых обращений помнит небольшой «призрак»),
+# чтобы линейное проигрывание длинного трека не вымывало горячие головы.
+
+log = logging.getLogger("app.tgstream.memcache")
+
+try:
+    from app.api.telemetry.metrics import (
+        mark_stream_memcache_lookup,
+        mark_stream_memcache_evicted,
+        set_stream_memcache_bytes,
+    )
+except Exception:
+    def mark_stream_memcache_lookup(hit: bool) -> None:  # type: ignore
+        pass
+
+    def mark_stream_memcache_evicted(n_bytes: int) -> None:  # type: ignore
+        pass
+
+    def set_stream_memcache_bytes(n_bytes: int) -> None:  # type: ignore
+        pass
+
+MAX_BYTES = int(float(os.environ.get("STREAM_MEM_CACHE_MB", "64")) * 1024 * 1024)  # 0 — выключено
+HEAD_BLOCKS = int(os.environ.get("STREAM_MEM_CACHE_HEAD_BLOCKS", "1"))
+GHOST_ITEMS = 4096
+
+Key = Tuple[int, int]  # (doc_id, номер блока)
+
+
+class ChunkLRU:
+    def __init__(self, max_bytes: int = MAX_BYTES, head_blocks: int = HEAD_BLOCKS, ghost_items: int = GHOST_ITEMS):
+        self.max_bytes = max(0, int(max_bytes))
+        self.head_blocks = max(0, int(head_blocks))
+        self.ghost_items = max(0, int(ghost_items))
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._items: "OrderedDict[Key, bytes]" = OrderedDict()
+        self._ghost: "OrderedDict[Key, None]" = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, key: Key) -> bool:
+        return key in self._items
+
+    def get(self, key: Key) -> Optional[bytes]:
+        if not self.enabled:
+            return None
+        data = self._items.get(key)
+        if data is None:
+            self.misses += 1
+            mark_stream_memcache_lookup(False)
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        mark_stream_memcache_lookup(True)
+        return data
+
+    def peek(self, key: Key) -> Optional[bytes]:
+        """Без учёта в статистике и без продвижения в LRU."""
+        return self._items.get(key)
+
+    def offer(self, key: Key, data: bytes) -> bool:
+        """Блок прочитан с диска/из Telegram — кладём, если он прошёл допуск."""
+        if not self.enabled or not data or len(data) > self.max_bytes:
+            return False
+        if key in self._items:
+            self._items.move_to_end(key)
+            return True
+        if key[1] >= self.head_blocks:
+            if key not in self._ghost:
+                self._ghost[key] = None
+                while len(self._ghost) > self.ghost_items:
+                    self._ghost.popitem(last=False)
+                return False
+            del self._ghost[key]
+        data = bytes(data)  # bytearray/memoryview → неизменяемый объект, который можно раздавать
+        self._items[key] = data
+        self.bytes += len(data)
+        freed = 0
+        while self.bytes > self.max_bytes:
+            _, old = self._items.popitem(last=False)
+            self.bytes -= len(old)
+            freed += len(old)
+        if freed:
+            self.evicted += freed
+            mark_stream_memcache_evicted(freed)
+        set_stream_memcache_bytes(self.bytes)
+        return True
+
+    def clear(self) -> None:
+        self._items.clear()
+        self._ghost.clear()
+        self.bytes = 0
+        set_stream_memcache_bytes(0)
+
+
+_default: Optional[ChunkLRU] = None
+
+
+def default_memcache() -> ChunkLRU:
+    global _default
+    if _default is None:
+        _default = ChunkLRU()
+    return _default
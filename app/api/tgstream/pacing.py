@@ -0,0 +1,67 @@
+# /home/ogma/ogma/app/api/tgstream/pacing.py
+from __future__ import annotations
+
+import os
+import time
+from typing import Callable, Optional
+
+# Темп докачки по проигрыванию.
+#
+# Плеер забирает поток так быстро, как успевает сокет, и без ограничений _tg_byte_iter
+# вытянул бы из Telegram весь трек за секунды — даже если слушатель через 20 секунд
+# нажмёт паузу или «дальше». Здесь считаем битрейт как size_bytes / duration_s и не
+# ставим запрос в Telegram к блоку, который дальше STREAM_PACE_AHEAD_S секунд от позиции
+# проигрывания. Позиция — меньшее из «сколько секунд звука клиент уже получил» и «сколько
+# прошло с первого байта»: плеер не играет быстрее реального времени.
+#
+# Блоки из памяти/диска не ограничиваются — трафика Telegram они не стоят. Скачивания,
+# префетч и прогрев (классы bulk/background) идут без темпа.
+
+AHEAD_S = float(os.environ.get("STREAM_PACE_AHEAD_S", "45"))  # 0 — не ограничивать
+MIN_DURATION_S = 5
+
+
+class PlaybackPacer:
+    def __init__(
+        self,
+        bitrate: float,
+        ahead_s: float = AHEAD_S,
+        min_ahead: int = 0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.bitrate = float(bitrate)  # байт в секунду
+        self.ahead_s = float(ahead_s)
+        self.min_ahead = int(min_ahead)
+        self.clock = clock
+        self.t0: Optional[float] = None
+
+    @classmethod
+    def for_track(
+        cls, size: int, duration_s: Optional[int], ahead_s: float = AHEAD_S, min_ahead: int = 0
+    ) -> Optional["PlaybackPacer"]:
+        """None — темп не нужен или неизвестен (нет длительности, выключено)."""
+        if ahead_s <= 0 or not size or not duration_s or duration_s < MIN_DURATION_S:
+            return None
+        return cls(size / float(duration_s), ahead_s, min_ahead)
+
+    def started(self) -> None:
+        """Клиент получил первый байт — с этого момента идёт время проигрывания."""
+        if self.t0 is None:
+            self.t0 = self.clock()
+
+    def position_s(self, delivered: int) -> float:
+        elapsed = 0.0 if self.t0 is None else self.clock() - self.t0
+        return min(delivered / self.bitrate, elapsed)
+
+    def limit(self, delivered: int) -> int:
+        """Сколько байт от начала ответа можно уже запрашивать у Telegram."""
+        return max(self.min_ahead, int(self.bitrate * (self.position_s(delivered) + self.ahead_s)))
+
+    def allows(self, offset: int, delivered: int) -> bool:
+        return offset < self.limit(delivered)
+
+    def delay(self, offset: int, delivered: int) -> float:
+        """Через сколько секунд offset войдёт в окно, если клиент не отстаёт."""
+        if self.allows(offset, delivered):
+            return 0.0
+        return max(0.0, offset / self.bitrate - self.ahead_s - self.position_s(delivered))
@@ -0,0 +1,229 @@
+# /home/ogma/ogma/app/api/tgstream/peers.py
+from __future__ import annotations
+
+import os
+import json
+import time
+import base64
+import asyncio
+import hashlib
+import logging
+from bisect import bisect
+from contextlib import suppress
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+if TYPE_CHECKING:
+    from app.api.tgstream.locations import DocLocation
+
+# Шардирование треков между несколькими узлами шлюза.
+#
+# STREAM_NODES — базовые URL всех узлов (с префиксом API, например http://10.0.0.2:8080/api),
+# STREAM_NODE_SELF — свой URL из этого списка. Документ принадлежит узлу по consistent hash
+# от doc_id (кольцо с виртуальными узлами). Не-владелец берёт блоки у владельца
+# (GET <owner>/_peer/block/...) и к себе на диск их не пишет — каждый трек лежит в кеше
+# одного узла, и суммарная ёмкость кеша растёт с числом узлов. В Telegram не-владелец
+# идёт сам, только если владелец недоступен.
+#
+# Соседи проверяются фоном (GET <node>/_peer/health); упавший узел выпадает из кольца, его
+# документы переходят к следующим по кругу узлам, а после возврата — обратно к нему.
+
+log = logging.getLogger("app.tgstream.peers")
+
+try:
+    from app.api.telemetry.metrics import set_stream_peer_up
+except Exception:
+    def set_stream_peer_up(peer: str, up: bool) -> None:  # type: ignore
+        pass
+
+NODES = [x.strip().rstrip("/") for x in (os.environ.get("STREAM_NODES", "") or "").split(",") if x.strip()]
+SELF = (os.environ.get("STREAM_NODE_SELF", "") or "").strip().rstrip("/")
+PEER_TOKEN = os.environ.get("STREAM_PEER_TOKEN", "")
+VNODES = int(os.environ.get("STREAM_RING_VNODES", "160"))
+HEALTH_INTERVAL_S = float(os.environ.get("STREAM_PEER_HEALTH_INTERVAL", "5"))
+PEER_TIMEOUT_S = float(os.environ.get("STREAM_PEER_TIMEOUT", "5"))
+FAILS_TO_DOWN = 2  # подряд неудачных проверок/запросов — узел выпадает из кольца
+
+TOKEN_HEADER = "X-Ogma-Peer-Token"
+LOC_HEADER = "X-Ogma-Loc"
+
+
+class PeerUnavailable(Exception):
+    pass
+
+
+def _point(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    def __init__(self, nodes: List[str], vnodes: int = VNODES):
+        self.nodes = list(dict.fromkeys(nodes))
+        points: List[Tuple[int, str]] = []
+        for node in self.nodes:
+            for i in range(max(1, vnodes)):
+                points.append((_point(f"{node}#{i}"), node))
+        points.sort()
+        self._keys = [p for p, _ in points]
+        self._owners = [n for _, n in points]
+
+    def owner(self, key: str, alive: Optional[Callable[[str], bool]] = None) -> Optional[str]:
+        """Первый живой узел по часовой стрелке от hash(key)."""
+        if not self._keys:
+            return None
+        start = bisect(self._keys, _point(key)) % len(self._keys)
+        seen = set()
+        for i in range(len(self._keys)):
+            node = self._owners[(start + i) % len(self._keys)]
+            if node in seen:
+                continue
+            if alive is None or alive(node):
+                return node
+            seen.add(node)
+            if len(seen) == len(self.nodes):
+                break
+        return None
+
+
+def encode_loc(loc: DocLocation) -> str:
+    from app.api.tgstream.fetcher import loc_to_wire
+
+    return base64.urlsafe_b64encode(json.dumps(loc_to_wire(loc), separators=(",", ":")).encode()).decode()
+
+
+def decode_loc(value: str) -> DocLocation:
+    from app.api.tgstream.fetcher import loc_from_wire
+
+    return loc_from_wire(json.loads(base64.urlsafe_b64decode(value.encode())))
+
+
+class PeerSet:
+    def __init__(self, nodes: List[str] = NODES, self_url: str = SELF, token: str = PEER_TOKEN):
+        self.self_url = self_url
+        self.token = token
+        self.ring = HashRing(nodes)
+        self.fails: Dict[str, int] = {n: 0 for n in self.ring.nodes}
+        self.last_seen: Dict[str, float] = {}
+        self._client: Optional[httpx.AsyncClient] = None
+        self._stop: Optional[Callable[[], None]] = None
+
+    @property
+    def enabled(self) -> bool:
+        # без общего секрета /_peer/block открыт всем — такое шардирование не включаем
+        return len(self.ring.nodes) > 1 and self.self_url in self.ring.nodes and bool(self.token)
+
+    def alive(self, node: str) -> bool:
+        return node == self.self_url or self.fails.get(node, 0) < FAILS_TO_DOWN
+
+    def owner_for(self, doc_id: int) -> Optional[str]:
+        """URL узла-владельца документа; None — владелец мы сами (или шардирование выключено)."""
+        if not self.enabled:
+            return None
+        owner = self.ring.owner(str(int(doc_id)), self.alive)
+        return None if owner in (None, self.self_url) else owner
+
+    def mark(self, node: str, ok: bool) -> None:
+        was = self.alive(node)
+        if ok:
+            self.fails[node] = 0
+            self.last_seen[node] = time.monotonic()
+        else:
+            self.fails[node] = self.fails.get(node, 0) + 1
+        now = self.alive(node)
+        if was != now:
+            log.warning("stream peer %s is %s, ring rebalanced", node, "back" if now else "down")
+        set_stream_peer_up(node, now)
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=PEER_TIMEOUT_S,
+                limits=httpx.Limits(max_connections=64, max_keepalive_connections=16),
+                headers={TOKEN_HEADER: self.token} if self.token else None,
+            )
+        return self._client
+
+    async def fetch_block(self, node: str, loc: DocLocation, offset: int, priority: int) -> bytes:
+        try:
+            r = await self._http().get(
+                f"{node}/_peer/block/{int(loc.doc_id)}/{int(offset)}",
+                params={"p": int(priority)},
+                headers={LOC_HEADER: encode_loc(loc)},  # только подсказка (chat, msg_id), см. peer_block
+            )
+        except httpx.HTTPError as e:
+            self.mark(node, False)
+            raise PeerUnavailable(f"{node}: {e!r}") from e
+        if r.status_code != 200:
+            # 5xx — узел болен; 4xx/429 — узел жив, но блок не отдал
+            if r.status_code >= 500:
+                self.mark(node, False)
+            raise PeerUnavailable(f"{node}: HTTP {r.status_code}")
+        self.mark(node, True)
+        return r.content
+
+    async def check(self) -> None:
+        async def one(node: str) -> None:
+            try:
+                r = await self._http().get(f"{node}/_peer/health")
+                self.mark(node, r.status_code == 200)
+            except httpx.HTTPError:
+                self.mark(node, False)
+
+        await asyncio.gather(*(one(n) for n in self.ring.nodes if n != self.self_url))
+
+    def ensure_checks(self) -> None:
+        """Фоновая проверка соседей; запускается при первом обращении из event loop."""
+        if self._stop is not None or not self.enabled:
+            return
+        stop_evt = asyncio.Event()
+        task = asyncio.create_task(self._health_loop(stop_evt), name="ogma-stream-peers")
+
+        def _stop() -> None:
+            stop_evt.set()
+            task.cancel()
+
+        self._stop = _stop
+
+    async def _health_loop(self, stop_evt: asyncio.Event) -> None:
+        while not stop_evt.is_set():
+            with suppress(Exception):
+                await self.check()
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(stop_evt.wait(), timeout=max(1.0, HEALTH_INTERVAL_S))
+
+    async def close(self) -> None:
+        if self._stop is not None:
+            self._stop()
+            self._stop = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def status(self) -> List[dict]:
+        now = time.monotonic()
+        return [
+            {
+                "node": n,
+                "self": n == self.self_url,
+                "alive": self.alive(n),
+                "fails": self.fails.get(n, 0),
+                "seen_s_ago": round(now - self.last_seen[n], 1) if n in self.last_seen else None,
+            }
+            for n in self.ring.nodes
+        ]
+
+
+_default: Optional[PeerSet] = None
+
+
+def default_peers() -> PeerSet:
+    global _default
+    if _default is None:
+        _default = PeerSet()
+        if NODES and not _default.enabled:
+            if not PEER_TOKEN:
+                log.warning("STREAM_NODES is set but STREAM_PEER_TOKEN is empty: sharding disabled")
+            else:
+                log.warning("STREAM_NODES is set but STREAM_NODE_SELF=%r is not in it: sharding disabled", SELF)
+    return _default
@@ -0,0 +1,217 @@
+# /home/ogma/ogma/app/api/tgstream/prefetch.py
+from __future__ import annotations
+
+import os
+import uuid
+import asyncio as _asyncio
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Hashable, List, Optional, Set
+
+import asyncpg
+
+from app.api.tgstream.blockcache import default_cache as _block_cache
+from app.api.tgstream.scheduler import BACKGROUND as PRIO_BACKGROUND
+
+# Префетч следующего трека плейлиста.
+#
+# Клиент и так сообщает в /me/listen, из какого плейлиста играет трек (playlist_id /
+# playlist_handle). Тогда голова следующих STREAM_PREFETCH_NEXT треков
+# (STREAM_PREFETCH_HEAD_KB, по умолчанию один блок) заранее ложится в блочный кеш —
+# переход к следующему треку начинается с диска, без паузы на Telegram.
+#
+# На пользователя живёт одна задача. Новый трек вне предсказанных (пользователь ушёл
+# в другое место) отменяет её; повторные пинги того же трека — no-op.
+
+log = logging.getLogger("app.tgstream.prefetch")
+
+try:
+    from app.api.telemetry.metrics import mark_stream_prefetch
+except Exception:
+    def mark_stream_prefetch(result: str) -> None:  # type: ignore
+        pass
+
+ENABLED = os.environ.get("STREAM_PREFETCH", "1").strip().lower() not in {"0", "false", "no", "off", ""}
+NEXT_TRACKS = int(os.environ.get("STREAM_PREFETCH_NEXT", "2"))
+HEAD_BYTES = int(os.environ.get("STREAM_PREFETCH_HEAD_KB", "512")) * 1024
+MAX_USERS = 10000
+
+_TRACK_COLS = """t.id::text, t.tg_msg_id, t.chat_username, t.size_bytes,
+       t.tg_document_id, t.tg_access_hash, t.tg_file_ref, t.tg_dc_id, t.mime, t.duration_s"""
+
+
+async def next_tracks(
+    pool: asyncpg.Pool,
+    user_id: int,
+    track_id: str,
+    playlist_id: Optional[str] = None,
+    playlist_handle: Optional[str] = None,
+    limit: int = NEXT_TRACKS,
+) -> List[Dict[str, Any]]:
+    """Строки tracks, идущие в плейлисте после track_id. Плейлист должен быть публичным
+    или принадлежать пользователю; «Мой плейлист» (kind='system') — это user_playlist_items."""
+    pl = None
+    if playlist_id:
+        try:
+            pid = uuid.UUID(str(playlist_id))
+        except ValueError:
+            pid = None
+        if pid is not None:
+            pl = await pool.fetchrow("select id, user_id, kind, is_public from playlists where id=$1", pid)
+    if pl is None and playlist_handle:
+        handle = str(playlist_handle).strip().lstrip("@")
+        if handle:
+            pl = await pool.fetchrow(
+                "select id, user_id, kind, is_public from playlists where lower(handle)=lower($1)", handle
+            )
+    if pl is None or not (pl["is_public"] or int(pl["user_id"]) == int(user_id)):
+        return []
+
+    if pl["kind"] == "system":
+        rows = await pool.fetch(
+            f"""
+            select {_TRACK_COLS}
+              from user_playlist_items cur
+              join user_playlist_items u on u.user_id = cur.user_id and u.added_at < cur.added_at
+              join tracks t on t.id = u.track_id
+             where cur.user_id = $1 and cur.track_id = $2::uuid
+             order by u.added_at desc
+             limit $3
+            """,
+            int(pl["user_id"]), track_id, int(limit),
+        )
+    else:
+        rows = await pool.fetch(
+            f"""
+            select {_TRACK_COLS}
+              from playlist_items cur
+              join playlist_items i on i.playlist_id = cur.playlist_id and i.position > cur.position
+              join tracks t on t.id = i.track_id
+             where cur.playlist_id = $1 and cur.track_id = $2::uuid
+             order by i.position
+             limit $3
+            """,
+            pl["id"], track_id, int(limit),
+        )
+    return [dict(r) for r in rows]
+
+
+def _keys(row: Dict[str, Any]) -> Set[Hashable]:
+    # стрим приходит и по id трека, и по (chat, msg_id)
+    keys: Set[Hashable] = {row["id"]}
+    if row.get("chat_username") and row.get("tg_msg_id") is not None:
+        keys.add((row["chat_username"], int(row["tg_msg_id"])))
+    return keys
+
+
+@dataclass
+class _Job:
+    track_id: str
+    playlist: str
+    task: Optional[_asyncio.Task] = None
+    keys: Optional[Set[Hashable]] = None  # текущий + предсказанные треки; None — ещё не знаем
+
+
+class PlaylistPrefetcher:
+    def __init__(self, head_bytes: int = HEAD_BYTES, max_users: int = MAX_USERS):
+        self.head_bytes = max(1, int(head_bytes))
+        self.max_users = max(1, int(max_users))
+        self._jobs: "OrderedDict[int, _Job]" = OrderedDict()
+
+    def hint(
+        self,
+        user_id: int,
+        pool: asyncpg.Pool,
+        track_id: str,
+        playlist_id: Optional[str] = None,
+        playlist_handle: Optional[str] = None,
+    ) -> None:
+        """Пользователь слушает track_id из плейлиста — греем следующие треки."""
+        if not (playlist_id or playlist_handle):
+            self.played(user_id, track_id)
+            return
+        playlist = f"{playlist_id or ''}|{(playlist_handle or '').lower()}"
+        job = self._jobs.get(user_id)
+        if job is not None and job.track_id == track_id and job.playlist == playlist:
+            self._jobs.move_to_end(user_id)
+            return
+        self._cancel(user_id)
+        job = _Job(track_id=str(track_id), playlist=playlist)
+        job.task = _asyncio.create_task(
+            self._run(job, pool, user_id, playlist_id, playlist_handle), name="ogma-stream-prefetch"
+        )
+        self._jobs[user_id] = job
+        while len(self._jobs) > self.max_users:
+            _, old = self._jobs.popitem(last=False)
+            if old.task is not None and not old.task.done():
+                old.task.cancel()
+
+    def played(self, user_id: int, key: Hashable) -> None:
+        """Начался стрим (id трека или (chat, msg_id)): если это не текущий и не предсказанный
+        трек — пользователь ушёл в другое место, префетч уже не нужен."""
+        job = self._jobs.get(user_id)
+        if job is None or key == job.track_id or job.keys is None or key in job.keys:
+            return
+        self._cancel(user_id)
+
+    def _cancel(self, user_id: int) -> None:
+        job = self._jobs.pop(user_id, None)
+        if job is not None and job.task is not None and not job.task.done():
+            job.task.cancel()
+            mark_stream_prefetch("cancelled")
+
+    async def _run(
+        self, job: _Job, pool: asyncpg.Pool, user_id: int,
+        playlist_id: Optional[str], playlist_handle: Optional[str],
+    ) -> None:
+        from app.api import stream_gateway as sg  # шлюз тянет Telethon — импортируем по требованию
+
+        try:
+            rows = await next_tracks(pool, user_id, job.track_id, playlist_id, playlist_handle)
+            cur = await pool.fetchrow(
+                "select id::text, chat_username, tg_msg_id from tracks where id=$1::uuid", job.track_id
+            )
+            keys: Set[Hashable] = _keys(dict(cur)) if cur else {job.track_id}
+            for r in rows:
+                keys |= _keys(r)
+            job.keys = keys
+            for row in rows:
+                await self._prefetch(sg, pool, row)
+        except _asyncio.CancelledError:
+            raise
+        except Exception as e:
+            mark_stream_prefetch("failed")
+            log.info("playlist prefetch after %s failed: %r", job.track_id, e)
+
+    async def _prefetch(self, sg, pool: asyncpg.Pool, row: Dict[str, Any]) -> None:
+        loc = await sg._get_location(pool, row["chat_username"], row["tg_msg_id"], row)
+        size = int(loc.size or row.get("size_bytes") or 0)
+        if size <= 0:
+            return
+        end = min(size, self.head_bytes) - 1
+        if sg._peers().owner_for(loc.doc_id) is None:
+            bf = _block_cache().open(str(loc.doc_id), size)
+            if bf is not None:
+                missing = await _asyncio.to_thread(bf.missing, 0, bf.block_for(end))
+                if not missing:
+                    mark_stream_prefetch("cached")
+                    return
+        agen = sg._tg_byte_iter(loc, 0, end, pool, PRIO_BACKGROUND)
+        try:
+            async for _chunk in agen:
+                pass
+        finally:
+            await agen.aclose()
+        mark_stream_prefetch("fetched")
+
+
+_default: Optional[PlaylistPrefetcher] = None
+
+
+def default_prefetcher() -> Optional[PlaylistPrefetcher]:
+    """Общий префетчер процесса; None, если STREAM_PREFETCH=0."""
+    global _default
+    if _default is None and ENABLED:
+        _default = PlaylistPrefetcher()
+    return _default
@@ -0,0 +1,242 @@
+# /home/ogma/ogma/app/api/tgstream/scheduler.py
+from __future__ import annotations
+
+import os
+import time
+import heapq
+import asyncio
+import itertools
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar, Union
+
+# Общий планировщик MTProto-вызовов процесса.
+#
+# Все пути (стрим, seek, скачивание, me_send, прогрев) ставят вызовы в одну очередь с
+# приоритетом. Выдача идёт по token bucket (TG_RATE/с, всплеск TG_BURST), с лимитом
+# одновременных запросов, причём фоновые классы не могут занять все слоты — проигрыванию
+# всегда что-то остаётся. FloodWait от Telegram общий для всех: пока он действует, очередь
+# стоит целиком, а по его окончании первыми уходят интерактивные запросы. Вызывающие
+# больше не спят на e.seconds сами.
+#
+# Вместо числа можно передать Ticket: его класс повышается на лету (raise_to), и ожидание
+# в очереди перекладывается в новый класс. Так single-flight отдаёт общий GetFile
+# самому важному из подсевших, а не тому, кто пришёл первым.
+
+log = logging.getLogger("app.tgstream.scheduler")
+
+try:
+    from telethon.errors import FloodWaitError
+except Exception:  # pragma: no cover
+    class FloodWaitError(Exception):  # type: ignore
+        def __init__(self, seconds: int = 3):
+            super().__init__(f"FloodWait {seconds}s")
+            self.seconds = seconds
+
+try:
+    from app.api.telemetry.metrics import (
+        set_tg_queue_depth,
+        set_tg_inflight,
+        observe_tg_queue_wait,
+        mark_tg_floodwait,
+    )
+except Exception:
+    def set_tg_queue_depth(priority: str, n: int) -> None:  # type: ignore
+        pass
+
+    def set_tg_inflight(n: int) -> None:  # type: ignore
+        pass
+
+    def observe_tg_queue_wait(priority: str, seconds: float) -> None:  # type: ignore
+        pass
+
+    def mark_tg_floodwait(op: str, seconds: float) -> None:  # type: ignore
+        pass
+
+T = TypeVar("T")
+
+# классы приоритета: меньше — важнее
+STREAM = 0      # идущее воспроизведение
+SEEK = 1        # перемотка / старт с середины
+BULK = 2        # /download, me_send
+BACKGROUND = 3  # префетч, прогрев кеша
+
+PRIORITY_NAMES = {STREAM: "stream", SEEK: "seek", BULK: "bulk", BACKGROUND: "background"}
+
+RATE = float(os.environ.get("TG_RATE", "30"))
+BURST = float(os.environ.get("TG_BURST", "60"))
+MAX_INFLIGHT = int(os.environ.get("TG_MAX_INFLIGHT", "16"))
+# доля слотов, которую может занять класс (stream/seek — все)
+CLASS_SHARE = {STREAM: 1.0, SEEK: 1.0, BULK: 0.5, BACKGROUND: 0.25}
+FLOOD_RETRIES = int(os.environ.get("TG_FLOOD_RETRIES", "3"))
+# интерактивный запрос не ждёт дольше этого — пусть клиент получит 429
+MAX_INTERACTIVE_FLOOD_WAIT = float(os.environ.get("TG_MAX_INTERACTIVE_FLOOD_WAIT", "10"))
+
+
+class Ticket:
+    """Класс запроса, который можно повысить, пока вызов ждёт в очереди."""
+
+    __slots__ = ("priority", "_sched", "_fut")
+
+    def __init__(self, priority: int = STREAM):
+        self.priority = int(priority)
+        self._sched: Optional["TgScheduler"] = None
+        self._fut: Optional[asyncio.Future] = None
+
+    def raise_to(self, priority: int) -> None:
+        if priority >= self.priority:
+            return
+        self.priority = int(priority)
+        if self._sched is not None and self._fut is not None and not self._fut.done():
+            self._sched._requeue(self)
+
+
+Priority = Union[int, Ticket]
+
+
+class TgScheduler:
+    def __init__(self, rate: float = RATE, burst: float = BURST, max_inflight: int = MAX_INFLIGHT):
+        self.rate = max(0.1, float(rate))
+        self.burst = max(1.0, float(burst))
+        self.max_inflight = max(1, int(max_inflight))
+        self.flood_until = 0.0
+        self._flood_exc: Optional[BaseException] = None
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+        self._heap: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._inflight: Dict[int, int] = {p: 0 for p in PRIORITY_NAMES}
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    # --- состояние ---
+    @property
+    def inflight(self) -> int:
+        return sum(self._inflight.values())
+
+    def queued(self, priority: Optional[int] = None) -> int:
+        return sum(1 for p, _, f in self._heap if not f.done() and (priority is None or p == priority))
+
+    def flood_remaining(self) -> float:
+        return max(0.0, self.flood_until - time.monotonic())
+
+    def note_flood(self, seconds: float, exc: Optional[BaseException] = None, op: str = "") -> None:
+        until = time.monotonic() + max(0.0, float(seconds))
+        if until > self.flood_until:
+            self.flood_until = until
+            self._flood_exc = exc
+            log.warning("telegram flood wait %.0fs (op=%s), queue paused", seconds, op or "?")
+        mark_tg_floodwait(op or "unknown", float(seconds))
+
+    # --- очередь ---
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def _class_full(self, priority: int) -> bool:
+        limit = max(1, int(self.max_inflight * CLASS_SHARE.get(priority, 1.0)))
+        return self._inflight[priority] >= limit
+
+    def _arm(self, delay: float) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(max(0.001, delay), self._pump)
+
+    def _pump(self) -> None:
+        self._timer = None
+        while self._heap:
+            now = time.monotonic()
+            if now < self.flood_until:
+                self._arm(self.flood_until - now)
+                break
+            if self.inflight >= self.max_inflight:
+                break  # разбудит release()
+            self._refill(now)
+            if self._tokens < 1.0:
+                self._arm((1.0 - self._tokens) / self.rate)
+                break
+
+            # первый по приоритету, чей класс не упёрся в свою долю слотов
+            granted = False
+            skipped = []
+            while self._heap:
+                prio, seq, fut = heapq.heappop(self._heap)
+                if fut.done():
+                    continue  # ожидающий ушёл
+                if self._class_full(prio):
+                    skipped.append((prio, seq, fut))
+                    continue
+                self._tokens -= 1.0
+                self._inflight[prio] += 1
+                fut.set_result(prio)  # слот засчитан этому классу — его и освобождать
+                granted = True
+                break
+            for item in skipped:
+                heapq.heappush(self._heap, item)
+            if not granted:
+                break
+        self._export()
+
+    def _export(self) -> None:
+        for prio, name in PRIORITY_NAMES.items():
+            set_tg_queue_depth(name, self.queued(prio))
+        set_tg_inflight(self.inflight)
+
+    def _requeue(self, ticket: Ticket) -> None:
+        fut = ticket._fut
+        self._heap = [item for item in self._heap if item[2] is not fut]
+        heapq.heapify(self._heap)
+        heapq.heappush(self._heap, (ticket.priority, next(self._seq), fut))
+        self._pump()
+
+    async def acquire(self, priority: Priority = STREAM) -> int:
+        """Ждёт слот; возвращает класс, которому слот засчитан (для release)."""
+        ticket = priority if isinstance(priority, Ticket) else None
+        prio = ticket.priority if ticket is not None else int(priority)
+        if prio <= SEEK and self.flood_remaining() > MAX_INTERACTIVE_FLOOD_WAIT and self._flood_exc:
+            raise self._flood_exc
+        fut = asyncio.get_running_loop().create_future()
+        if ticket is not None:
+            ticket._sched, ticket._fut = self, fut
+        heapq.heappush(self._heap, (prio, next(self._seq), fut))
+        t0 = time.monotonic()
+        self._pump()
+        try:
+            granted = await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release(fut.result())  # слот уже выдан — вернуть
+            raise
+        finally:
+            if ticket is not None:
+                ticket._sched = ticket._fut = None
+        observe_tg_queue_wait(PRIORITY_NAMES.get(granted, str(granted)), time.monotonic() - t0)
+        return granted
+
+    def release(self, priority: int) -> None:
+        self._inflight[priority] = max(0, self._inflight[priority] - 1)
+        self._pump()
+
+    async def call(self, fn: Callable[[], Awaitable[T]], priority: Priority = STREAM, op: str = "") -> T:
+        """Выполнить MTProto-вызов в очереди. FloodWait ставит на паузу всю очередь и
+        повторяется (до TG_FLOOD_RETRIES раз); остальные ошибки — вызывающему."""
+        attempt = 0
+        while True:
+            granted = await self.acquire(priority)
+            try:
+                return await fn()
+            except FloodWaitError as e:
+                self.note_flood(getattr(e, "seconds", 3), e, op)
+                attempt += 1
+                if attempt > FLOOD_RETRIES:
+                    raise
+            finally:
+                self.release(granted)
+
+
+_default: Optional[TgScheduler] = None
+
+
+def default_scheduler() -> TgScheduler:
+    global _default
+    if _default is None:
+        _default = TgScheduler()
+    return _default
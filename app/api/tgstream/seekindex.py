@@ -0,0 +1,404 @@
+# /home/ogma/ogma/app/api/tgstream/seekindex.py
+from __future__ import annotations
+
+import os
+import bisect
+import struct
+import logging
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+import asyncpg
+
+# Индекс перемотки: время → байт.
+#
+# Плеер перематывает, угадывая байт по доле длительности. У VBR MP3 это промах на секунды,
+# у M4A с moov в конце — лишние Range-запросы в хвост. Здесь из начала файла (интро/блочный
+# кеш) и, для MP4, из moov строится компактная таблица точек (мс, байт):
+#   * MP3 — TOC из Xing/Info или VBRI; без них (CBR) — линейно от первого фрейма;
+#   * MP4 — stts/stsc/stco(co64) звуковой дорожки, точка на каждый чанк (прорежено до MAX_POINTS).
+# Таблица хранится в track_seek_index (sql/014_track_seek_index.sql) по id документа.
+# Для MP3 точное начало фрейма у найденного байта ищет find_frame.
+
+log = logging.getLogger("app.tgstream.seekindex")
+
+ENABLED = os.environ.get("STREAM_SEEK_INDEX", "1").strip().lower() not in {"0", "false", "no", "off", ""}
+MAX_POINTS = 400
+MOOV_MAX_BYTES = int(os.environ.get("STREAM_MOOV_MAX_MB", "8")) * 1024 * 1024
+
+MP4_MIMES = {"audio/mp4", "audio/x-m4a", "audio/m4a", "audio/aac", "audio/x-m4b", "video/mp4"}
+MP3_MIMES = {"audio/mpeg", "audio/mp3", "audio/x-mpeg", "audio/mpeg3"}
+
+_BITRATES_V1 = (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)
+_BITRATES_V2 = (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)
+_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+
+@dataclass(frozen=True)
+class SeekIndex:
+    kind: str  # mp3 / mp4
+    duration_ms: int
+    audio_start: int
+    points: Tuple[Tuple[int, int], ...]  # (мс, байт), по возрастанию
+    moov_offset: int = 0  # MP4: где лежит moov (в конце — префетчим хвост)
+
+    def lookup(self, t: float) -> Tuple[int, int]:
+        """(мс, байт) для момента t секунд. MP3 — интерполяция между точками TOC,
+        MP4 — ближайший чанк не позже t (внутри чанка резать нельзя)."""
+        ms = max(0, min(int(t * 1000), self.duration_ms))
+        if not self.points:
+            return 0, self.audio_start
+        i = bisect.bisect_right([p[0] for p in self.points], ms) - 1
+        if i < 0:
+            return self.points[0]
+        t0, b0 = self.points[i]
+        if self.kind != "mp3":
+            return t0, b0
+        if i + 1 >= len(self.points):
+            return ms, b0
+        t1, b1 = self.points[i + 1]
+        if t1 <= t0:
+            return ms, b0
+        return ms, b0 + (b1 - b0) * (ms - t0) // (t1 - t0)
+
+    def pack_points(self) -> bytes:
+        flat = [v for p in self.points for v in p]
+        return struct.pack(f"<{len(flat)}I", *flat)
+
+    @staticmethod
+    def unpack_points(data: bytes) -> Tuple[Tuple[int, int], ...]:
+        flat = struct.unpack(f"<{len(data) // 4}I", data)
+        return tuple(zip(flat[0::2], flat[1::2]))
+
+
+def thin(points: Sequence[Tuple[int, int]], limit: int = MAX_POINTS) -> Tuple[Tuple[int, int], ...]:
+    """Оставляет не больше limit точек примерно равномерно по времени (первая и последняя — всегда)."""
+    if len(points) <= limit:
+        return tuple(points)
+    span = points[-1][0] - points[0][0]
+    step = span / max(1, limit - 1)
+    out = [points[0]]
+    for p in points[1:-1]:
+        if p[0] - out[-1][0] >= step:
+            out.append(p)
+    out.append(points[-1])
+    return tuple(out)
+
+
+# --- MP3 ---
+
+def id3_end(data: bytes) -> int:
+    """Длина ID3v2-тега в начале файла (0 — тега нет)."""
+    if len(data) < 10 or data[:3] != b"ID3":
+        return 0
+    size = (data[6] & 0x7F) << 21 | (data[7] & 0x7F) << 14 | (data[8] & 0x7F) << 7 | (data[9] & 0x7F)
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+@dataclass(frozen=True)
+class Mp3Frame:
+    version: int  # 3 — MPEG1, 2 — MPEG2, 0 — MPEG2.5
+    bitrate: int  # кбит/с
+    sample_rate: int
+    samples: int  # сэмплов во фрейме
+    length: int  # байт
+    mono: bool
+
+
+def parse_frame(data: bytes, pos: int = 0) -> Optional[Mp3Frame]:
+    """Заголовок MPEG Layer III в data[pos:pos+4] или None."""
+    if pos < 0 or pos + 4 > len(data):
+        return None
+    b0, b1, b2, b3 = data[pos], data[pos + 1], data[pos + 2], data[pos + 3]
+    if b0 != 0xFF or (b1 & 0xE0) != 0xE0:
+        return None
+    version = (b1 >> 3) & 3
+    layer = (b1 >> 1) & 3
+    br_idx = b2 >> 4
+    sr_idx = (b2 >> 2) & 3
+    if version == 1 or layer != 1 or br_idx in (0, 15) or sr_idx == 3:
+        return None
+    bitrate = (_BITRATES_V1 if version == 3 else _BITRATES_V2)[br_idx]
+    sample_rate = _SAMPLE_RATES[version][sr_idx]
+    samples = 1152 if version == 3 else 576
+    length = samples // 8 * bitrate * 1000 // sample_rate + ((b2 >> 1) & 1)
+    return Mp3Frame(version, bitrate, sample_rate, samples, length, (b3 >> 6) == 3)
+
+
+def find_frame(data: bytes, pos: int = 0) -> Optional[int]:
+    """Первый байт не раньше pos, с которого начинается фрейм; следующий фрейм (если он
+    помещается в data) тоже должен быть валиден — иначе это случайные 0xFFE в аудио."""
+    n = len(data)
+    while True:
+        pos = data.find(b"\xff", pos)
+        if pos < 0 or pos + 4 > n:
+            return None
+        frame = parse_frame(data, pos)
+        if frame is not None:
+            nxt = pos + frame.length
+            if nxt + 4 > n or parse_frame(data, nxt) is not None:
+                return pos
+        pos += 1
+
+
+def mp3_index(data: bytes, size: int, duration_s: int = 0, base: int = 0) -> Optional[SeekIndex]:
+    """data — байты файла начиная с base (обычно с нуля, либо сразу после большого ID3)."""
+    first = find_frame(data, id3_end(data) if base == 0 else 0)
+    if first is None:
+        return None
+    frame = parse_frame(data, first)
+    assert frame is not None
+    start = base + first
+
+    side = (17 if frame.mono else 32) if frame.version == 3 else (9 if frame.mono else 17)
+    xing = first + 4 + side
+    tag = data[xing : xing + 4]
+    if tag in (b"Xing", b"Info") and xing + 8 <= len(data):
+        (flags,) = struct.unpack_from(">I", data, xing + 4)
+        p = xing + 8
+        frames = n_bytes = 0
+        toc = b""
+        if flags & 1 and p + 4 <= len(data):
+            (frames,) = struct.unpack_from(">I", data, p)
+            p += 4
+        if flags & 2 and p + 4 <= len(data):
+            (n_bytes,) = struct.unpack_from(">I", data, p)
+            p += 4
+        if flags & 4 and p + 100 <= len(data):
+            toc = data[p : p + 100]
+        if frames:
+            duration_ms = frames * frame.samples * 1000 // frame.sample_rate
+            n_bytes = n_bytes or (size - start)
+            if toc:
+                points = [(i * duration_ms // 100, start + toc[i] * n_bytes // 256) for i in range(100)]
+            else:
+                points = [(0, start)]
+            points.append((duration_ms, min(size, start + n_bytes)))
+            return SeekIndex("mp3", duration_ms, start, _monotonic(points))
+
+    vbri = first + 4 + 32
+    if data[vbri : vbri + 4] == b"VBRI" and vbri + 26 <= len(data):
+        _, _, _, n_bytes, frames, entries, scale, entry_size, per_entry = struct.unpack_from(
+            ">HHHIIHHHH", data, vbri + 4
+        )
+        p = vbri + 26
+        if frames and entry_size in (1, 2, 3, 4) and p + entries * entry_size <= len(data):
+            duration_ms = frames * frame.samples * 1000 // frame.sample_rate
+            ms_per_entry = per_entry * frame.samples * 1000 / frame.sample_rate
+            points = [(0, start)]
+            offset = start
+            for i in range(entries):
+                offset += int.from_bytes(data[p : p + entry_size], "big") * scale
+                p += entry_size
+                points.append((min(duration_ms, int((i + 1) * ms_per_entry)), min(size, offset)))
+            points.append((duration_ms, min(size, start + n_bytes)))
+            return SeekIndex("mp3", duration_ms, start, thin(_monotonic(points)))
+
+    # без TOC — считаем поток CBR: байт линейно от первого фрейма
+    audio = max(0, size - start)
+    duration_ms = int(duration_s * 1000) if duration_s else audio * 8 // max(1, frame.bitrate)
+    return SeekIndex("mp3", duration_ms, start, ((0, start), (duration_ms, size)))
+
+
+def _monotonic(points: List[Tuple[int, int]]) -> Tuple[Tuple[int, int], ...]:
+    out: List[Tuple[int, int]] = []
+    for ms, off in points:
+        if out and (ms < out[-1][0] or off < out[-1][1]):
+            continue
+        if out and ms == out[-1][0]:
+            out[-1] = (ms, off)
+            continue
+        out.append((ms, off))
+    return tuple(out)
+
+
+# --- MP4 ---
+
+def _boxes(data: bytes, start: int, end: int) -> Iterator[Tuple[bytes, int, int, int]]:
+    """(тип, начало бокса, начало тела, конец бокса) в data[start:end]; конец может выходить за data."""
+    pos = start
+    while pos + 8 <= end:
+        size, kind = struct.unpack_from(">I4s", data, pos)
+        body = pos + 8
+        if size == 1:
+            if pos + 16 > len(data):
+                return
+            (size,) = struct.unpack_from(">Q", data, pos + 8)
+            body = pos + 16
+        elif size == 0:
+            size = end - pos
+        if size < body - pos:
+            return
+        yield kind, pos, body, pos + size
+        pos += size
+
+
+def _child(data: bytes, start: int, end: int, kind: bytes) -> Optional[Tuple[int, int]]:
+    for k, _, body, box_end in _boxes(data, start, end):
+        if k == kind:
+            return body, min(box_end, end)
+    return None
+
+
+def _path(data: bytes, start: int, end: int, *kinds: bytes) -> Optional[Tuple[int, int]]:
+    span: Optional[Tuple[int, int]] = (start, end)
+    for kind in kinds:
+        if span is None:
+            return None
+        span = _child(data, span[0], span[1], kind)
+    return span
+
+
+def mp4_moov_location(head: bytes, size: int) -> Tuple[Optional[int], int]:
+    """Где moov среди боксов верхнего уровня: (смещение, длина). Если заголовок moov не
+    попал в head — (начало первого бокса за пределами head, 0): обычно это moov после mdat.
+    (None, 0) — не MP4."""
+    if head[4:8] != b"ftyp":
+        return None, 0
+    pos = 0
+    for kind, start, _, box_end in _boxes(head, 0, size):
+        if kind == b"moov":
+            return start, box_end - start
+        pos = box_end
+        if pos + 8 > len(head):
+            break
+    return (pos, 0) if pos < size else (None, 0)
+
+
+def find_moov(tail: bytes) -> Optional[Tuple[int, int]]:
+    """moov среди боксов верхнего уровня, начиная с tail[0]: (смещение в tail, длина)."""
+    for kind, start, _, box_end in _boxes(tail, 0, len(tail)):
+        if kind == b"moov":
+            return start, box_end - start
+    return None
+
+
+def mp4_index(moov: bytes, moov_offset: int = 0) -> Optional[SeekIndex]:
+    """moov целиком (с заголовком) → чанки звуковой дорожки."""
+    top = _child(moov, 0, len(moov), b"moov")
+    if top is None:
+        return None
+    chosen = None
+    for kind, _, body, box_end in _boxes(moov, top[0], top[1]):
+        if kind != b"trak":
+            continue
+        hdlr = _path(moov, body, box_end, b"mdia", b"hdlr")
+        handler = moov[hdlr[0] + 8 : hdlr[0] + 12] if hdlr else b""
+        if chosen is None or handler == b"soun":
+            chosen = (body, box_end)
+        if handler == b"soun":
+            break
+    if chosen is None:
+        return None
+
+    mdhd = _path(moov, chosen[0], chosen[1], b"mdia", b"mdhd")
+    stbl = _path(moov, chosen[0], chosen[1], b"mdia", b"minf", b"stbl")
+    if mdhd is None or stbl is None:
+        return None
+    p = mdhd[0]
+    if moov[p] == 1:
+        timescale, duration = struct.unpack_from(">IQ", moov, p + 20)
+    else:
+        timescale, duration = struct.unpack_from(">II", moov, p + 12)
+    if not timescale:
+        return None
+
+    def table(kind: bytes, fmt: str) -> List[tuple]:
+        span = _child(moov, stbl[0], stbl[1], kind)
+        if span is None:
+            return []
+        (count,) = struct.unpack_from(">I", moov, span[0] + 4)
+        width = struct.calcsize(fmt)
+        count = min(count, (span[1] - span[0] - 8) // width)
+        return [struct.unpack_from(fmt, moov, span[0] + 8 + i * width) for i in range(count)]
+
+    stts = table(b"stts", ">II")
+    stsc = table(b"stsc", ">III")
+    offsets = [o for (o,) in table(b"stco", ">I")] or [o for (o,) in table(b"co64", ">Q")]
+    if not (stts and stsc and offsets):
+        return None
+
+    # номер первого сэмпла каждого чанка
+    chunk_samples: List[int] = []
+    sample = 0
+    for i, (first, per_chunk, _) in enumerate(stsc):
+        last = stsc[i + 1][0] - 1 if i + 1 < len(stsc) else len(offsets)
+        for _ in range(first, last + 1):
+            chunk_samples.append(sample)
+            sample += per_chunk
+    # время сэмпла по stts: оба списка по возрастанию — один проход
+    points: List[Tuple[int, int]] = []
+    entry, entry_left, t, s = 0, stts[0][0], 0, 0
+    for chunk, want in enumerate(chunk_samples[: len(offsets)]):
+        while s < want and entry < len(stts):
+            step = min(entry_left, want - s)
+            t += step * stts[entry][1]
+            s += step
+            entry_left -= step
+            if entry_left == 0:
+                entry += 1
+                entry_left = stts[entry][0] if entry < len(stts) else 0
+        points.append((t * 1000 // timescale, int(offsets[chunk])))
+    duration_ms = duration * 1000 // timescale
+    if not points:
+        return None
+    return SeekIndex("mp4", duration_ms, points[0][1], thin(_monotonic(points)), moov_offset)
+
+
+def seek_kind(mime: Optional[str], head: bytes) -> Optional[str]:
+    if head[4:8] == b"ftyp":
+        return "mp4"
+    if (mime or "").lower() in MP3_MIMES or head[:3] == b"ID3" or parse_frame(head, 0) is not None:
+        return "mp3"
+    return None
+
+
+# --- хранилище ---
+
+_missing_table = False
+
+
+async def load_index(pool: Optional[asyncpg.Pool], doc_id: int) -> Optional[SeekIndex]:
+    global _missing_table
+    if pool is None or _missing_table:
+        return None
+    try:
+        row = await pool.fetchrow(
+            "select kind, duration_ms, audio_start, moov_offset, points from track_seek_index where doc_id=$1",
+            int(doc_id),
+        )
+    except asyncpg.UndefinedTableError:
+        log.warning("track_seek_index is missing (sql/014_track_seek_index.sql not applied): seek index not stored")
+        _missing_table = True
+        return None
+    except Exception as e:
+        log.debug("seek index lookup failed doc=%s: %r", doc_id, e)
+        return None
+    if row is None:
+        return None
+    return SeekIndex(
+        row["kind"],
+        int(row["duration_ms"]),
+        int(row["audio_start"]),
+        SeekIndex.unpack_points(bytes(row["points"])),
+        int(row["moov_offset"] or 0),
+    )
+
+
+async def save_index(pool: Optional[asyncpg.Pool], doc_id: int, idx: SeekIndex) -> None:
+    if pool is None or _missing_table:
+        return
+    try:
+        await pool.execute(
+            """
+            insert into track_seek_index(doc_id, kind, duration_ms, audio_start, moov_offset, points)
+            values ($1, $2, $3, $4, $5, $6)
+            on conflict (doc_id) do update set
+              kind = excluded.kind, duration_ms = excluded.duration_ms, audio_start = excluded.audio_start,
+              moov_offset = excluded.moov_offset, points = excluded.points, created_at = now()
+            """,
+            int(doc_id), idx.kind, idx.duration_ms, idx.audio_start, idx.moov_offset, idx.pack_points(),
+        )
+    except Exception as e:
+        log.debug("seek index store failed doc=%s: %r", doc_id, e)
@@ -0,0 +1,145 @@
+# /home/ogma/ogma/app/api/tgstream/segmented.py
+from __future__ import annotations
+
+import os
+import asyncio
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, Type
+
+# Сегментное скачивание большого документа.
+#
+# Обычный поток (_tg_byte_iter) держит в полёте окно из READ_AHEAD блоков перед клиентом и
+# ждёт, пока тот заберёт очередной чанк. Для /download 50–300 МБ lossless это медленно.
+# Здесь диапазон блоков режется на TG_DOWNLOAD_SEGMENTS отрезков, и каждый качается своим
+# воркером независимо от клиента — параллелизм ограничивает только планировщик MTProto
+# (класс bulk). Блоки ложатся в блочный кеш; в памяти держим лишь ближайшие KEEP блоков
+# перед курсором выдачи, остальное клиент дочитает с диска. Воркер, закончивший свой
+# отрезок, забирает вторую половину самого длинного из оставшихся.
+#
+# Ошибка блока повторяется только для этого блока (TG_DOWNLOAD_SEGMENT_RETRIES раз);
+# клиенту она долетает, лишь когда выдача дошла до сломанного блока.
+
+log = logging.getLogger("app.tgstream.segmented")
+
+try:
+    from app.api.telemetry.metrics import mark_download_segment_retry
+except Exception:
+    def mark_download_segment_retry() -> None:  # type: ignore
+        pass
+
+SEGMENTS = int(os.environ.get("TG_DOWNLOAD_SEGMENTS", "4"))
+RETRIES = int(os.environ.get("TG_DOWNLOAD_SEGMENT_RETRIES", "3"))
+MIN_BYTES = int(float(os.environ.get("TG_DOWNLOAD_SEGMENT_MIN_MB", "4")) * 1024 * 1024)
+KEEP = 8  # блоков в памяти перед курсором выдачи
+BACKOFF_BASE = 0.5
+
+
+class ShortBlock(Exception):
+    pass
+
+
+def split_segments(first: int, last: int, n: int) -> List[List[int]]:
+    """[first, last] → до n отрезков [next, hi] примерно равной длины."""
+    total = last - first + 1
+    n = max(1, min(n, total))
+    out: List[List[int]] = []
+    lo = first
+    for i in range(n):
+        size = total // n + (1 if i < total % n else 0)
+        out.append([lo, lo + size - 1])
+        lo += size
+    return out
+
+
+async def segmented_blocks(
+    load: Callable[[int], Awaitable[bytes]],
+    reread: Callable[[int], Awaitable[Optional[bytes]]],
+    first: int,
+    last: int,
+    block_len: Callable[[int], int],
+    cached: Callable[[int], bool] = lambda idx: False,
+    segments: int = SEGMENTS,
+    retries: int = RETRIES,
+    fatal: Tuple[Type[BaseException], ...] = (),
+    keep: int = KEEP,
+) -> AsyncIterator[Tuple[int, bytes]]:
+    """(номер блока, байты) строго по порядку. load качает блок (и пишет его в кеш),
+    reread читает уже записанный блок с диска, cached — блок уже лежит в кеше."""
+    segs = split_segments(first, last, segments)
+    ready: Dict[int, Optional[bytes]] = {}  # None — блок на диске
+    errors: Dict[int, BaseException] = {}
+    changed = asyncio.Event()
+    cursor = first
+
+    async def fetch(idx: int) -> bytes:
+        attempt = 0
+        while True:
+            try:
+                data = await load(idx)
+                if len(data) != block_len(idx):
+                    raise ShortBlock(f"block {idx}: {len(data)} of {block_len(idx)} bytes")
+                return data
+            except asyncio.CancelledError:
+                raise
+            except fatal:
+                raise
+            except Exception as e:
+                attempt += 1
+                if attempt > retries:
+                    raise
+                mark_download_segment_retry()
+                log.warning("segment block %s failed (%r), retry %d/%d", idx, e, attempt, retries)
+                await asyncio.sleep(BACKOFF_BASE * (2 ** (attempt - 1)))
+
+    def _steal() -> Optional[List[int]]:
+        seg = max(segs, key=lambda s: s[1] - s[0], default=None)
+        if seg is None or seg[1] - seg[0] < 2:
+            return None
+        mid = (seg[0] + seg[1] + 1) // 2
+        new = [mid, seg[1]]
+        seg[1] = mid - 1
+        return new
+
+    async def worker(seg: List[int]) -> None:
+        while True:
+            while seg[0] <= seg[1]:
+                idx = seg[0]
+                seg[0] += 1
+                if cached(idx):
+                    ready[idx] = None
+                else:
+                    try:
+                        data = await fetch(idx)
+                    except asyncio.CancelledError:
+                        raise
+                    except BaseException as e:
+                        errors[idx] = e
+                        changed.set()
+                        return
+                    ready[idx] = data if idx < cursor + keep else None
+                changed.set()
+            segs[:] = [s for s in segs if s is not seg]
+            seg = _steal()
+            if seg is None:
+                return
+            segs.append(seg)
+
+    tasks = [asyncio.create_task(worker(s), name="ogma-download-segment") for s in list(segs)]
+    try:
+        while cursor <= last:
+            while cursor not in ready and cursor not in errors:
+                changed.clear()
+                await changed.wait()
+            if cursor in errors:
+                raise errors.pop(cursor)
+            data = ready.pop(cursor)
+            if data is None:
+                data = await reread(cursor)
+                if data is None:  # вытеснили с диска, пока ждали очереди
+                    data = await fetch(cursor)
+            yield cursor, data
+            cursor += 1
+    finally:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,82 @@
+# /home/ogma/ogma/app/api/tgstream/singleflight.py
+from __future__ import annotations
+
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, Optional, TypeVar
+
+from app.api.tgstream.scheduler import Ticket
+
+# Single-flight: параллельные запросы одного и того же блока документа делят один
+# upstream-запрос. Работа крутится в отдельном таске, а вызывающие ждут его через
+# shield — отключение одного слушателя не рвёт загрузку остальным. Если ушли все
+# ожидающие, таск отменяется, чтобы не качать никому не нужный блок.
+#
+# Полёт может нести Ticket планировщика: подсевший вызывающий повышает его класс до своего,
+# иначе стрим, попавший на блок прогрева, ждал бы в очереди фонового класса.
+
+T = TypeVar("T")
+
+
+class _Call:
+    __slots__ = ("task", "waiters", "ticket")
+
+    def __init__(self, task: asyncio.Task, ticket: Optional[Ticket] = None):
+        self.task = task
+        self.waiters = 0
+        self.ticket = ticket
+
+
+class SingleFlight:
+    def __init__(self) -> None:
+        self._calls: Dict[Hashable, _Call] = {}
+        self.started = 0  # сколько реальных upstream-вызовов запущено
+        self.shared = 0   # сколько вызовов подсело на уже летящий
+
+    def in_flight(self, key: Hashable) -> bool:
+        call = self._calls.get(key)
+        return call is not None and not call.task.done()
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]], ticket: Optional[Ticket] = None) -> T:
+        """ticket — класс, с которым fn ставит вызовы в планировщик; для подсевших он же
+        повышается до их класса."""
+        call = self._calls.get(key)
+        if call is None or call.task.done():
+            call = _Call(asyncio.ensure_future(fn()), ticket)
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _t, k=key, c=call: self._forget(k, c))
+            self.started += 1
+        else:
+            self.shared += 1
+            if ticket is not None and call.ticket is not None:
+                call.ticket.raise_to(ticket.priority)
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                # ключ убираем сразу: кто придёт, пока таск доотменяется, начнёт новый полёт,
+                # а не получит чужой CancelledError
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+                call.task.cancel()
+
+    def _forget(self, key: Hashable, call: _Call) -> None:
+        if self._calls.get(key) is call:
+            self._calls.pop(key, None)
+        if not call.task.cancelled():
+            call.task.exception()  # помечаем исключение прочитанным
+
+
+_default: Optional[SingleFlight] = None
+
+
+def default_flights() -> SingleFlight:
+    global _default
+    if _default is None:
+        _default = SingleFlight()
+    return _default
@@ -0,0 +1,167 @@
+# /home/ogma/ogma/app/api/tgstream/upload.py
+from __future__ import annotations
+
+import os
+import asyncio
+import hashlib
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Set, Union
+
+# Конвейерная перезаливка документа ботом без временного файла.
+#
+# Байты идут из _tg_byte_iter (блочный кеш → Telegram, класс bulk) и режутся на части
+# PART_SIZE; каждая часть сразу уходит в upload.saveBigFilePart (для файлов до 10 МБ —
+# upload.saveFilePart) отдельной задачей. В полёте не больше TG_UPLOAD_PARALLEL частей:
+# пока они не подтверждены, скачивание ждёт — в памяти максимум PARALLEL × 512 КБ,
+# на диске ничего. Части можно слать в любом порядке, поэтому медленная часть не
+# тормозит следующие. Ошибка части повторяется только для неё.
+
+log = logging.getLogger("app.tgstream.upload")
+
+try:
+    from telethon import helpers, types
+    from telethon.errors import FloodWaitError
+    from telethon.tl.functions.upload import SaveBigFilePartRequest, SaveFilePartRequest
+except Exception:  # pragma: no cover
+    helpers = types = None  # type: ignore
+    SaveBigFilePartRequest = SaveFilePartRequest = None  # type: ignore
+
+    class FloodWaitError(Exception):  # type: ignore
+        seconds = 3
+
+try:
+    from app.api.telemetry.metrics import add_send_upload_bytes, mark_send_upload_retry
+except Exception:
+    def add_send_upload_bytes(n_bytes: int) -> None:  # type: ignore
+        pass
+
+    def mark_send_upload_retry() -> None:  # type: ignore
+        pass
+
+PART_SIZE = 512 * 1024  # максимум MTProto; 524288 % PART_SIZE == 0
+BIG_FILE_BYTES = 10 * 1024 * 1024  # больше — только saveBigFilePart
+PARALLEL = int(os.environ.get("TG_UPLOAD_PARALLEL", "4"))
+RETRIES = int(os.environ.get("TG_UPLOAD_PART_RETRIES", "3"))
+BACKOFF_BASE = 0.5
+FLOOD_WAIT_MAX_S = 60
+
+# (номер части, всего частей, байты, big) → часть принята сервером
+SendPart = Callable[[int, int, bytes, bool], Awaitable[object]]
+
+
+def part_count(size: int, part_size: int = PART_SIZE) -> int:
+    return max(1, (int(size) + part_size - 1) // part_size)
+
+
+def client_part_sender(client, file_id: int) -> SendPart:
+    async def send(idx: int, total: int, data: bytes, big: bool) -> object:
+        if big:
+            return await client(SaveBigFilePartRequest(file_id, idx, total, data))
+        return await client(SaveFilePartRequest(file_id, idx, data))
+
+    return send
+
+
+async def pipe_parts(
+    send: SendPart,
+    chunks: AsyncIterator[Union[bytes, memoryview]],
+    size: int,
+    part_size: int = PART_SIZE,
+    parallel: int = PARALLEL,
+    retries: int = RETRIES,
+) -> str:
+    """Режет поток на части и шлёт их параллельно. Возвращает md5 (hex) всего файла —
+    его просит inputFile для маленьких файлов."""
+    size = int(size)
+    total = part_count(size, part_size)
+    big = size > BIG_FILE_BYTES
+    md5 = hashlib.md5()
+    slots = asyncio.Semaphore(max(1, int(parallel)))
+    inflight: Set[asyncio.Task] = set()
+    failed: list[BaseException] = []
+
+    async def put(idx: int, data: bytes) -> None:
+        attempt = 0
+        try:
+            while True:
+                try:
+                    await send(idx, total, data, big)
+                    add_send_upload_bytes(len(data))
+                    return
+                except asyncio.CancelledError:
+                    raise
+                except FloodWaitError as e:
+                    secs = int(getattr(e, "seconds", 0) or 0)
+                    if secs > FLOOD_WAIT_MAX_S:
+                        raise
+                    await asyncio.sleep(secs)
+                except Exception as e:
+                    attempt += 1
+                    if attempt > retries:
+                        raise
+                    mark_send_upload_retry()
+                    log.warning("upload part %d/%d failed (%r), retry %d/%d", idx, total, e, attempt, retries)
+                    await asyncio.sleep(BACKOFF_BASE * (2 ** (attempt - 1)))
+        except asyncio.CancelledError:
+            raise
+        except BaseException as e:
+            failed.append(e)
+        finally:
+            slots.release()
+
+    async def spawn(idx: int, data: bytes) -> None:
+        await slots.acquire()
+        if failed:
+            slots.release()
+            raise failed[0]
+        md5.update(data)
+        t = asyncio.create_task(put(idx, data), name="ogma-upload-part")
+        inflight.add(t)
+        t.add_done_callback(inflight.discard)
+
+    buf = bytearray()
+    idx = 0
+    seen = 0
+    try:
+        async for chunk in chunks:
+            seen += len(chunk)
+            if seen > size:
+                raise ValueError(f"stream is longer than {size} bytes")
+            buf += chunk
+            while len(buf) >= part_size:
+                data = bytes(buf[:part_size])
+                del buf[:part_size]
+                await spawn(idx, data)
+                idx += 1
+        if seen != size:
+            raise ValueError(f"stream ended at {seen} of {size} bytes")
+        if buf or idx == 0:
+            await spawn(idx, bytes(buf))
+            idx += 1
+        if inflight:
+            await asyncio.gather(*list(inflight))
+        if failed:
+            raise failed[0]
+    finally:
+        for t in list(inflight):
+            t.cancel()
+        if inflight:
+            await asyncio.gather(*list(inflight), return_exceptions=True)
+    assert idx == total
+    return md5.hexdigest()
+
+
+async def stream_upload(
+    client,
+    chunks: AsyncIterator[Union[bytes, memoryview]],
+    size: int,
+    name: str,
+    parallel: int = PARALLEL,
+):
+    """Заливает поток байтов клиентом и возвращает InputFile/InputFileBig для send_file."""
+    file_id = helpers.generate_random_long()
+    md5 = await pipe_parts(client_part_sender(client, file_id), chunks, size, parallel=parallel)
+    total = part_count(size)
+    if int(size) > BIG_FILE_BYTES:
+        return types.InputFileBig(file_id, total, name)
+    return types.InputFile(file_id, total, name, md5)
@@ -0,0 +1,280 @@
+# /home/ogma/ogma/app/api/tgstream/warmer.py
+from __future__ import annotations
+
+import os
+import time
+import fcntl
+import asyncio as _asyncio
+import logging
+from contextlib import suppress
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import asyncpg
+
+from app.api.tgstream.blockcache import default_cache as _block_cache, default_root as _block_root
+from app.api.tgstream.cachemgr import MAX_BYTES as _CACHE_MAX_BYTES
+from app.api.tgstream.scheduler import BACKGROUND as PRIO_BACKGROUND
+
+# Прогрев дискового кеша по данным прослушиваний.
+#
+# Раз в интервал (и только в «тихие часы») берём топ треков по секундам прослушивания
+# с экспоненциальным затуханием по дням (listening_seconds) плюс свежепроиндексированные
+# релизы и докачиваем их недостающие блоки в блочный кеш. Запросы идут классом background
+# планировщика MTProto, байты — не быстрее STREAM_WARM_RATE_MBPS и не больше
+# STREAM_WARM_RUN_GB за проход. Вечером горячие треки стартуют с диска.
+#
+# Прогревает один воркер на машину (flock на <block root>/.warm.lock). При STREAM_NODES
+# чужие документы пропускаются — их прогреет узел-владелец.
+
+log = logging.getLogger("app.tgstream.warmer")
+
+try:
+    from app.api.telemetry.metrics import add_stream_warm_bytes, mark_stream_warm_track
+except Exception:
+    def add_stream_warm_bytes(n_bytes: int) -> None:  # type: ignore
+        pass
+
+    def mark_stream_warm_track(result: str) -> None:  # type: ignore
+        pass
+
+ENABLED = os.environ.get("STREAM_WARM", "1").strip().lower() not in {"0", "false", "no", "off", ""}
+TOP_N = int(os.environ.get("STREAM_WARM_TOP", "200"))
+HALF_LIFE_DAYS = float(os.environ.get("STREAM_WARM_HALF_LIFE_DAYS", "3"))
+WINDOW_DAYS = int(os.environ.get("STREAM_WARM_WINDOW_DAYS", "14"))
+NEW_DAYS = int(os.environ.get("STREAM_WARM_NEW_DAYS", "2"))
+NEW_LIMIT = int(os.environ.get("STREAM_WARM_NEW_LIMIT", "50"))
+QUIET_HOURS = os.environ.get("STREAM_WARM_HOURS", "2-8")  # локальное время сервера; пусто — всегда
+RATE_BPS = int(float(os.environ.get("STREAM_WARM_RATE_MBPS", "2")) * 1024 * 1024)
+RUN_BYTES = int(float(os.environ.get("STREAM_WARM_RUN_GB", "2")) * 1024 ** 3)
+INTERVAL_S = int(os.environ.get("STREAM_WARM_INTERVAL", "900"))
+LOCK_NAME = ".warm.lock"
+
+
+def parse_hours(spec: str) -> List[Tuple[int, int]]:
+    """'2-8,13-14' → [(2, 8), (13, 14)]: полуинтервалы [от, до) часов; '23-6' переходит через полночь."""
+    out: List[Tuple[int, int]] = []
+    for part in (spec or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        a, _, b = part.partition("-")
+        lo = int(a) % 24
+        hi = int(b) % 24 if b.strip() else (lo + 1) % 24
+        out.append((lo, hi))
+    return out
+
+
+def in_hours(windows: Sequence[Tuple[int, int]], hour: int) -> bool:
+    if not windows:
+        return True
+    for lo, hi in windows:
+        if lo == hi:
+            return True
+        if (lo <= hour < hi) if lo < hi else (hour >= lo or hour < hi):
+            return True
+    return False
+
+
+def missing_runs(missing: Sequence[int]) -> List[Tuple[int, int]]:
+    """Отсортированные номера блоков → непрерывные отрезки (first, last)."""
+    runs: List[Tuple[int, int]] = []
+    for idx in missing:
+        if runs and runs[-1][1] + 1 == idx:
+            runs[-1] = (runs[-1][0], idx)
+        else:
+            runs.append((idx, idx))
+    return runs
+
+
+class Pacer:
+    """Держит средний поток не выше rate байт/с (rate ≤ 0 — без ограничения)."""
+
+    def __init__(self, rate: float, clock=time.monotonic):
+        self.rate = float(rate)
+        self._clock = clock
+        self._t0 = clock()
+        self._sent = 0
+
+    def delay(self, n_bytes: int) -> float:
+        self._sent += n_bytes
+        if self.rate <= 0:
+            return 0.0
+        return max(0.0, self._t0 + self._sent / self.rate - self._clock())
+
+    async def spend(self, n_bytes: int) -> None:
+        d = self.delay(n_bytes)
+        if d > 0:
+            await _asyncio.sleep(d)
+
+
+_TRENDING_SQL = """
+with hot as (
+  select track_id,
+         sum(seconds * power(0.5, (current_date - day)::float8 / $2::float8)) as score
+    from listening_seconds
+   where day >= current_date - $3::int
+   group by track_id
+   order by score desc
+   limit $1
+)
+select t.id::text, t.tg_msg_id, t.chat_username, t.size_bytes,
+       t.tg_document_id, t.tg_access_hash, t.tg_file_ref, t.tg_dc_id, t.mime, t.duration_s
+  from hot
+  join tracks t on t.id = hot.track_id
+ where t.tg_msg_id is not null and t.chat_username is not null
+ order by hot.score desc;
+"""
+
+_NEW_SQL = """
+select t.id::text, t.tg_msg_id, t.chat_username, t.size_bytes,
+       t.tg_document_id, t.tg_access_hash, t.tg_file_ref, t.tg_dc_id, t.mime, t.duration_s
+  from tracks t
+ where t.created_at >= now() - make_interval(days => $1::int)
+   and t.tg_msg_id is not null and t.chat_username is not null
+ order by t.created_at desc
+ limit $2;
+"""
+
+
+async def candidates(pool: asyncpg.Pool) -> List[Dict[str, Any]]:
+    """Трендовые треки по убыванию «остывающих» секунд, затем новинки; без повторов."""
+    rows: List[Dict[str, Any]] = []
+    try:
+        rows += [dict(r) for r in await pool.fetch(_TRENDING_SQL, TOP_N, max(0.1, HALF_LIFE_DAYS), WINDOW_DAYS)]
+    except asyncpg.UndefinedTableError:
+        pass  # listening_seconds создаётся при первом /listen
+    if NEW_LIMIT > 0:
+        rows += [dict(r) for r in await pool.fetch(_NEW_SQL, NEW_DAYS, NEW_LIMIT)]
+    seen = set()
+    out = []
+    for r in rows:
+        if r["id"] not in seen:
+            seen.add(r["id"])
+            out.append(r)
+    return out
+
+
+class Warmer:
+    def __init__(self, pool: asyncpg.Pool, rate: float = RATE_BPS, run_bytes: int = RUN_BYTES,
+                 hours: str = QUIET_HOURS):
+        self.pool = pool
+        self.rate = rate
+        # прогрев не должен сам себя вытеснять: не больше половины бюджета кеша
+        self.run_bytes = min(run_bytes, _CACHE_MAX_BYTES // 2) if _CACHE_MAX_BYTES else run_bytes
+        self.windows = parse_hours(hours)
+        self.last_run: Optional[float] = None
+        self.last_bytes = 0
+
+    def quiet(self) -> bool:
+        return in_hours(self.windows, time.localtime().tm_hour)
+
+    def _lock(self) -> Optional[int]:
+        root = _block_root()
+        try:
+            os.makedirs(root, exist_ok=True)
+            fd = os.open(os.path.join(root, LOCK_NAME), os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError:
+            return None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return None
+        return fd
+
+    async def run_once(self, stop_evt: Optional[_asyncio.Event] = None) -> int:
+        """Один проход; возвращает число докачанных байт."""
+        if not self.quiet():
+            return 0
+        fd = self._lock()
+        if fd is None:
+            return 0  # греет соседний воркер
+        try:
+            return await self._run(stop_evt)
+        finally:
+            with suppress(OSError):
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    async def _run(self, stop_evt: Optional[_asyncio.Event]) -> int:
+        from app.api import stream_gateway as sg  # шлюз тянет Telethon — импортируем по требованию
+
+        pacer = Pacer(self.rate)
+        fetched = 0
+        rows = await candidates(self.pool)
+        for row in rows:
+            if (stop_evt is not None and stop_evt.is_set()) or fetched >= self.run_bytes or not self.quiet():
+                break
+            try:
+                n = await self._warm_track(sg, row, pacer, self.run_bytes - fetched)
+            except Exception as e:
+                mark_stream_warm_track("failed")
+                log.warning("warm track %s failed: %r", row.get("id"), e)
+                continue
+            fetched += n
+            mark_stream_warm_track("warmed" if n else "cached")
+        self.last_run = time.time()
+        self.last_bytes = fetched
+        if fetched:
+            log.info("stream cache warmed: %d tracks considered, %.1f MiB fetched", len(rows), fetched / 2 ** 20)
+        return fetched
+
+    async def _warm_track(self, sg, row: Dict[str, Any], pacer: Pacer, budget: int) -> int:
+        doc_id = row.get("tg_document_id")
+        if doc_id and sg._peers().owner_for(int(doc_id)) is not None:
+            return 0
+        loc = await sg._get_location(self.pool, row["chat_username"], row["tg_msg_id"], row)
+        size = int(loc.size or row.get("size_bytes") or 0)
+        if size <= 0 or sg._peers().owner_for(loc.doc_id) is not None:
+            return 0
+        bf = _block_cache().open(str(loc.doc_id), size)
+        if bf is None:
+            return 0
+        missing = await _asyncio.to_thread(bf.missing, 0, bf.nblocks - 1)
+        fetched = 0
+        for first, last in missing_runs(missing):
+            start = first * bf.block_size
+            end = min(size, (last + 1) * bf.block_size) - 1
+            agen = sg._tg_byte_iter(loc, start, end, self.pool, PRIO_BACKGROUND)
+            try:
+                async for chunk in agen:
+                    fetched += len(chunk)
+                    add_stream_warm_bytes(len(chunk))
+                    await pacer.spend(len(chunk))
+                    if fetched >= budget:
+                        return fetched
+            finally:
+                await agen.aclose()
+        return fetched
+
+
+async def _runner(warmer: Warmer, stop_evt: _asyncio.Event) -> None:
+    while not stop_evt.is_set():
+        try:
+            await warmer.run_once(stop_evt)
+        except Exception:
+            log.exception("stream cache warmer pass failed")
+        with suppress(_asyncio.TimeoutError):
+            await _asyncio.wait_for(stop_evt.wait(), timeout=max(60, INTERVAL_S))
+
+
+# ---- API для main.py ----
+async def start_warmer(app) -> None:
+    if not ENABLED:
+        return
+    warmer = Warmer(app.state.pool)
+    stop_evt = _asyncio.Event()
+    app.state.stream_warmer = warmer
+    app.state._stream_warm_stop_evt = stop_evt
+    app.state._stream_warm_task = _asyncio.create_task(_runner(warmer, stop_evt), name="ogma-stream-warm")
+
+
+async def stop_warmer(app) -> None:
+    stop_evt = getattr(app.state, "_stream_warm_stop_evt", None)
+    task = getattr(app.state, "_stream_warm_task", None)
+    if stop_evt:
+        stop_evt.set()
+    if task:
+        task.cancel()  # посреди трека не ждём — недокачанные блоки просто не попадут в кеш
+        with suppress(BaseException):
+            await task
@@ -28,6 +28,16 @@ MEILI_KEY  = os.environ.get("MEILI_KEY", "")
 
 BATCH = 200
 
+# Интро: первые STREAM_INTRO_KB каждого аудио → track_intros (sql/011_track_intros.sql).
+# Шлюз отдаёт из них начало холодного трека без ожидания Telegram. 0 — не сохранять.
+INTRO_BYTES = min(int(os.environ.get("STREAM_INTRO_KB", "128")), 512) * 1024
+# обычный (не precise) GetFile требует, чтобы 1 MiB делился на limit: округляем вниз
+# до степени двойки, не меньше 4 KiB (96 → 64 KiB)
+if INTRO_BYTES > 0:
+    INTRO_BYTES = max(4096, 1 << (INTRO_BYTES.bit_length() - 1))
+# сколько уже проиндексированных треков без интро добирать за один запуск
+INTRO_BACKFILL = int(os.environ.get("INTRO_BACKFILL", "0"))
+
 log = logging.getLogger("ogma.indexer")
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
@@ -146,6 +156,66 @@ async def upsert_track(con: asyncpg.Connection, chat: str, msg, meili_docs: List
     return True
 
 
+async def store_intro(pool: asyncpg.Pool, tg: TelegramClient, doc) -> bool:
+    """Скачивает начало документа в track_intros. Ошибки не мешают индексации."""
+    if INTRO_BYTES <= 0:
+        return False
+    async with pool.acquire() as con:
+        if await con.fetchval("SELECT 1 FROM track_intros WHERE doc_id=$1", int(doc.id)):
+            return False
+    data = b""
+    try:
+        # iter_download сам уходит в DC документа
+        async for chunk in tg.iter_download(doc, request_size=INTRO_BYTES, limit=1):
+            data = bytes(chunk)
+    except FloodWaitError as e:
+        log.warning("FloodWait %ss on intro of doc %s", e.seconds, doc.id)
+        await asyncio.sleep(e.seconds + 1)
+        return False
+    except Exception as e:
+        log.warning("intro of doc %s failed: %r", doc.id, e)
+        return False
+    if not data:
+        return False
+    async with pool.acquire() as con:
+        await con.execute(
+            "INSERT INTO track_intros (doc_id, data) VALUES ($1, $2) ON CONFLICT (doc_id) DO NOTHING",
+            int(doc.id), data,
+        )
+    return True
+
+
+async def backfill_intros(pool: asyncpg.Pool, tg: TelegramClient, limit: int) -> int:
+    """Интро для треков, проиндексированных до появления track_intros (свежие — первыми)."""
+    async with pool.acquire() as con:
+        rows = await con.fetch(
+            """
+            SELECT t.chat_username, t.tg_msg_id
+              FROM tracks t
+             WHERE t.tg_document_id IS NOT NULL
+               AND NOT EXISTS (SELECT 1 FROM track_intros i WHERE i.doc_id = t.tg_document_id)
+             ORDER BY t.created_at DESC
+             LIMIT $1
+            """,
+            limit,
+        )
+    done = 0
+    for r in rows:
+        try:
+            msg = await tg.get_messages(r["chat_username"], ids=r["tg_msg_id"])
+        except FloodWaitError as e:
+            log.warning("FloodWait %ss", e.seconds)
+            await asyncio.sleep(e.seconds + 1)
+            continue
+        except Exception as e:
+            log.warning("intro backfill %s/%s: %r", r["chat_username"], r["tg_msg_id"], e)
+            continue
+        if msg and msg.document and await store_intro(pool, tg, msg.document):
+            done += 1
+    log.info("intro backfill: %d of %d", done, len(rows))
+    return done
+
+
 async def index_chat(pool: asyncpg.Pool, tg: TelegramClient, meili: httpx.AsyncClient, chat: str):
     async with pool.acquire() as con:
         since_id = await con.fetchval(
@@ -168,6 +238,8 @@ async def index_chat(pool: asyncpg.Pool, tg: TelegramClient, meili: httpx.AsyncC
 
         if added:
             total += 1
+            # сообщение уже в руках — заодно берём начало файла
+            await store_intro(pool, tg, msg.document)
             if len(batch_docs) >= BATCH:
                 r = await meili.post("/indexes/tracks/documents", json=batch_docs)
                 if r.status_code == 401:
@@ -207,6 +279,11 @@ async def main():
     },
 )
 
+    global INTRO_BYTES
+    if INTRO_BYTES > 0 and not await pool.fetchval("SELECT to_regclass('public.track_intros') IS NOT NULL"):
+        log.warning("track_intros не найдена (sql/011_track_intros.sql) — интро не сохраняем.")
+        INTRO_BYTES = 0
+
     # Meili (Bearer)
     if not MEILI_KEY:
         log.warning("MEILI_KEY не задан — запросы к Meili вернут 401.")
@@ -232,6 +309,8 @@ async def main():
     try:
         for chat in CHAT_USERNAMES:
             total += await index_chat(pool, tg, meili, chat)
+        if INTRO_BYTES > 0 and INTRO_BACKFILL > 0:
+            await backfill_intros(pool, tg, INTRO_BACKFILL)
     finally:
         await tg.disconnect()
         await meili.aclose()
@@ -0,0 +1,17 @@
+-- 011_track_intros.sql
+-- Первые 64–128 KiB каждого аудио-документа: индексатор кладёт их сюда при обходе канала,
+-- шлюз отдаёт начало холодного трека отсюда, пока остальное тянется из Telegram.
+-- Ключ — id Telegram-документа (как у блочного кеша), а не id трека.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS public.track_intros (
+  doc_id     bigint      PRIMARY KEY,
+  data       bytea       NOT NULL,
+  created_at timestamptz NOT NULL DEFAULT now()
+);
+
+-- аудио уже сжато — TOAST-сжатие только тратит CPU
+ALTER TABLE public.track_intros ALTER COLUMN data SET STORAGE EXTERNAL;
+
+COMMIT;
@@ -0,0 +1,22 @@
+-- 012_bot_file_ids.sql
+-- Документ, который бот уже загрузил для трека: /me/send повторно шлёт его по
+-- (id, access_hash, file_reference), не перекачивая файл. Документы принадлежат боту,
+-- поэтому ключ включает bot_id. Строка удаляется, когда Telegram отвергает документ.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS public.bot_file_ids (
+  bot_id         bigint      NOT NULL,
+  chat_username  text        NOT NULL,
+  tg_msg_id      bigint      NOT NULL,
+  doc_id         bigint      NOT NULL,
+  access_hash    bigint      NOT NULL,
+  file_ref       bytea       NOT NULL,
+  src_doc_id     bigint      NULL,   -- документ в канале, с которого делали загрузку
+  sends          integer     NOT NULL DEFAULT 0,
+  created_at     timestamptz NOT NULL DEFAULT now(),
+  used_at        timestamptz NOT NULL DEFAULT now(),
+  PRIMARY KEY (bot_id, chat_username, tg_msg_id)
+);
+
+COMMIT;
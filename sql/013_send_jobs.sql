@@ -0,0 +1,34 @@
+-- 013_send_jobs.sql
+-- Очередь /me/send: эндпоинт только вставляет задание, воркеры API забирают его
+-- через FOR UPDATE SKIP LOCKED. Задания переживают рестарт: running с истёкшей арендой
+-- (started_at) снова берётся в работу.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS public.send_jobs (
+  id             bigserial   PRIMARY KEY,
+  user_id        bigint      NOT NULL,
+  chat_username  text        NOT NULL,
+  tg_msg_id      bigint      NOT NULL,
+  title          text        NULL,
+  artists        text[]      NOT NULL DEFAULT '{}',
+  mime           text        NULL,
+  size_bytes     bigint      NULL,
+  status         text        NOT NULL DEFAULT 'queued',  -- queued / running / done / failed
+  attempts       integer     NOT NULL DEFAULT 0,
+  last_error     text        NULL,
+  worker         text        NULL,
+  created_at     timestamptz NOT NULL DEFAULT now(),
+  run_after      timestamptz NOT NULL DEFAULT now(),
+  started_at     timestamptz NULL,
+  finished_at    timestamptz NULL
+);
+
+CREATE INDEX IF NOT EXISTS send_jobs_pending_idx
+  ON public.send_jobs (run_after, id) WHERE status IN ('queued', 'running');
+
+-- один и тот же трек одному пользователю — одно активное задание
+CREATE UNIQUE INDEX IF NOT EXISTS send_jobs_active_uniq
+  ON public.send_jobs (user_id, chat_username, tg_msg_id) WHERE status IN ('queued', 'running');
+
+COMMIT;
@@ -0,0 +1,18 @@
+-- 014_track_seek_index.sql
+-- Индекс перемотки документа: точки (мс, байт) из Xing/VBRI TOC, заголовков MP3-фреймов
+-- или таблиц moov/stts MP4. points — пары uint32 little-endian (мс, смещение).
+-- Ключ — id Telegram-документа, как у track_intros и блочного кеша.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS public.track_seek_index (
+  doc_id       bigint      PRIMARY KEY,
+  kind         text        NOT NULL,            -- mp3 / mp4
+  duration_ms  integer     NOT NULL,
+  audio_start  bigint      NOT NULL DEFAULT 0,  -- первый аудиофрейм / первый чанк
+  moov_offset  bigint      NOT NULL DEFAULT 0,  -- MP4: смещение moov (0 — неизвестно/в начале)
+  points       bytea       NOT NULL,
+  created_at   timestamptz NOT NULL DEFAULT now()
+);
+
+COMMIT;
@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 import os
-import io
 import re
+import sys
 import asyncio
 import logging, base64
+from pathlib import Path
 from typing import Optional, AsyncIterator, Tuple
 
 import asyncpg
@@ -16,7 +17,20 @@ from telethon import TelegramClient
 from telethon.errors import FloodWaitError, FileReferenceExpiredError, AuthKeyError
 from telethon.tl.types import InputDocumentFileLocation
 from telethon.tl.functions.messages import GetMessagesRequest
-from starlette.middleware.gzip import GZipMiddleware
+
+# общие модули шлюза живут в app/ (корень репозитория — на уровень выше stream/)
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from app.api.tgstream.blockcache import BlockCache, BlockFile
+from app.api.tgstream.singleflight import SingleFlight
+from app.api.tgstream.scheduler import STREAM as PRIO_STREAM, TgScheduler
+from app.api.tgstream.filesend import cached_file_response
+from app.api.compression import CompressionMiddleware
+from app.api.tgstream.conditional import etag_for, http_date, not_modified, range_allowed, validator_headers
+from app.api.tgstream.cachemgr import default_manager as cache_manager, start_cache_manager, stop_cache_manager
+from app.api.tgstream.cdn import ENABLED as CDN_ENABLED, default_cdn
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Config
@@ -37,6 +51,15 @@ PORT = int(os.environ.get("PORT", "8082"))
 CACHE_DIR = os.environ.get("CACHE_DIR", "/home/ogma/ogma/stream/media-cache")
 os.makedirs(CACHE_DIR, exist_ok=True)
 
+# блочный кеш (общий с app/api/stream_gateway.py): по умолчанию <CACHE_DIR>/blocks
+BLOCKS = BlockCache(os.environ.get("BLOCK_CACHE_DIR") or os.path.join(CACHE_DIR, "blocks"))
+# координатор загрузок: один блок документа качается из Telegram ровно одним запросом
+FLIGHTS = SingleFlight()
+# общий планировщик MTProto-вызовов процесса: token bucket + общий FloodWait
+SCHED = TgScheduler()
+# FileCdnRedirect: популярные файлы качаем с CDN-DC Telegram (TG_CDN=0 — выключить)
+CDN = default_cdn() if CDN_ENABLED else None
+
 # ──────────────────────────────────────────────────────────────────────────────
 # App + globals
 # ──────────────────────────────────────────────────────────────────────────────
@@ -48,7 +71,7 @@ app.add_middleware(
     allow_methods=["GET", "HEAD", "OPTIONS"],
     allow_headers=["*"],
 )
-app.add_middleware(GZipMiddleware, minimum_size=1024)  # сжимать >1KB
+app.add_middleware(CompressionMiddleware)  # только JSON/текст; аудио идёт как есть
 
 log = logging.getLogger("ogma.stream")
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
@@ -61,9 +84,8 @@ tg: Optional[TelegramClient] = None
 # ──────────────────────────────────────────────────────────────────────────────
 
 def cache_path_for(track_id: str) -> str:
-    sub = os.path.join(CACHE_DIR, track_id[:2])
-    os.makedirs(sub, exist_ok=True)
-    return os.path.join(sub, f"{track_id}.bin")
+    # только путь: старые .bin больше не пишутся, каталог создавать незачем
+    return os.path.join(CACHE_DIR, track_id[:2], f"{track_id}.bin")
 
 def sanitize_filename(name: str) -> str:
     # очень простой санитайзер
@@ -129,7 +151,8 @@ async def fetch_track_row(track_id: str) -> Optional[asyncpg.Record]:
         tg_document_id,
         tg_access_hash,
         tg_file_ref,
-        tg_dc_id
+        tg_dc_id,
+        created_at
       FROM tracks
       WHERE id = $1::uuid
       LIMIT 1;
@@ -179,13 +202,25 @@ async def refresh_file_reference(row: asyncpg.Record) -> asyncpg.Record:
     # вернём обновлённый row
     return await fetch_track_row(row["id"])
 
+async def tg_get_file(loc: InputDocumentFileLocation, offset: int, limit: int):
+    """Один GetFile; при FileCdnRedirect байты приходят с CDN-DC (расшифрованные и проверенные)."""
+    # импортируем тут, чтобы избежать путаницы с tg.upload.GetFileRequest
+    from telethon.tl.functions.upload import GetFileRequest
+
+    request = GetFileRequest(
+        location=loc, offset=offset, limit=limit, precise=True, cdn_supported=CDN is not None
+    )
+    if CDN is None:
+        return await tg(request)
+    return await CDN.get_file("main", tg, request, tg)
+
 async def telegram_bytes(
-    row: asyncpg.Record, start: int, end: int, write_to: Optional[io.BufferedWriter] = None
+    row: asyncpg.Record, start: int, end: int, row_box: Optional[list] = None,
 ) -> AsyncIterator[bytes]:
     """
     Читает байты документа через MTProto (GetFile), отдаёт генератором.
     При необходимости обновляет file_reference.
-    Если write_to задан — дублирует поток в файл (для кеша).
+    Если row_box задан — освежённая строка кладётся в row_box[0] для следующих вызовов.
     """
     assert tg is not None
 
@@ -197,6 +232,8 @@ async def telegram_bytes(
     # если чего-то не хватает — освежаем ссылку
     if not (doc_id and access_hash and file_ref):
         row = await refresh_file_reference(row)
+        if row_box is not None:
+            row_box[0] = row
         doc_id = row["tg_document_id"]
         access_hash = row["tg_access_hash"]
         file_ref = row["tg_file_ref"] or b""
@@ -214,26 +251,27 @@ async def telegram_bytes(
     remaining = end - start + 1
     CHUNK = 512 * 1024  # 512KiB
 
-    # импортируем тут, чтобы избежать путаницы с tg.upload.GetFileRequest
-    from telethon.tl.functions.upload import GetFileRequest
-
     while remaining > 0:
         req = min(CHUNK, remaining)
         try:
-            res = await tg(GetFileRequest(
-                location=loc, offset=offset, limit=req, precise=True, cdn_supported=True
-            ))
+            res = await SCHED.call(
+                lambda: tg_get_file(loc, offset, req),
+                PRIO_STREAM,
+                op="GetFile",
+            )
         except FileReferenceExpiredError:
             # обновляем file_reference и пробуем снова с тем же offset
             row = await refresh_file_reference(row)
+            if row_box is not None:
+                row_box[0] = row
             file_ref = bytes(row["tg_file_ref"] or b"")
             loc = InputDocumentFileLocation(
                 id=doc_id, access_hash=access_hash, file_reference=file_ref, thumb_size=""
             )
             continue
         except FloodWaitError as e:
-            await asyncio.sleep(e.seconds + 1)
-            continue
+            # планировщик уже выждал общий FloodWait и сдался — дальше ждать нельзя
+            raise HTTPException(429, f"Telegram rate limit, wait {e.seconds}s")
 
         chunk = bytes(getattr(res, "bytes", b""))
         if not chunk:
@@ -243,24 +281,58 @@ async def telegram_bytes(
         if len(chunk) > remaining:
             chunk = chunk[:remaining]
 
-        if write_to:
-            write_to.write(chunk)
-
         yield chunk
         offset += len(chunk)
         remaining -= len(chunk)
 
-async def file_bytes(path: str, start: int, end: int) -> AsyncIterator[bytes]:
-    CHUNK = 256 * 1024
-    with open(path, "rb") as f:
-        f.seek(start)
-        left = end - start + 1
-        while left > 0:
-            data = f.read(min(CHUNK, left))
-            if not data:
-                break
-            yield data
-            left -= len(data)
+async def fetch_block(row_box: list, bf: BlockFile, idx: int) -> bytes:
+    """Тянет один блок из Telegram и пишет его в кеш. Вызывать только через FLIGHTS."""
+    await asyncio.to_thread(bf.reload)
+    cached = await asyncio.to_thread(bf.read_block, idx)
+    if cached is not None:
+        return cached
+
+    first = idx * bf.block_size
+    parts = []
+    async for chunk in telegram_bytes(row_box[0], first, first + bf.block_len(idx) - 1, row_box=row_box):
+        parts.append(chunk)
+    block = b"".join(parts)
+    try:
+        await asyncio.to_thread(bf.write_block, idx, block)
+    except OSError as e:
+        log.warning("block cache write failed doc=%s block=%d: %s", bf.key, idx, e)
+    return block
+
+async def block_bytes(row: asyncpg.Record, bf: BlockFile, start: int, end: int) -> AsyncIterator[bytes]:
+    """
+    Отдаёт [start, end] поблочно: готовые блоки — с диска, недостающие — из Telegram
+    со сквозной записью в кеш. Параллельные запросы одного блока (два полных
+    скачивания одного трека) ждут одну и ту же загрузку, а не пишут файл дважды.
+    """
+    bs = bf.block_size
+    row_box = [row]
+    await asyncio.to_thread(bf.reload)
+
+    for idx in range(start // bs, end // bs + 1):
+        block = await asyncio.to_thread(bf.read_block, idx)
+        cache_manager().record(bf.data_path, hit=block is not None)
+        if block is None:
+            block = await FLIGHTS.do((bf.key, idx), lambda i=idx: fetch_block(row_box, bf, i))
+
+        base = idx * bs
+        lo = max(start, base) - base
+        hi = min(end, base + len(block) - 1) - base
+        if hi >= lo:
+            yield block[lo:hi + 1]
+        if len(block) < bf.block_len(idx):
+            # Telegram отдал меньше, чем ожидали — дальше не идём
+            return
+
+def track_validators(row: asyncpg.Record, size: int) -> Tuple[Optional[str], Optional[str]]:
+    """(ETag, Last-Modified) трека. ETag — из id Telegram-документа: общий с stream_gateway."""
+    if not row["tg_document_id"]:
+        return None, None
+    return etag_for(row["tg_document_id"], size), http_date(row["created_at"])
 
 def common_headers(mime: str, file_size: int, start: int, end: int, is_partial: bool) -> dict:
     length = end - start + 1
@@ -303,10 +375,14 @@ async def _startup():
         # Останавливаем приложение, чтобы systemd перезапускал после авторизации
         raise RuntimeError("Telegram session unauthorized")
 
+    await start_cache_manager(app)
     log.info("Startup complete.")
 
 @app.on_event("shutdown")
 async def _shutdown():
+    await stop_cache_manager(app)
+    if CDN is not None:
+        await CDN.close()
     if tg:
         await tg.disconnect()
     if pool:
@@ -348,20 +424,28 @@ async def serve_track(track_id: str, request: Request, as_download: bool) -> Res
     mime = (row["mime"] or "audio/mpeg").strip()
     title = (row["title"] or "track").strip()
 
-    rng = request.headers.get("Range")
-    start, end, is_partial = parse_http_range(rng, size)
-
     # ── Префлайт: убедиться, что есть TG-поля ДО отправки заголовков ──
     if not (row["tg_document_id"] and row["tg_access_hash"] and row["tg_file_ref"]):
         # Если не получится освежить — вернём 404/500 до старта ответа
         row = await refresh_file_reference(row)
 
-    # Кэш на диск
+    etag, last_mod = track_validators(row, size)
+    if etag and not_modified(request.headers, etag, last_mod):
+        return Response(status_code=304, headers=validator_headers(etag, last_mod, immutable=True))
+
+    rng = request.headers.get("Range")
+    if etag and not range_allowed(request.headers, etag, last_mod):
+        rng = None  # If-Range не совпал — отдаём файл целиком
+    start, end, is_partial = parse_http_range(rng, size)
+
+    # Кэш на диск: старый полнофайловый .bin (если уже есть) или блочный кеш
     cpath = cache_path_for(track_id)
     use_cache = os.path.exists(cpath) and os.path.getsize(cpath) == size
 
     headers = common_headers(mime, size, start, end, is_partial)
     headers["Cache-Control"] = "public, max-age=86400, immutable"
+    if etag:
+        headers.update(validator_headers(etag, last_mod, immutable=True))
     headers["Vary"] = "Range"
     if as_download:
         fname = sanitize_filename(title)
@@ -371,52 +455,54 @@ async def serve_track(track_id: str, request: Request, as_download: bool) -> Res
     status = 206 if is_partial else 200
 
     if use_cache:
-        # Из файла можно безопасно указывать Content-Length
-        stream = file_bytes(cpath, start, end)
-        return StreamingResponse(stream, status_code=status, headers=headers)
-    else:
-        # Для лайв-стрима убираем Content-Length (chunked), чтобы не было "remaining to read"
-        headers.pop("Content-Length", None)
-
-        write_to = None
-        temp_path = cpath + ".part"
-        if start == 0 and end == size - 1:
-            write_to = open(temp_path, "wb")
-
-        async def gen():
-            sent = 0
-            try:
-                async for chunk in telegram_bytes(row, start, end, write_to):
-                    sent += len(chunk)
-                    yield chunk
-            except HTTPException as e:
-                # Не пробрасываем наружу после старта ответа — тихо завершаем поток
-                log.warning("telegram http-exception during stream id=%s: %s", track_id, e)
-                return
-            except Exception as e:
-                log.exception("stream error id=%s: %s", track_id, e)
-                return
-            finally:
-                expected = end - start + 1
-                log.info(
-                    "stream done id=%s range=%d-%d sent=%d expected=%d",
-                    track_id, start, end, sent, expected
-                )
-                if write_to:
-                    try:
-                        write_to.flush()
-                        write_to.close()
-                        if sent == expected and start == 0 and end == size - 1:
-                            os.replace(temp_path, cpath)   # докатываем .part в кэш
-                        else:
-                            try:
-                                os.remove(temp_path)       # частичный/ошибка — чистим .part
-                            except FileNotFoundError:
-                                pass
-                    except Exception as e2:
-                        log.warning("cache finalize error: %s", e2)
-
-        return StreamingResponse(gen(), status_code=status, headers=headers)
+        try:
+            resp = cached_file_response(cpath, start, end, status_code=status, headers=headers)
+        except OSError:
+            pass  # файл вытеснили между проверкой и открытием — пойдём через блоки
+        else:
+            cache_manager().record(cpath, hit=True)
+            return resp
+
+    bf = BLOCKS.open(str(row["tg_document_id"]), size)
+    if bf is not None and not bf.missing(start // bf.block_size, end // bf.block_size):
+        # весь диапазон уже лежит в блоках: .blk — файл полного размера, смещения совпадают,
+        # так что отдаём его напрямую, без чтения поблочно на event loop
+        try:
+            resp = cached_file_response(bf.data_path, start, end, status_code=status, headers=headers)
+        except OSError:
+            resp = None
+        if resp is not None and bf.missing(start // bf.block_size, end // bf.block_size):
+            # блоки вытеснили, пока открывали файл, — отдадим через Telegram (fd закроет GC)
+            resp = None
+        if resp is not None:
+            cache_manager().record(bf.data_path, hit=True)
+            return resp
+
+    # Для лайв-стрима убираем Content-Length (chunked), чтобы не было "remaining to read"
+    headers.pop("Content-Length", None)
+
+    async def gen():
+        sent = 0
+        try:
+            source = block_bytes(row, bf, start, end) if bf is not None else telegram_bytes(row, start, end)
+            async for chunk in source:
+                sent += len(chunk)
+                yield chunk
+        except HTTPException as e:
+            # Не пробрасываем наружу после старта ответа — тихо завершаем поток
+            log.warning("telegram http-exception during stream id=%s: %s", track_id, e)
+            return
+        except Exception as e:
+            log.exception("stream error id=%s: %s", track_id, e)
+            return
+        finally:
+            expected = end - start + 1
+            log.info(
+                "stream done id=%s range=%d-%d sent=%d expected=%d",
+                track_id, start, end, sent, expected
+            )
+
+    return StreamingResponse(gen(), status_code=status, headers=headers)
 
 @app.get("/stream/{track_id}")
 async def http_stream(track_id: str, request: Request):
@@ -455,10 +541,18 @@ async def http_stream_head(track_id: str, request: Request):
                 "Content-Type": mime,
             })
 
+    etag, last_mod = track_validators(row, size)
+    if etag and not_modified(request.headers, etag, last_mod):
+        return Response(status_code=304, headers=validator_headers(etag, last_mod, immutable=True))
+
     rng = request.headers.get("Range")
+    if etag and not range_allowed(request.headers, etag, last_mod):
+        rng = None
     start, end, is_partial = parse_http_range(rng, size)
     headers = common_headers(mime, size, start, end, is_partial)
     headers["Cache-Control"] = "public, max-age=86400, immutable"
+    if etag:
+        headers.update(validator_headers(etag, last_mod, immutable=True))
     headers["Vary"] = "Range"
     status = 206 if is_partial else 200
     return Response(status_code=status, headers=headers)
@@ -489,10 +583,18 @@ async def http_download_head(track_id: str, request: Request):
             resp.headers["Content-Disposition"] = f'attachment; filename="{fname}{ext}"'
             return resp
 
+    etag, last_mod = track_validators(row, size)
+    if etag and not_modified(request.headers, etag, last_mod):
+        return Response(status_code=304, headers=validator_headers(etag, last_mod, immutable=True))
+
     rng = request.headers.get("Range")
+    if etag and not range_allowed(request.headers, etag, last_mod):
+        rng = None
     start, end, is_partial = parse_http_range(rng, size)
     headers = common_headers(mime, size, start, end, is_partial)
     headers["Cache-Control"] = "public, max-age=86400, immutable"
+    if etag:
+        headers.update(validator_headers(etag, last_mod, immutable=True))
     headers["Vary"] = "Range"
     fname = sanitize_filename(title)
     ext = ".mp3" if mime == "audio/mpeg" else ""
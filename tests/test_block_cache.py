@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import os
+from pathlib import Path
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from app.api.tgstream.blockcache import BlockCache, BlockFile
+
+
+def test_blocks_are_written_and_reported(tmp_path):
+    cache = BlockCache(str(tmp_path), block_size=4)
+    bf = cache.open("12345", 10)  # блоки: 4 + 4 + 2
+
+    assert bf.nblocks == 3
+    assert bf.missing(0, 2) == [0, 1, 2]
+
+    assert bf.write_block(1, b"efgh")
+    assert bf.read_block(1) == b"efgh"
+    assert bf.read_block(0) is None
+    assert bf.missing(0, 2) == [0, 2]
+
+
+def test_partial_blocks_are_not_cached(tmp_path):
+    bf = BlockCache(str(tmp_path), block_size=4).open("777", 10)
+
+    assert not bf.write_block(0, b"ab")  # обрыв посреди блока
+    assert bf.write_block(2, b"ij")  # хвостовой блок короче block_size — это норма
+    assert bf.missing(0, 2) == [0, 1]
+
+
+def test_bitmap_is_shared_between_instances(tmp_path):
+    first = BlockFile(str(tmp_path), "999", 8, block_size=4)
+    second = BlockFile(str(tmp_path), "999", 8, block_size=4)
+
+    first.write_block(0, b"abcd")
+    assert second.missing(0, 1) == [1]
+    assert second.read_block(0) == b"abcd"
+
+    first.write_block(1, b"efgh")
+    assert second.complete
+
+
+def test_size_change_resets_blocks(tmp_path):
+    BlockFile(str(tmp_path), "42", 8, block_size=4).write_block(0, b"abcd")
+    resized = BlockFile(str(tmp_path), "42", 12, block_size=4)
+    assert resized.missing(0, 2) == [0, 1, 2]
+
+
+def test_block_written_into_evicted_file_is_not_marked(tmp_path, monkeypatch):
+    from app.api.tgstream import blockcache
+
+    cache = BlockCache(str(tmp_path), block_size=4)
+    bf = cache.open("4242", 8)
+    real_locked = blockcache._locked
+    reborn = []
+
+    def evict_then_lock(path):
+        # менеджер кеша удалил запись, соседний воркер тут же завёл её заново
+        monkeypatch.setattr(blockcache, "_locked", real_locked)
+        os.remove(bf.data_path)
+        os.remove(bf.map_path)
+        reborn.append(BlockFile(str(tmp_path), "4242", 8, block_size=4))
+        return real_locked(path)
+
+    monkeypatch.setattr(blockcache, "_locked", evict_then_lock)
+
+    assert not bf.write_block(0, b"abcd")
+    assert reborn[0].missing(0, 1) == [0, 1]
+    assert bf.write_block(0, b"abcd")  # следующая запись идёт уже в новый файл
+    assert reborn[0].missing(0, 1) == [1]
+
+
+def test_stale_bitmap_does_not_read_holes_of_a_recreated_file(tmp_path):
+    bf = BlockCache(str(tmp_path), block_size=4).open("4343", 8)
+    assert bf.write_block(0, b"abcd") and bf.read_block(0) == b"abcd"
+
+    # менеджер кеша вытеснил запись, другой воркер завёл пустой файл под тем же именем
+    os.remove(bf.data_path)
+    os.remove(bf.map_path)
+    BlockFile(str(tmp_path), "4343", 8, block_size=4)
+
+    assert bf.has(0)  # битмап в памяти ещё старый
+    assert bf.read_block(0) is None  # а не четыре нулевых байта из дыры
+    assert not bf.has(0)
@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import os
+from pathlib import Path
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from app.api.tgstream.cachemgr import CacheManager
+
+
+def _put(root: Path, name: str, size: int, mtime: float) -> Path:
+    path = root / name[:2] / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"x" * size)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_lru_evicts_oldest_down_to_low_watermark(tmp_path):
+    old = _put(tmp_path, "aa.bin", 64 * 1024, 1000)
+    mid = _put(tmp_path, "bb.bin", 64 * 1024, 2000)
+    new = _put(tmp_path, "cc.bin", 64 * 1024, 3000)
+
+    mgr = CacheManager(str(tmp_path), max_bytes=150 * 1024, low_watermark=0.9)
+    mgr.record(str(old), hit=True)  # свежее обращение спасает старый файл
+
+    evicted = mgr.run_once(mgr._pending)
+
+    assert evicted > 0
+    assert old.exists() and new.exists()
+    assert not mid.exists()
+    assert mgr.total_bytes <= 150 * 1024
+
+
+def test_block_files_are_evicted_with_bitmap(tmp_path):
+    blk = _put(tmp_path, "12.blk", 64 * 1024, 1000)
+    bitmap = blk.with_suffix(".map")
+    bitmap.write_bytes(b"\x01")
+
+    CacheManager(str(tmp_path), max_bytes=1024).run_once()
+
+    assert not blk.exists() and not bitmap.exists()
+
+
+def test_unlimited_budget_keeps_everything(tmp_path):
+    path = _put(tmp_path, "dd.bin", 4096, 1000)
+    assert CacheManager(str(tmp_path), max_bytes=0).run_once() == 0
+    assert path.exists()
+
+
+def test_scan_cleans_only_its_own_leftovers(tmp_path):
+    part = _put(tmp_path, "ee.bin.part", 16, 1000)
+    index_tmp = tmp_path / ".cache-index.json.tmp"
+    index_tmp.write_bytes(b"{")
+    os.utime(index_tmp, (1000, 1000))
+    foreign = _put(tmp_path, "ff.tmp", 16, 1000)  # чужой временный файл рядом с кешем
+
+    CacheManager(str(tmp_path), max_bytes=0).run_once()
+
+    assert not part.exists() and not index_tmp.exists()
+    assert foreign.exists()
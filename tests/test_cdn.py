@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+from pathlib import Path
+from types import SimpleNamespace
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import pytest
+
+from app.api.tgstream import cdn
+from app.api.tgstream.cdn import CdnFetcher, CdnHashMismatch, CdnRedirect, check_hashes, cdn_pieces
+
+KIB = 1024
+
+
+def _redirect_tl(hashes=()):
+    tl = cdn.FileCdnRedirect.__new__(cdn.FileCdnRedirect)
+    tl.dc_id = 203
+    tl.file_token = b"tok"
+    tl.encryption_key = b"k" * 32
+    tl.encryption_iv = b"i" * 16
+    tl.file_hashes = list(hashes)
+    return tl
+
+
+def _get_file(doc_id=7, offset=0, limit=512 * KIB):
+    return SimpleNamespace(location=SimpleNamespace(id=doc_id), offset=offset, limit=limit, cdn_supported=True)
+
+
+def test_cdn_pieces_are_power_of_two_and_aligned():
+    assert cdn_pieces(0, 512 * KIB) == [(0, 512 * KIB)]
+    pieces = cdn_pieces(128 * KIB, 640 * KIB)
+    assert pieces == [(128 * KIB, 128 * KIB), (256 * KIB, 256 * KIB), (512 * KIB, 128 * KIB)]
+    for off, lim in pieces:
+        assert off % lim == 0 and off // (1024 * KIB) == (off + lim - 1) // (1024 * KIB)
+
+
+def test_check_hashes_verifies_and_reports_missing():
+    data = bytes(range(256)) * 1024  # 256 KiB
+    red = CdnRedirect(dc_id=1, file_token=b"t", key=b"", iv=b"")
+    red.add_hashes([SimpleNamespace(offset=0, limit=128 * KIB, hash=hashlib.sha256(data[:128 * KIB]).digest())])
+    assert check_hashes(red, 0, data) == [128 * KIB]
+
+    red.add_hashes([SimpleNamespace(offset=128 * KIB, limit=128 * KIB, hash=b"\0" * 32)])
+    with pytest.raises(CdnHashMismatch):
+        check_hashes(red, 0, data)
+
+
+def test_redirect_is_reused_and_expired_token_refreshed():
+    fetcher = CdnFetcher()
+    sent = []
+
+    async def send(request):
+        sent.append(request)
+        return _redirect_tl()
+
+    reads = []
+
+    async def read(client, red, offset, limit, master):
+        reads.append(offset)
+        if len(reads) == 2:
+            raise cdn.CdnTokenExpired("FILE_TOKEN_INVALID")
+        return b"x" * limit
+
+    fetcher.read = read
+
+    async def scenario():
+        first = await fetcher.get_file("main", None, _get_file(offset=0), send)
+        second = await fetcher.get_file("main", None, _get_file(offset=512 * KIB), send)
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert len(first.bytes) == len(second.bytes) == 512 * KIB
+    # второй блок: редирект из кеша → протух → один свежий GetFile
+    assert len(sent) == 2 and reads == [0, 512 * KIB, 512 * KIB]
+
+
+def test_cdn_failure_falls_back_to_main_dc():
+    fetcher = CdnFetcher()
+    sent = []
+
+    async def send(request):
+        sent.append(request.cdn_supported)
+        return _redirect_tl() if request.cdn_supported else SimpleNamespace(bytes=b"main")
+
+    async def read(client, red, offset, limit, master):
+        raise CdnHashMismatch("bad")
+
+    fetcher.read = read
+
+    async def scenario():
+        a = await fetcher.get_file("main", None, _get_file(), send)
+        b = await fetcher.get_file("main", None, _get_file(offset=512 * KIB), send)
+        return a, b
+
+    a, b = asyncio.run(scenario())
+    assert a.bytes == b.bytes == b"main"
+    # после сбоя документ временно идёт мимо CDN, без повторного редиректа
+    assert sent == [True, False, False]
+    assert not fetcher.allowed(7)
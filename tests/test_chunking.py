@@ -0,0 +1,44 @@
+from __future__ import annotations
+
+from pathlib import Path
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from app.api.tgstream.chunking import is_precise_legal, ramp_pieces
+
+BLOCK = 512 * 1024
+
+
+def test_aligned_start_uses_whole_blocks():
+    assert ramp_pieces(0, 10 * BLOCK, BLOCK) == []
+    assert ramp_pieces(3 * BLOCK, 10 * BLOCK, BLOCK) == []
+
+
+def test_seek_ramps_up_to_block_boundary():
+    start = BLOCK + 300_000
+    pieces = ramp_pieces(start, 10 * BLOCK, BLOCK, first=64 * 1024)
+
+    assert pieces[0][0] <= start < pieces[0][0] + pieces[0][1]
+    assert pieces[0][1] == 64 * 1024
+    assert [p[1] for p in pieces[:2]] == [64 * 1024, 128 * 1024]
+    # куски смежные и заканчиваются ровно на границе блока
+    for (o1, l1), (o2, _) in zip(pieces, pieces[1:]):
+        assert o1 + l1 == o2
+    assert pieces[-1][0] + pieces[-1][1] == 2 * BLOCK
+    assert all(is_precise_legal(o, l) for o, l in pieces)
+
+
+def test_short_range_stops_near_end():
+    pieces = ramp_pieces(500_000, 500_100, BLOCK, first=64 * 1024)
+    assert pieces == [(499_712, 4096)]
+    assert is_precise_legal(*pieces[0])
+
+
+def test_precise_rules():
+    assert is_precise_legal(0, 1024 * 1024)
+    assert not is_precise_legal(512 * 1024, 1024 * 1024)  # пересекает границу 1 MiB
+    assert not is_precise_legal(1000, 4096)
+    assert not is_precise_legal(0, 1500)
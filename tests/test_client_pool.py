@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import asyncio
+from pathlib import Path
+from types import SimpleNamespace
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import pytest
+
+from app.api.tgstream.clientpool import ClientPool, FloodWaitError
+
+
+class FakeClient:
+    def __init__(self, dc_id, flood=False):
+        self.session = SimpleNamespace(dc_id=dc_id)
+        self.flood = flood
+        self.direct = 0
+        self.exported = []
+
+    async def __call__(self, request):
+        self.direct += 1
+        if self.flood:
+            err = FloodWaitError.__new__(FloodWaitError)
+            err.seconds = 30
+            raise err
+        return ("direct", self.session.dc_id, request)
+
+    async def _borrow_exported_sender(self, dc_id):
+        self.exported.append(dc_id)
+        return dc_id
+
+    async def _return_exported_sender(self, sender):
+        pass
+
+    async def _call(self, sender, request):
+        return ("exported", sender, request)
+
+
+def test_prefers_session_in_document_dc():
+    pool = ClientPool()
+    dc2, dc4 = FakeClient(2), FakeClient(4)
+    pool.add(dc2, "a")
+    pool.add(dc4, "b")
+
+    assert asyncio.run(pool.call("req", dc_id=4)) == ("direct", 4, "req")
+    assert dc4.direct == 1 and dc2.direct == 0
+
+
+def test_foreign_dc_uses_exported_sender():
+    pool = ClientPool()
+    client = FakeClient(2)
+    pool.add(client, "a")
+
+    assert asyncio.run(pool.call("req", dc_id=5)) == ("exported", 5, "req")
+    assert client.exported == [5]
+
+
+def test_flood_reroutes_to_other_session_then_surfaces():
+    pool = ClientPool()
+    bad, good = FakeClient(2, flood=True), FakeClient(2)
+    pool.add(bad, "bad")
+    pool.add(good, "good")
+
+    assert asyncio.run(pool.call("req", dc_id=2))[0] == "direct"
+    assert pool.status()[0]["cooling_s"] > 0
+
+    good.flood = True
+    with pytest.raises(FloodWaitError):
+        asyncio.run(pool.call("req", dc_id=2))
+
+
+def test_shared_client_keeps_its_flood_threshold():
+    pool = ClientPool()
+    main, extra = FakeClient(2), FakeClient(4)
+    main.flood_sleep_threshold = extra.flood_sleep_threshold = 60
+    pool.add(main, "main", owned=False)
+    pool.add(extra, "pool1")
+    assert main.flood_sleep_threshold == 60
+    assert extra.flood_sleep_threshold == 0
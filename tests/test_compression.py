@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import asyncio
+import gzip
+import json
+from pathlib import Path
+import sys
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+pytest.importorskip("starlette")
+
+from app.api.compression import CompressedBodyCache, CompressionMiddleware, choose_encoding
+
+
+def _app(content_type: bytes, body: bytes, extra=()):
+    async def app(scope, receive, send):
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode()), *extra],
+        })
+        await send({"type": "http.response.body", "body": body, "more_body": False})
+    return app
+
+
+def _call(app, accept=b"gzip"):
+    sent = []
+
+    async def send(msg):
+        sent.append(msg)
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    scope = {"type": "http", "method": "GET", "headers": [(b"accept-encoding", accept)]}
+    asyncio.run(app(scope, receive, send))
+    return dict(sent[0]["headers"]), b"".join(m.get("body", b"") for m in sent[1:])
+
+
+def test_json_is_gzipped():
+    body = json.dumps({"artists": ["a" * 10] * 500}).encode()
+    headers, out = _call(CompressionMiddleware(_app(b"application/json", body)))
+    assert headers[b"content-encoding"] == b"gzip"
+    assert gzip.decompress(out) == body
+    assert int(headers[b"content-length"]) == len(out)
+
+
+def test_audio_passes_through():
+    body = b"\xff\xfb" * 4096
+    headers, out = _call(CompressionMiddleware(_app(b"audio/mpeg", body)))
+    assert b"content-encoding" not in headers
+    assert out == body
+
+
+def test_cacheable_bodies_are_compressed_once():
+    body = json.dumps({"top": list(range(1000))}).encode()
+    cache = CompressedBodyCache(max_bytes=1 << 20)
+    app = CompressionMiddleware(
+        _app(b"application/json", body, [(b"cache-control", b"public, max-age=60")]), cache=cache
+    )
+    first = _call(app)[1]
+    second = _call(app)[1]
+    assert first == second
+    assert cache.misses == 1 and cache.hits == 1
+
+
+def test_encoding_negotiation():
+    assert choose_encoding("") is None
+    assert choose_encoding("gzip;q=0") is None
+    assert choose_encoding("deflate, gzip") == "gzip"
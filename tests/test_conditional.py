@@ -0,0 +1,42 @@
+from __future__ import annotations
+
+from datetime import datetime, timezone
+from pathlib import Path
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from app.api.tgstream.conditional import etag_for, http_date, not_modified, range_allowed
+
+ETAG = etag_for(5566, 1024)
+LAST_MOD = http_date(datetime(2025, 10, 1, 12, 0, tzinfo=timezone.utc))
+
+
+def test_etag_is_strong_and_stable():
+    assert ETAG == '"tg-5566-1024"'
+    assert etag_for(5566, 2048) != ETAG
+
+
+def test_if_none_match():
+    assert not_modified({"if-none-match": ETAG}, ETAG, LAST_MOD)
+    assert not_modified({"if-none-match": f'"x", W/{ETAG}'}, ETAG, LAST_MOD)
+    assert not not_modified({"if-none-match": '"tg-1-1"'}, ETAG, LAST_MOD)
+    # If-None-Match важнее даты
+    assert not not_modified({"if-none-match": '"x"', "if-modified-since": LAST_MOD}, ETAG, LAST_MOD)
+
+
+def test_if_modified_since():
+    assert not_modified({"if-modified-since": LAST_MOD}, ETAG, LAST_MOD)
+    assert not not_modified({"if-modified-since": "Tue, 30 Sep 2025 00:00:00 GMT"}, ETAG, LAST_MOD)
+    assert not not_modified({"if-modified-since": "garbage"}, ETAG, LAST_MOD)
+
+
+def test_if_range():
+    assert range_allowed({}, ETAG, LAST_MOD)
+    assert range_allowed({"if-range": ETAG}, ETAG, LAST_MOD)
+    assert not range_allowed({"if-range": "W/" + ETAG}, ETAG, LAST_MOD)
+    assert not range_allowed({"if-range": '"tg-1-1"'}, ETAG, LAST_MOD)
+    assert range_allowed({"if-range": LAST_MOD}, ETAG, LAST_MOD)
+    assert not range_allowed({"if-range": LAST_MOD}, ETAG, None)
@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+import asyncio
+from pathlib import Path
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import pytest
+
+pytest.importorskip("telethon")
+pytest.importorskip("asyncpg")
+
+from app.api.tgstream.fetcher import FetcherClient, FetcherError, FetcherServer, loc_from_wire, loc_to_wire
+from app.api.tgstream.locations import DocLocation
+
+LOC = DocLocation("chan", 42, 1001, 77, b"\x00ref\xff", 2, 3000, "audio/mpeg")
+
+
+def test_location_roundtrip():
+    assert loc_from_wire(loc_to_wire(LOC)) == LOC
+
+
+def test_stream_locate_and_errors(tmp_path):
+    data = bytes(range(256)) * 12  # 3072 байт
+
+    async def read(loc, start, end, priority, peers):
+        assert loc == LOC and priority == 2 and peers
+        for off in range(start, end + 1, 1000):
+            if off >= 2000 and end == 2999 and start == 1500:
+                raise RuntimeError("telegram broke")
+            yield data[off:min(off + 1000, end + 1)]
+
+    async def locate(req):
+        if req["msg_id"] != 42:
+            return {"ok": False, "status": 404, "detail": "not found"}
+        return {"ok": True, "loc": loc_to_wire(LOC)}
+
+    def error(e):
+        return {"ok": False, "status": 502, "detail": str(e)}
+
+    async def scenario():
+        path = str(tmp_path / "f.sock")
+        server = FetcherServer(path, read=read, handlers={"locate": locate}, error=error)
+        await server.start()
+        client = FetcherClient(path)
+        try:
+            got = b"".join([c async for c in client.read(LOC, 0, 2999, 2)])
+            assert got == data[:3000]
+
+            assert await client.locate("chan", 42, 0) == LOC
+            with pytest.raises(FetcherError) as ei:
+                await client.locate("chan", 43, 0)
+            assert ei.value.status == 404
+
+            parts = []
+            with pytest.raises(FetcherError) as ei:
+                async for c in client.read(LOC, 1500, 2999, 2):
+                    parts.append(c)
+            assert ei.value.detail == "telegram broke" and parts == [data[1500:2500]]
+        finally:
+            await server.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import asyncio
+from pathlib import Path
+import sys
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+pytest.importorskip("starlette")
+
+from app.api.tgstream.filesend import FileRangeResponse
+
+
+def _run(resp, extensions=None):
+    sent = []
+
+    async def send(msg):
+        sent.append(msg)
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    scope = {"type": "http", "method": "GET", "extensions": extensions or {}}
+    asyncio.run(resp(scope, receive, send))
+    return sent
+
+
+def test_range_is_read_in_chunks(tmp_path):
+    path = tmp_path / "a.bin"
+    path.write_bytes(bytes(range(256)) * 4096)  # 1 MiB
+
+    resp = FileRangeResponse(str(path), 100, 300_099, status_code=206, headers={"Content-Range": "x"})
+    sent = _run(resp)
+
+    assert sent[0]["status"] == 206
+    assert (b"content-length", b"300000") in sent[0]["headers"]
+    body = b"".join(m["body"] for m in sent[1:])
+    assert body == path.read_bytes()[100:300_100]
+    assert sent[-1]["more_body"] is False
+
+
+def test_zerocopysend_extension_gets_fd(tmp_path):
+    path = tmp_path / "b.bin"
+    path.write_bytes(b"0123456789")
+
+    sent = _run(FileRangeResponse(str(path), 2, 5), {"http.response.zerocopysend": {}})
+
+    assert sent[1]["type"] == "http.response.zerocopysend"
+    assert sent[1]["offset"] == 2 and sent[1]["count"] == 4
+
+
+def test_missing_file_fails_before_headers(tmp_path):
+    with pytest.raises(OSError):
+        FileRangeResponse(str(tmp_path / "gone.blk"), 0, 10)
+
+
+def test_accel_redirect_points_into_internal_location(tmp_path, monkeypatch):
+    from app.api.tgstream import filesend
+
+    path = tmp_path / "ab" / "abc.blk"
+    path.parent.mkdir()
+    path.write_bytes(b"x" * 16)
+    monkeypatch.setattr(filesend, "OFFLOAD", "accel")
+    monkeypatch.setattr(filesend, "OFFLOAD_ROOT", str(tmp_path))
+    monkeypatch.setattr(filesend, "OFFLOAD_PREFIX", "/_ogma_media/")
+
+    resp = filesend.cached_file_response(
+        str(path), 4, 7, status_code=206, headers={"Content-Range": "bytes 4-7/16", "Content-Length": "4"}
+    )
+
+    assert resp.status_code == 200
+    assert resp.headers["x-accel-redirect"] == "/_ogma_media/ab/abc.blk"
+    assert "content-range" not in resp.headers
+
+
+def test_offload_can_be_refused_per_response(tmp_path, monkeypatch):
+    from app.api.tgstream import filesend
+
+    path = tmp_path / "abc.blk"
+    path.write_bytes(b"x" * 16)
+    monkeypatch.setattr(filesend, "OFFLOAD", "accel")
+    monkeypatch.setattr(filesend, "OFFLOAD_ROOT", str(tmp_path))
+
+    resp = filesend.cached_file_response(str(path), 4, 7, status_code=206, offload=False)
+    assert isinstance(resp, FileRangeResponse) and "x-accel-redirect" not in resp.headers
+    assert resp.headers["content-length"] == "4"
+    resp.close()
+
+
+def test_offload_keeps_the_gateway_validators(tmp_path, monkeypatch):
+    from app.api.tgstream import filesend
+
+    path = tmp_path / "abc.blk"
+    path.write_bytes(b"x" * 16)
+    validators = {"ETag": '"tg-1-16"', "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT"}
+    monkeypatch.setattr(filesend, "OFFLOAD_ROOT", str(tmp_path))
+
+    direct = filesend.cached_file_response(str(path), 0, 15, headers=validators, offload=False)
+    monkeypatch.setattr(filesend, "OFFLOAD", "accel")
+    accel = filesend.cached_file_response(str(path), 0, 15, headers=validators)
+
+    assert "x-accel-redirect" in accel.headers
+    assert accel.headers["etag"] == direct.headers["etag"] == '"tg-1-16"'
+    assert accel.headers["last-modified"] == direct.headers["last-modified"] == validators["Last-Modified"]
+    direct.close()
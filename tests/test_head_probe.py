@@ -0,0 +1,79 @@
+from __future__ import annotations
+
+import asyncio
+from pathlib import Path
+from types import SimpleNamespace
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("telethon")
+pytest.importorskip("asyncpg")
+
+from starlette.datastructures import Headers
+
+from app.api import stream_gateway as sg
+from app.api.tgstream.locations import LocationCache
+
+ROW = {
+    "id": "t1", "chat_username": "chan", "tg_msg_id": 5, "title": "Song", "artists": [], "mime": "audio/mpeg",
+    "size_bytes": 4000, "duration_s": 100, "tg_document_id": 9, "tg_access_hash": 1, "tg_file_ref": b"r",
+    "tg_dc_id": 2, "created_at": None,
+}
+
+
+class _Pool:
+    def __init__(self):
+        self.sql = []
+
+    async def fetchrow(self, sql, *args):
+        self.sql.append(" ".join(sql.split()))
+        return ROW
+
+    async def execute(self, sql, *args):
+        self.sql.append(" ".join(sql.split()))
+
+
+class _TG:
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, request):  # GetFile, JoinChannel и прочие MTProto-запросы
+        self.calls.append(type(request).__name__)
+
+    async def get_messages(self, *args, **kwargs):
+        self.calls.append("get_messages")
+
+
+@pytest.fixture
+def probe(monkeypatch):
+    pool, tg = _Pool(), _TG()
+    monkeypatch.setattr(sg, "_TG", tg)
+    monkeypatch.setattr(sg, "_FETCHER", None)
+    monkeypatch.setattr(sg, "_loc_cache", lambda: LocationCache())
+    monkeypatch.setattr(sg, "_log_play", lambda *a: pytest.fail("HEAD logged a play"))
+    request = SimpleNamespace(app=SimpleNamespace(state=SimpleNamespace(pool=pool)), headers=Headers({"x-user-id": "42"}))
+    return pool, tg, request
+
+
+def test_head_by_id_does_not_log_or_touch_telegram(probe):
+    pool, tg, request = probe
+    resp = asyncio.run(sg.head_stream("t1", request, seek=None))
+
+    assert resp.status_code == 200 and resp.headers["content-length"] == "4000"
+    assert not [s for s in pool.sql if "history" in s]
+    assert tg.calls == []
+
+
+def test_head_by_msg_does_not_log_or_touch_telegram(probe):
+    pool, tg, request = probe
+    resp = asyncio.run(sg.head_stream_by_msg(5, request, chat="@chan"))
+
+    assert resp.status_code == 200 and resp.headers["content-length"] == "4000"
+    assert not [s for s in pool.sql if "history" in s]
+    assert tg.calls == []
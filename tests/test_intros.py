@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import asyncio
+from pathlib import Path
+from types import SimpleNamespace
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("telethon")
+pytest.importorskip("asyncpg")
+
+from app.api import stream_gateway as sg
+
+
+def test_cold_start_is_served_from_intro(monkeypatch):
+    size = 3000
+    intro = b"I" * 1000
+    block = bytes(range(256)) * 12  # 3072 байт, хвост короче CHUNK — конец файла
+    block = block[:size]
+    loads = []
+
+    async def load_intro(pool, doc_id):
+        return intro
+
+    async def load_block(ref, bf, offset, priority=sg.PRIO_STREAM, owner=None):
+        loads.append(offset)
+        return block
+
+    monkeypatch.setattr(sg, "_FETCHER", None)
+    monkeypatch.setattr(sg, "_peers", lambda: SimpleNamespace(ensure_checks=lambda: None, owner_for=lambda d: None))
+    monkeypatch.setattr(sg, "_block_cache", lambda: SimpleNamespace(open=lambda key, size: None))
+    monkeypatch.setattr(sg, "_load_intro", load_intro)
+    monkeypatch.setattr(sg, "_load_block", load_block)
+
+    async def collect():
+        loc = SimpleNamespace(doc_id=1, size=size, duration_s=0)
+        return [c async for c in sg._tg_byte_iter(loc, 0, size - 1)]
+
+    chunks = asyncio.run(collect())
+    assert chunks[0] == intro  # первый ответ — из интро, без ожидания блока
+    assert b"".join(chunks) == intro + block[len(intro):]
+    assert loads == [0]
+
+
+@pytest.mark.parametrize("stored", [False, True])
+def test_seek_without_intro_keeps_short_first_requests(monkeypatch, stored):
+    size = sg.CHUNK + 1000
+    start = 8192
+    intro = bytes(i % 7 for i in range(16384))
+    pieces, blocks = [], []
+
+    async def load_intro(pool, doc_id):
+        return intro if stored else None
+
+    async def load_piece(ref, offset, limit, priority=sg.PRIO_SEEK):
+        pieces.append(offset)
+        return bytes(limit)
+
+    async def load_block(ref, bf, offset, priority=sg.PRIO_STREAM, owner=None):
+        blocks.append(offset)
+        return bytes(min(sg.CHUNK, size - offset))
+
+    monkeypatch.setattr(sg, "_FETCHER", None)
+    monkeypatch.setattr(sg, "_peers", lambda: SimpleNamespace(ensure_checks=lambda: None, owner_for=lambda d: None))
+    monkeypatch.setattr(sg, "_block_cache", lambda: SimpleNamespace(open=lambda key, size: None))
+    monkeypatch.setattr(sg, "_load_intro", load_intro)
+    monkeypatch.setattr(sg, "_load_piece", load_piece)
+    monkeypatch.setattr(sg, "_load_block", load_block)
+
+    async def collect():
+        loc = SimpleNamespace(doc_id=1, size=size, duration_s=0)
+        return b"".join([c async for c in sg._tg_byte_iter(loc, start, size - 1)])
+
+    data = asyncio.run(collect())
+    assert len(data) == size - start
+    if stored:
+        assert data[: len(intro) - start] == intro[start:] and pieces == [] and blocks[0] == 0
+    else:
+        assert pieces and pieces[0] == start and 0 not in blocks  # голову блока добрали короткие запросы
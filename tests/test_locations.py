@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import asyncio
+from pathlib import Path
+from types import SimpleNamespace
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import pytest
+
+pytest.importorskip("asyncpg")
+pytest.importorskip("telethon")
+
+from app.api.tgstream.locations import DocLocation, LocationCache, location_from_row
+
+
+def _loc(msg_id: int, doc_id: int, file_ref: bytes = b"r") -> DocLocation:
+    return DocLocation("chan", msg_id, doc_id, 1, file_ref, 2, 100, None)
+
+
+def test_lru_keeps_recent_and_evicts_oldest():
+    cache = LocationCache(max_items=2)
+    cache.put(_loc(1, 10))
+    cache.put(_loc(2, 20))
+    assert cache.get(("chan", 1)) is not None  # освежили — теперь старейший (chan, 2)
+    cache.put(_loc(3, 30))
+
+    assert len(cache) == 2
+    assert cache.get(("chan", 2)) is None and cache.get_doc(20) is None
+    assert cache.get(("chan", 1)).doc_id == 10 and cache.get_doc(30).msg_id == 3
+
+
+def test_doc_index_follows_replacement_and_invalidate():
+    cache = LocationCache()
+    cache.put(_loc(1, 10))
+    cache.put(_loc(1, 11))  # сообщение перезалили другим документом
+    assert cache.get_doc(10) is None and cache.get_doc(11).msg_id == 1
+
+    cache.put(_loc(2, 20))
+    cache.invalidate(("chan", 2))
+    assert cache.get(("chan", 2)) is None and cache.get_doc(20) is None
+
+    cache.clear()
+    assert len(cache) == 0 and cache.get_doc(11) is None
+
+
+def test_location_from_row_needs_all_tg_columns():
+    row = {
+        "chat_username": "chan", "tg_msg_id": 5, "size_bytes": None, "mime": "audio/mpeg", "duration_s": None,
+        "tg_document_id": 9, "tg_access_hash": 7, "tg_file_ref": memoryview(b"ref"), "tg_dc_id": None,
+    }
+    loc = location_from_row(row)
+    assert loc == DocLocation("chan", 5, 9, 7, b"ref", 0, 0, "audio/mpeg", 0)
+    assert type(loc.file_ref) is bytes  # asyncpg отдаёт bytea не обязательно как bytes
+
+    for col in ("tg_document_id", "tg_access_hash", "tg_file_ref"):
+        assert location_from_row(dict(row, **{col: None})) is None
+
+
+def test_expired_file_reference_is_refreshed_and_retried(monkeypatch):
+    pytest.importorskip("fastapi")
+    from telethon.errors.rpcerrorlist import FileReferenceExpiredError
+
+    from app.api import stream_gateway as sg
+
+    stale, fresh = _loc(5, 9, b"old"), _loc(5, 9, b"new")
+    cache = LocationCache()
+    cache.put(stale)
+    refs = []
+
+    async def call(request, dc_id=None):
+        refs.append(request.location.file_reference)
+        if len(refs) == 1:
+            raise FileReferenceExpiredError(None)
+        return SimpleNamespace(bytes=b"data")
+
+    async def ensure_pool():
+        return SimpleNamespace(call=call, cdn=None)
+
+    async def fetch_location(chat, msg_id, priority=sg.PRIO_STREAM, **kw):
+        return fresh
+
+    monkeypatch.setattr(sg, "_TG", object())
+    monkeypatch.setattr(sg, "_ensure_pool", ensure_pool)
+    monkeypatch.setattr(sg, "_fetch_location", fetch_location)
+    monkeypatch.setattr(sg, "_loc_cache", lambda: cache)
+
+    ref = sg._LocRef(stale)
+    assert asyncio.run(sg._fetch_chunk(ref, 0)) == b"data"
+    assert refs == [b"old", b"new"]  # тот же offset повторён со свежим file_reference
+    assert ref.loc is fresh and cache.get(("chan", 5)) is fresh
@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+import asyncio
+from pathlib import Path
+from types import SimpleNamespace
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("telethon")
+pytest.importorskip("asyncpg")
+
+from telethon import types
+from telethon.errors import RPCError
+from telethon.errors.rpcerrorlist import FileReferenceExpiredError
+
+from app.api import me_send as ms
+
+META = ms.TrackMeta(chat_username="chan", msg_id=5, title="Song", artists=["Band"], mime="audio/mpeg", size_bytes=100)
+ROW = {"doc_id": 11, "access_hash": 22, "file_ref": b"ref", "src_doc_id": 55}
+
+
+class _Bot:
+    def __init__(self, send_errors=(), forward_ok=True):
+        self.sent = []
+        self.forwarded = []
+        self._send_errors = list(send_errors)
+        self._forward_ok = forward_ok
+
+    async def send_file(self, entity, file, **kw):
+        self.sent.append(file)
+        if self._send_errors:
+            raise self._send_errors.pop(0)
+        return SimpleNamespace(document=SimpleNamespace(id=33, access_hash=44, file_reference=b"new"))
+
+    async def forward_messages(self, entity, messages, from_peer):
+        self.forwarded.append((from_peer, messages))
+        if not self._forward_ok:
+            raise RPCError(None, "CHAT_FORWARDS_RESTRICTED")
+
+
+class _Pool:
+    def __init__(self, row):
+        self.row = row
+        self.sql = []
+
+    async def fetchrow(self, sql, *args):
+        return self.row
+
+    async def execute(self, sql, *args):
+        self.sql.append(" ".join(sql.split()))
+
+
+@pytest.fixture
+def bot(monkeypatch):
+    def install(**kw):
+        b = _Bot(**kw)
+        monkeypatch.setattr(ms, "_BOT", b)
+        monkeypatch.setattr(ms, "_BOT_ID", 7)
+        return b
+
+    monkeypatch.setattr(ms, "_loc_cache", lambda: {})
+    return install
+
+
+def _ran(pool, verb):
+    return [s for s in pool.sql if s.startswith(verb)]
+
+
+def test_cache_hit_sends_stored_document(bot):
+    b = bot()
+    pool = _Pool(dict(ROW))
+
+    asyncio.run(ms._send_track_to_user(pool, 1, META))
+
+    assert len(b.sent) == 1 and not b.forwarded
+    doc = b.sent[0]
+    assert isinstance(doc, types.InputDocument)
+    assert (doc.id, doc.access_hash, doc.file_reference) == (11, 22, b"ref")
+    assert _ran(pool, "update bot_file_ids set sends")
+
+
+def test_rejected_document_is_forgotten_and_reuploaded(bot, monkeypatch):
+    b = bot(send_errors=[FileReferenceExpiredError(None)], forward_ok=False)
+    pool = _Pool(dict(ROW))
+    loc = SimpleNamespace(doc_id=55, size=100)
+
+    async def fetch_location(chat, msg_id, priority):
+        return loc
+
+    async def reupload(pool, l, name):
+        return "uploaded"
+
+    monkeypatch.setattr(ms, "_fetch_location", fetch_location)
+    monkeypatch.setattr(ms, "_reupload_via_bot", reupload)
+
+    asyncio.run(ms._send_track_to_user(pool, 1, META))
+
+    assert _ran(pool, "delete from bot_file_ids")
+    assert b.forwarded == [("chan", 5)]
+    assert b.sent[1] == "uploaded"  # после отказа — пересылка, потом перезаливка
+    assert _ran(pool, "insert into bot_file_ids")
+
+
+def test_changed_source_document_invalidates_row(bot, monkeypatch):
+    b = bot()
+    pool = _Pool(dict(ROW))
+    monkeypatch.setattr(ms, "_loc_cache", lambda: {("chan", 5): SimpleNamespace(doc_id=99)})
+
+    asyncio.run(ms._send_track_to_user(pool, 1, META))
+
+    assert _ran(pool, "delete from bot_file_ids")
+    assert not b.sent and b.forwarded == [("chan", 5)]
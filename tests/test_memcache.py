@@ -0,0 +1,31 @@
+from __future__ import annotations
+
+from pathlib import Path
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from app.api.tgstream.memcache import ChunkLRU
+
+
+def test_byte_budget_evicts_least_recent():
+    lru = ChunkLRU(max_bytes=300, head_blocks=1)
+    a, b, c = b"a" * 100, b"b" * 100, b"c" * 150
+    assert lru.offer((1, 0), a) and lru.offer((2, 0), b)
+    assert lru.get((1, 0)) is a  # тот же объект — без копии
+    assert lru.offer((3, 0), c)
+    assert lru.bytes == 250 and (2, 0) not in lru and (1, 0) in lru
+    assert lru.evicted == 100
+    assert lru.get((2, 0)) is None
+    assert (lru.hits, lru.misses) == (1, 1)
+
+
+def test_tail_blocks_admitted_on_second_read():
+    lru = ChunkLRU(max_bytes=1000, head_blocks=1)
+    assert not lru.offer((1, 5), b"x" * 10)
+    assert (1, 5) not in lru
+    assert lru.offer((1, 5), b"x" * 10)
+    assert (1, 5) in lru
+    assert not ChunkLRU(max_bytes=0).offer((1, 0), b"x")
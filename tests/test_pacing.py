@@ -0,0 +1,43 @@
+from __future__ import annotations
+
+from pathlib import Path
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from app.api.tgstream.pacing import PlaybackPacer
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_window_follows_playback_not_socket():
+    clock = _Clock()
+    pacer = PlaybackPacer(bitrate=1000, ahead_s=10, clock=clock)
+    assert pacer.allows(9_999, 0) and not pacer.allows(10_000, 0)
+
+    pacer.started()
+    clock.now += 5
+    # клиент забрал 60 секунд звука за 5 секунд — играет он всё равно 5-ю секунду
+    assert pacer.position_s(60_000) == 5
+    assert not pacer.allows(15_000, 60_000)
+    assert pacer.delay(20_000, 60_000) == 5
+
+    # клиент отстаёт (буферизация) — позиция по полученным байтам
+    assert pacer.position_s(2_000) == 2
+    assert pacer.limit(2_000) == 12_000
+
+
+def test_min_ahead_and_unknown_duration():
+    pacer = PlaybackPacer(bitrate=10, ahead_s=1, min_ahead=4096, clock=_Clock())
+    assert pacer.allows(4095, 0) and pacer.delay(4095, 0) == 0
+    assert PlaybackPacer.for_track(5_000_000, None) is None
+    assert PlaybackPacer.for_track(5_000_000, 200, ahead_s=0) is None
+    assert PlaybackPacer.for_track(5_000_000, 200).bitrate == 25_000
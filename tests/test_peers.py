@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+from collections import Counter
+from pathlib import Path
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import pytest
+
+pytest.importorskip("httpx")
+
+from app.api.tgstream.peers import FAILS_TO_DOWN, HashRing, PeerSet
+
+NODES = ["http://a/api", "http://b/api", "http://c/api"]
+
+
+def test_ring_spreads_and_moves_only_dead_node_keys():
+    ring = HashRing(NODES)
+    owners = {k: ring.owner(str(k)) for k in range(3000)}
+    counts = Counter(owners.values())
+    assert set(counts) == set(NODES)
+    assert min(counts.values()) > 600  # без сильного перекоса
+
+    alive = lambda n: n != "http://b/api"  # noqa: E731
+    moved = {k for k in owners if ring.owner(str(k), alive) != owners[k]}
+    assert moved == {k for k, n in owners.items() if n == "http://b/api"}
+
+
+def test_peer_set_owner_and_rebalance():
+    peers = PeerSet(NODES, self_url="http://a/api", token="t")
+    docs = range(500)
+    remote = {d: peers.owner_for(d) for d in docs}
+    assert None in remote.values() and "http://b/api" in remote.values()
+
+    for _ in range(FAILS_TO_DOWN):
+        peers.mark("http://b/api", False)
+    assert not peers.alive("http://b/api")
+    assert "http://b/api" not in {peers.owner_for(d) for d in docs}
+
+    peers.mark("http://b/api", True)
+    assert {d: peers.owner_for(d) for d in docs} == remote
+
+
+def test_sharding_disabled_without_self_in_nodes():
+    assert PeerSet(NODES, self_url="http://x/api", token="t").owner_for(1) is None
+    assert PeerSet(["http://a/api"], self_url="http://a/api", token="t").owner_for(1) is None
+
+
+def test_sharding_disabled_without_token():
+    peers = PeerSet(NODES, self_url="http://a/api", token="")
+    assert not peers.enabled
+    assert {peers.owner_for(d) for d in range(100)} == {None}
+
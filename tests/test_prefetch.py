@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import asyncio
+import uuid
+from pathlib import Path
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import pytest
+
+pytest.importorskip("asyncpg")
+
+from app.api.tgstream.prefetch import PlaylistPrefetcher, next_tracks
+
+
+class _FakePool:
+    def __init__(self, playlist):
+        self.playlist = playlist
+        self.queries = []
+
+    async def fetchrow(self, sql, *args):
+        self.queries.append(sql)
+        return self.playlist
+
+    async def fetch(self, sql, *args):
+        self.queries.append(sql)
+        return [{"id": "next"}]
+
+
+def test_next_tracks_respects_access_and_personal_playlist():
+    pid = str(uuid.uuid4())
+    private = _FakePool({"id": pid, "user_id": 1, "kind": "custom", "is_public": False})
+    assert asyncio.run(next_tracks(private, 2, "t", playlist_id=pid)) == []
+
+    personal = _FakePool({"id": pid, "user_id": 1, "kind": "system", "is_public": False})
+    assert asyncio.run(next_tracks(personal, 1, "t", playlist_id=pid)) == [{"id": "next"}]
+    assert "user_playlist_items" in personal.queries[-1]
+
+
+def test_hint_dedupes_and_skip_elsewhere_cancels():
+    runs = []
+
+    async def fake_run(self, job, pool, user_id, playlist_id, playlist_handle):
+        runs.append(job.track_id)
+        job.keys = {job.track_id, "b", ("chan", 2)}
+        await asyncio.sleep(10)
+
+    async def scenario():
+        pf = PlaylistPrefetcher()
+        pf._run = fake_run.__get__(pf)
+        pf.hint(1, None, "a", playlist_id="p")
+        pf.hint(1, None, "a", playlist_id="p")  # повторный пинг того же трека
+        await asyncio.sleep(0)
+        task = pf._jobs[1].task
+
+        pf.played(1, ("chan", 2))  # следующий трек плейлиста — префетч остаётся
+        assert not task.cancelled() and 1 in pf._jobs
+
+        pf.played(1, "zzz")  # ушёл в другое место
+        await asyncio.sleep(0)
+        assert task.cancelled() and 1 not in pf._jobs
+
+    asyncio.run(scenario())
+    assert runs == ["a"]
+
+
+def test_prefetched_location_keeps_duration_for_pacing(monkeypatch):
+    pytest.importorskip("fastapi")
+    pytest.importorskip("telethon")
+    from types import SimpleNamespace
+
+    from app.api import stream_gateway as sg
+    from app.api.tgstream import prefetch
+    from app.api.tgstream.locations import LocationCache
+    from app.api.tgstream.pacing import PlaybackPacer
+
+    lru = LocationCache()
+    monkeypatch.setattr(sg, "_loc_cache", lambda: lru)
+    monkeypatch.setattr(sg, "_peers", lambda: SimpleNamespace(owner_for=lambda d: "http://b/api"))
+
+    priorities = []
+
+    async def byte_iter(loc, start, end, pool=None, priority=sg.PRIO_STREAM, peers=True):
+        priorities.append(priority)
+        yield b""
+
+    monkeypatch.setattr(sg, "_tg_byte_iter", byte_iter)
+    assert "t.duration_s" in prefetch._TRACK_COLS
+    row = {
+        "id": "t2", "chat_username": "chan", "tg_msg_id": 6, "size_bytes": 5_000_000, "mime": "audio/mpeg",
+        "tg_document_id": 9, "tg_access_hash": 1, "tg_file_ref": b"r", "tg_dc_id": 2, "duration_s": 200,
+    }
+    asyncio.run(PlaylistPrefetcher()._prefetch(sg, None, row))
+    assert priorities == [prefetch.PRIO_BACKGROUND]  # спекулятивный префетч — ниже /download и me_send
+
+    loc, size, _ = asyncio.run(sg._track_location(None, row))
+    assert PlaybackPacer.for_track(size, loc.duration_s) is not None
+
+    # запись, положенная в LRU без длительности, добирает её из строки tracks
+    lru.put(sg._dc_replace(loc, msg_id=7, duration_s=0))
+    loc, size, _ = asyncio.run(sg._track_location(None, dict(row, tg_msg_id=7)))
+    assert loc.duration_s == 200 and lru.get(("chan", 7)).duration_s == 200
@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+import asyncio
+from pathlib import Path
+from types import SimpleNamespace
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("telethon")
+pytest.importorskip("asyncpg")
+
+from app.api import stream_gateway as sg
+
+CHUNK = 16
+
+
+def test_out_of_order_blocks_are_reassembled_with_backpressure(monkeypatch):
+    size = 6 * CHUNK
+    gates = {off: asyncio.Event() for off in range(0, size, CHUNK)}
+    started, cancelled = [], []
+
+    async def load_block(ref, bf, offset, priority=sg.PRIO_STREAM, owner=None):
+        started.append(offset)
+        try:
+            await gates[offset].wait()
+        except asyncio.CancelledError:
+            cancelled.append(offset)
+            raise
+        return bytes([offset // CHUNK]) * CHUNK
+
+    async def load_intro(pool, doc_id):
+        return None
+
+    monkeypatch.setattr(sg, "CHUNK", CHUNK)
+    monkeypatch.setattr(sg, "READ_AHEAD", 3)
+    monkeypatch.setattr(sg, "_FETCHER", None)
+    monkeypatch.setattr(sg, "_peers", lambda: SimpleNamespace(ensure_checks=lambda: None, owner_for=lambda d: None))
+    monkeypatch.setattr(sg, "_block_cache", lambda: SimpleNamespace(open=lambda key, size: None))
+    monkeypatch.setattr(sg, "_mem_cache", lambda: set())
+    monkeypatch.setattr(sg, "_load_intro", load_intro)
+    monkeypatch.setattr(sg, "_load_block", load_block)
+
+    async def settle():
+        for _ in range(5):
+            await asyncio.sleep(0)
+
+    async def run():
+        loc = SimpleNamespace(doc_id=1, size=size, duration_s=0)
+        agen = sg._tg_byte_iter(loc, 0, size - 1)
+        first = asyncio.ensure_future(agen.__anext__())
+        await settle()
+        assert started == [0, 16, 32]  # окно READ_AHEAD, дальше не забегаем
+
+        gates[32].set()
+        gates[16].set()
+        await settle()
+        assert not first.done()  # поздние блоки готовы, но первый ещё нет
+        gates[0].set()
+        assert await first == bytes([0]) * CHUNK
+
+        await settle()
+        assert started == [0, 16, 32]  # клиент не забрал чанк — новых запросов нет
+        assert await agen.__anext__() == bytes([1]) * CHUNK
+        await settle()
+        assert started == [0, 16, 32, 48]
+
+        await agen.aclose()
+        await settle()
+        assert cancelled == [48]
+
+    asyncio.run(run())
@@ -0,0 +1,79 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from pathlib import Path
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from app.api.tgstream.scheduler import BACKGROUND, BULK, STREAM, FloodWaitError, TgScheduler
+
+
+def test_higher_priority_goes_first():
+    sched = TgScheduler(rate=1000, burst=1000, max_inflight=1)
+    order = []
+
+    async def job(name):
+        order.append(name)
+        await asyncio.sleep(0.01)
+
+    async def main():
+        blocker = asyncio.create_task(sched.call(lambda: job("first"), BULK))
+        await asyncio.sleep(0)
+        tasks = [
+            asyncio.create_task(sched.call(lambda: job("warm"), BACKGROUND)),
+            asyncio.create_task(sched.call(lambda: job("download"), BULK)),
+            asyncio.create_task(sched.call(lambda: job("stream"), STREAM)),
+        ]
+        await asyncio.gather(blocker, *tasks)
+
+    asyncio.run(main())
+    assert order == ["first", "stream", "download", "warm"]
+
+
+def test_flood_wait_pauses_everyone_and_retries():
+    sched = TgScheduler(rate=1000, burst=1000, max_inflight=4)
+    calls = 0
+
+    async def flaky():
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            err = FloodWaitError.__new__(FloodWaitError)  # без telethon-запроса
+            err.seconds = 0  # ждать будем только note_flood ниже
+            raise err
+        return "ok"
+
+    async def main():
+        sched.note_flood(0.05)
+        t0 = time.monotonic()
+        res = await sched.call(flaky, STREAM)
+        return res, time.monotonic() - t0
+
+    res, waited = asyncio.run(main())
+    assert res == "ok" and calls == 2
+    assert waited >= 0.04
+
+
+def test_background_cannot_take_all_slots():
+    sched = TgScheduler(rate=1000, burst=1000, max_inflight=4)
+    release = None
+
+    async def hold():
+        await release.wait()
+
+    async def main():
+        nonlocal release
+        release = asyncio.Event()
+        bg = [asyncio.create_task(sched.call(hold, BACKGROUND)) for _ in range(4)]
+        await asyncio.sleep(0.01)
+        assert sched.inflight == 1 and sched.queued(BACKGROUND) == 3
+        got = await asyncio.wait_for(sched.call(lambda: asyncio.sleep(0, "stream"), STREAM), 1)
+        release.set()
+        await asyncio.gather(*bg)
+        return got
+
+    assert asyncio.run(main()) == "stream"
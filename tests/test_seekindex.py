@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import struct
+from pathlib import Path
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import pytest
+
+pytest.importorskip("asyncpg")
+
+from app.api.tgstream.seekindex import (
+    SeekIndex,
+    find_frame,
+    find_moov,
+    mp3_index,
+    mp4_index,
+    mp4_moov_location,
+)
+
+# MPEG1 Layer III, 128 кбит/с, 44.1 кГц, стерео: фрейм 417 байт
+_HDR = b"\xff\xfb\x90\x00"
+_FRAME = _HDR + b"\x00" * 413
+
+
+def _id3(n: int) -> bytes:
+    size = bytes([(n >> 21) & 0x7F, (n >> 14) & 0x7F, (n >> 7) & 0x7F, n & 0x7F])
+    return b"ID3\x04\x00\x00" + size + b"\x00" * n
+
+
+def test_xing_toc_maps_time_to_bytes():
+    tag = _id3(100)
+    n_frames, n_bytes = 1000, 1000 * 417
+    toc = bytes(min(255, i * i // 39) for i in range(100))  # VBR: байты растут быстрее времени
+    xing = _HDR + b"\x00" * 32 + b"Xing" + struct.pack(">III", 7, n_frames, n_bytes) + toc
+    data = tag + xing + b"\x00" * (417 - len(xing)) + _FRAME * 20
+    size = len(tag) + n_bytes
+
+    idx = mp3_index(data, size)
+    assert idx is not None and idx.kind == "mp3"
+    assert idx.audio_start == len(tag)
+    assert idx.duration_ms == n_frames * 1152 * 1000 // 44100
+    ms, off = idx.lookup(idx.duration_ms / 2000)
+    assert off == len(tag) + toc[50] * n_bytes // 256
+    assert SeekIndex.unpack_points(idx.pack_points()) == idx.points
+
+
+def test_cbr_without_toc_is_linear_and_frames_resync():
+    data = _FRAME * 10
+    idx = mp3_index(data, 417 * 1000, duration_s=26)
+    assert idx.points == ((0, 0), (26000, 417 * 1000))
+    assert idx.lookup(13)[1] == 417 * 500
+    # середина фрейма → следующий настоящий заголовок
+    assert find_frame(data, 5) == 417
+    assert find_frame(b"\xff\xfb\x90\x00garbage") == 0  # следующий фрейм вне окна
+    assert find_frame(b"\xff\xfb\x90\x00" + b"\x00" * 413 + b"junk") is None
+
+
+def _box(kind: bytes, payload: bytes) -> bytes:
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+
+def _full(kind: bytes, payload: bytes) -> bytes:
+    return _box(kind, b"\x00\x00\x00\x00" + payload)
+
+
+def _moov(offsets) -> bytes:
+    mdhd = _full(b"mdhd", struct.pack(">IIII", 0, 0, 1000, 10_000) + b"\x00" * 4)
+    hdlr = _full(b"hdlr", b"\x00" * 4 + b"soun" + b"\x00" * 13)
+    stts = _full(b"stts", struct.pack(">III", 1, 100, 100))  # 100 сэмплов по 0.1 с
+    stsc = _full(b"stsc", struct.pack(">IIII", 1, 1, 10, 1))  # по 10 сэмплов в чанке
+    stco = _full(b"stco", struct.pack(f">I{len(offsets)}I", len(offsets), *offsets))
+    stbl = _box(b"stbl", stts + stsc + stco)
+    mdia = _box(b"mdia", mdhd + hdlr + _box(b"minf", stbl))
+    return _box(b"moov", _box(b"trak", mdia))
+
+
+def test_mp4_moov_at_end_and_chunk_lookup():
+    offsets = [1000 + i * 500 for i in range(10)]
+    ftyp = _box(b"ftyp", b"M4A \x00\x00\x00\x00")
+    mdat_len = 6000
+    head = ftyp + struct.pack(">I4s", mdat_len, b"mdat")  # дальше — аудио, moov за ним
+    size = len(ftyp) + mdat_len + len(_moov(offsets))
+
+    off, length = mp4_moov_location(head, size)
+    assert (off, length) == (len(ftyp) + mdat_len, 0)
+
+    tail = _moov(offsets)
+    found = find_moov(tail)
+    idx = mp4_index(tail[found[0] : found[0] + found[1]], off)
+    assert idx.kind == "mp4" and idx.duration_ms == 10_000 and idx.moov_offset == off
+    assert idx.points[3] == (3000, 2500)
+    assert idx.lookup(3.7) == (3000, 2500)  # начало чанка, внутри которого 3.7 с
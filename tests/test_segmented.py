@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import asyncio
+from pathlib import Path
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import pytest
+
+from app.api.tgstream import segmented
+from app.api.tgstream.segmented import segmented_blocks, split_segments
+
+BLOCK = 16
+
+
+def _block(idx: int) -> bytes:
+    return bytes([idx % 256]) * BLOCK
+
+
+def _run(load, reread=None, cached=lambda i: False, **kw):
+    async def reread_default(idx):
+        return None
+
+    async def collect():
+        out = []
+        async for idx, data in segmented_blocks(
+            load, reread or reread_default, 0, 9, lambda i: BLOCK, cached=cached, **kw
+        ):
+            out.append((idx, data))
+        return out
+
+    return asyncio.run(collect())
+
+
+def test_split_segments_cover_range():
+    assert split_segments(0, 9, 4) == [[0, 2], [3, 5], [6, 7], [8, 9]]
+    assert split_segments(5, 6, 8) == [[5, 5], [6, 6]]
+
+
+def test_blocks_come_in_order_and_failed_block_is_retried_alone(monkeypatch):
+    monkeypatch.setattr(segmented, "BACKOFF_BASE", 0)
+    calls = []
+
+    async def load(idx):
+        calls.append(idx)
+        await asyncio.sleep(0.001 * (10 - idx))  # дальние сегменты успевают раньше
+        if idx == 4 and calls.count(4) == 1:
+            raise ConnectionError("boom")
+        return _block(idx)
+
+    disk = {}
+
+    async def reread(idx):
+        return disk.get(idx)
+
+    out = _run(load, reread, segments=3, keep=100)
+    assert [i for i, _ in out] == list(range(10))
+    assert all(data == _block(i) for i, data in out)
+    assert calls.count(4) == 2 and all(calls.count(i) == 1 for i in range(10) if i != 4)
+
+
+def test_exhausted_retries_surface_at_that_block(monkeypatch):
+    monkeypatch.setattr(segmented, "BACKOFF_BASE", 0)
+
+    async def load(idx):
+        if idx == 7:
+            raise ConnectionError("dead")
+        return _block(idx)
+
+    got = []
+
+    async def collect():
+        async for idx, _ in segmented_blocks(
+            load, lambda i: asyncio.sleep(0, None), 0, 9, lambda i: BLOCK, segments=2, retries=1, keep=100
+        ):
+            got.append(idx)
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(collect())
+    assert got == list(range(7))
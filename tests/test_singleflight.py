@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import asyncio
+from pathlib import Path
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from app.api.tgstream.scheduler import BACKGROUND, BULK, STREAM, TgScheduler, Ticket
+from app.api.tgstream.singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_fetch():
+    flights = SingleFlight()
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return b"block"
+
+    async def main():
+        return await asyncio.gather(*(flights.do(("doc", 0), fetch) for _ in range(5)))
+
+    assert asyncio.run(main()) == [b"block"] * 5
+    assert calls == 1
+    assert flights.started == 1 and flights.shared == 4
+    assert len(flights) == 0
+
+
+def test_one_waiter_leaving_does_not_cancel_others():
+    flights = SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.02)
+        return b"ok"
+
+    async def main():
+        leaver = asyncio.create_task(flights.do("k", fetch))
+        stayer = asyncio.create_task(flights.do("k", fetch))
+        await asyncio.sleep(0.005)
+        leaver.cancel()
+        return await stayer
+
+    assert asyncio.run(main()) == b"ok"
+
+
+def test_last_waiter_leaving_cancels_fetch():
+    flights = SingleFlight()
+    finished = False
+
+    async def fetch():
+        nonlocal finished
+        await asyncio.sleep(0.05)
+        finished = True
+
+    async def main():
+        waiter = asyncio.create_task(flights.do("k", fetch))
+        await asyncio.sleep(0.005)
+        waiter.cancel()
+        await asyncio.sleep(0.08)
+
+    asyncio.run(main())
+    assert not finished
+
+
+def test_caller_after_cancel_starts_fresh_flight():
+    flights = SingleFlight()
+    started = 0
+
+    async def fetch():
+        nonlocal started
+        started += 1
+        try:
+            await asyncio.sleep(0.05)
+        except asyncio.CancelledError:
+            await asyncio.sleep(0.01)  # отмена доходит не мгновенно
+            raise
+        return b"fresh"
+
+    async def main():
+        waiter = asyncio.create_task(flights.do("k", fetch))
+        await asyncio.sleep(0.005)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        return await flights.do("k", fetch)
+
+    assert asyncio.run(main()) == b"fresh"
+    assert started == 2
+
+
+def test_stream_joining_background_flight_raises_its_priority():
+    sched = TgScheduler(rate=1000, burst=1000, max_inflight=1)
+    flights = SingleFlight()
+    order = []
+
+    async def job(name):
+        order.append(name)
+        await asyncio.sleep(0.01)
+        return name
+
+    async def main():
+        blocker = asyncio.create_task(sched.call(lambda: job("busy"), BULK))
+        await asyncio.sleep(0)
+        warm = Ticket(BACKGROUND)
+        warming = asyncio.create_task(flights.do("blk", lambda: sched.call(lambda: job("block"), warm), warm))
+        download = asyncio.create_task(sched.call(lambda: job("download"), BULK))
+        await asyncio.sleep(0)
+        # стрим подсел на блок прогрева — полёт уходит в очередь классом стрима
+        got = await flights.do("blk", lambda: job("dup"), Ticket(STREAM))
+        assert warm.priority == STREAM
+        await asyncio.gather(blocker, warming, download)
+        return got
+
+    assert asyncio.run(main()) == "block"
+    assert order == ["busy", "block", "download"]
+    assert sched.inflight == 0 and sched.queued() == 0
@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import asyncio
+from pathlib import Path
+from types import SimpleNamespace
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("telethon")
+pytest.importorskip("asyncpg")
+
+from starlette.datastructures import Headers
+
+from app.api import stream_gateway as sg
+from app.api.tgstream import filesend
+from app.api.tgstream.filesend import FileRangeResponse
+
+SIZE = 4000
+BASE = 1000
+
+
+@pytest.fixture
+def cached_track(tmp_path, monkeypatch):
+    """Трек целиком в блочном кеше, индекс перемотки отправляет ?t= на байт BASE."""
+    blk = tmp_path / "ab" / "1.blk"
+    blk.parent.mkdir()
+    blk.write_bytes(bytes(i % 251 for i in range(SIZE)))
+    loc = SimpleNamespace(doc_id=1, size=SIZE, duration_s=100, mime="audio/mpeg")
+    row = {"id": "t1", "chat_username": "chan", "tg_msg_id": 5, "size_bytes": SIZE, "mime": "audio/mpeg",
+           "tg_document_id": 1}
+    bf = SimpleNamespace(data_path=str(blk), block_size=SIZE, missing=lambda first, last: [])
+
+    async def db_get_track(pool, track_id):
+        return row
+
+    async def track_location(pool, t):
+        return loc, SIZE, "audio/mpeg"
+
+    async def seek_index(pool, l):
+        return SimpleNamespace(kind="mp3")
+
+    async def seek_offset(pool, l, idx, t):
+        return int(t * 1000), BASE
+
+    monkeypatch.setattr(sg, "_db_get_track", db_get_track)
+    monkeypatch.setattr(sg, "_track_location", track_location)
+    monkeypatch.setattr(sg, "_seek_index", seek_index)
+    monkeypatch.setattr(sg, "_seek_offset", seek_offset)
+    monkeypatch.setattr(sg, "_maybe_user_id", lambda request: None)
+    monkeypatch.setattr(sg, "_mem_cache", lambda: SimpleNamespace(enabled=False))
+    monkeypatch.setattr(sg, "_block_cache", lambda: SimpleNamespace(open=lambda key, size: bf))
+    monkeypatch.setattr(sg, "_cache_mgr", lambda: SimpleNamespace(record=lambda path, hit: None))
+    monkeypatch.setattr(filesend, "OFFLOAD", "accel")
+    monkeypatch.setattr(filesend, "OFFLOAD_ROOT", str(tmp_path))
+    return blk
+
+
+def _request(**headers):
+    return SimpleNamespace(app=SimpleNamespace(state=SimpleNamespace(pool=object())), headers=Headers(headers))
+
+
+def test_seek_bypasses_offload(cached_track):
+    plain = asyncio.run(sg.stream_track("t1", _request(), seek=None))
+    assert "x-accel-redirect" in plain.headers  # без ?t= байты отдаёт nginx
+
+    resp = asyncio.run(sg.stream_track("t1", _request(range="bytes=0-99"), seek=2.5))
+    assert isinstance(resp, FileRangeResponse) and "x-accel-redirect" not in resp.headers
+    assert (resp.start, resp.end) == (BASE, BASE + 99)  # Range клиента — от base
+    assert resp.headers["content-range"] == f"bytes 0-99/{SIZE - BASE}"
+    assert resp.headers["x-seek-time"] == "2.500"
+    resp.close()
+
+
+def test_head_describes_the_seek_file(cached_track):
+    plain = asyncio.run(sg.head_stream("t1", _request(), seek=None))
+    resp = asyncio.run(sg.head_stream("t1", _request(), seek=2.5))
+    assert resp.headers["content-length"] == str(SIZE - BASE)
+    assert resp.headers["x-seek-time"] == "2.500"
+    assert resp.headers["etag"] != plain.headers["etag"]
+    assert resp.headers["etag"] == sg._validators(1, SIZE, None, BASE)[0]
+
+
+def test_seek_without_index_is_not_immutable(cached_track, monkeypatch):
+    indexed = asyncio.run(sg.stream_track("t1", _request(), seek=2.5))
+    assert "immutable" in indexed.headers["cache-control"]
+    indexed.close()
+
+    async def no_index(pool, loc):
+        return None
+
+    monkeypatch.setattr(sg, "_seek_index", no_index)
+    resp = asyncio.run(sg.stream_track("t1", _request(), seek=2.5))
+    head = asyncio.run(sg.head_stream("t1", _request(), seek=2.5))
+    for r in (resp, head):
+        assert "immutable" not in r.headers["cache-control"]
+        assert f"max-age={sg._SEEK_FALLBACK_MAX_AGE}," in r.headers["cache-control"]
+    assert "x-seek-time" not in resp.headers
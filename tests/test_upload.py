@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+from pathlib import Path
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import pytest
+
+from app.api.tgstream import upload
+from app.api.tgstream.upload import part_count, pipe_parts
+
+
+async def _chunks(data: bytes, step: int):
+    for i in range(0, len(data), step):
+        yield memoryview(data)[i:i + step]
+        await asyncio.sleep(0)
+
+
+def test_parts_are_rebuffered_and_bounded(monkeypatch):
+    monkeypatch.setattr(upload, "BACKOFF_BASE", 0)
+    data = bytes(range(256)) * 41  # 10496 байт → 11 частей по 1024, хвост 256
+    got = {}
+    live = peak = 0
+    failed_once = set()
+
+    async def send(idx, total, part, big):
+        nonlocal live, peak
+        live += 1
+        peak = max(peak, live)
+        try:
+            await asyncio.sleep(0.001 * (idx % 3))
+            if idx == 4 and idx not in failed_once:
+                failed_once.add(idx)
+                raise ConnectionError("drop")
+            assert total == 11 and not big
+            got[idx] = part
+        finally:
+            live -= 1
+
+    md5 = asyncio.run(pipe_parts(send, _chunks(data, 700), len(data), part_size=1024, parallel=3))
+    assert part_count(len(data), 1024) == 11
+    assert b"".join(got[i] for i in range(11)) == data
+    assert all(len(got[i]) == 1024 for i in range(10))
+    assert peak <= 3
+    assert md5 == hashlib.md5(data).hexdigest()
+
+
+def test_short_stream_and_failed_part_raise(monkeypatch):
+    monkeypatch.setattr(upload, "BACKOFF_BASE", 0)
+
+    async def ok(idx, total, part, big):
+        pass
+
+    with pytest.raises(ValueError):
+        asyncio.run(pipe_parts(ok, _chunks(b"x" * 1000, 300), 2000, part_size=512))
+
+    async def broken(idx, total, part, big):
+        raise ConnectionError("down")
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(pipe_parts(broken, _chunks(b"x" * 4096, 512), 4096, part_size=512, retries=1))
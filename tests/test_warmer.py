@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+import asyncio
+from pathlib import Path
+from types import SimpleNamespace
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import pytest
+
+pytest.importorskip("asyncpg")
+
+from app.api.tgstream import warmer
+from app.api.tgstream.blockcache import BlockCache
+from app.api.tgstream.warmer import Pacer, Warmer, in_hours, missing_runs, parse_hours
+
+BLOCK = 512 * 1024
+
+
+def test_quiet_hours_wrap_midnight():
+    night = parse_hours("23-6")
+    assert in_hours(night, 23) and in_hours(night, 0) and in_hours(night, 5)
+    assert not in_hours(night, 6) and not in_hours(night, 12)
+    assert in_hours(parse_hours(""), 12)
+    assert parse_hours("2-8, 13") == [(2, 8), (13, 14)]
+
+
+def test_pacer_and_missing_runs():
+    now = [0.0]
+    pacer = Pacer(1000, clock=lambda: now[0])
+    assert pacer.delay(500) == pytest.approx(0.5)
+    now[0] = 2.0
+    assert pacer.delay(500) == 0.0  # простояли дольше, чем надо на 1000 байт
+    assert missing_runs([0, 1, 3, 5, 6]) == [(0, 1), (3, 3), (5, 6)]
+
+
+def test_warm_track_fetches_only_missing_blocks(tmp_path, monkeypatch):
+    cache = BlockCache(str(tmp_path))
+    monkeypatch.setattr(warmer, "_block_cache", lambda: cache)
+    size = 3 * BLOCK + 100
+    cache.open("77", size).write_block(1, b"x" * BLOCK)
+
+    reads = []
+
+    async def get_location(pool, chat, msg_id, row):
+        return SimpleNamespace(doc_id=77, size=size)
+
+    async def byte_iter(loc, start, end, pool, priority):
+        reads.append((start, end, priority))
+        yield b"y" * (end - start + 1)
+
+    sg = SimpleNamespace(
+        _peers=lambda: SimpleNamespace(owner_for=lambda doc_id: None),
+        _get_location=get_location,
+        _tg_byte_iter=byte_iter,
+    )
+    w = Warmer(pool=None, rate=0, hours="")
+    row = {"id": "t", "chat_username": "c", "tg_msg_id": 1, "tg_document_id": 77}
+    n = asyncio.run(w._warm_track(sg, row, Pacer(0), budget=1 << 30))
+
+    assert reads == [(0, BLOCK - 1, warmer.PRIO_BACKGROUND), (2 * BLOCK, size - 1, warmer.PRIO_BACKGROUND)]
+    assert n == BLOCK + (BLOCK + 100)